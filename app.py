@@ -1,23 +1,49 @@
 # --- 引用所有必要的函式庫 ---
+import time
+STARTUP_STARTED = time.perf_counter()  # 啟動耗時從這裡開始計算
 import os
+import sys
 import re
 import json
+import csv
+import io
+import hmac
+import tempfile
+import importlib.util
 import datetime
 import gc
+import atexit
+import logging
+import logging.handlers
+from abc import ABC, abstractmethod
 from datetime import date, timedelta
 import gspread
+import numpy as np
 import pandas as pd
-from flask import Flask, request, abort, g
+from flask import Flask, request, abort, g, Response, stream_with_context
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 import threading
-import time
 import hashlib
+import queue
+import zlib
+import bisect
+import sqlite3
+import uuid
+import fcntl
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # --- 初始設定 ---
+STARTUP_IMPORTS_DONE = time.perf_counter()
 app = Flask(__name__)
 
 YOUR_CHANNEL_ACCESS_TOKEN = os.environ.get('YOUR_CHANNEL_ACCESS_TOKEN')
@@ -41,111 +67,2022 @@ DAILY_SUMMARY_SHEET = "每日統整"
 MAX_SESSIONS = 100  # 最多保留 100 個 Session
 SESSION_EXPIRE_DAYS = 7  # Session 保留 7 天
 CLEANUP_INTERVAL_HOURS = 6  # 每 6 小時清理一次
+SESSION_LOCK_STRIPES = int(os.environ.get('SESSION_LOCK_STRIPES', 64))  # Session 鎖分段數
+
+# [優化] 排程只由一個程序執行: 多個 gunicorn worker 以檔案鎖選出 leader，
+# 其他程序定期重試，leader 結束（含當機）時系統自動釋放鎖由其他程序接手
+SCHEDULER_LOCK_PATH = os.environ.get('SCHEDULER_LOCK_PATH')  # 預設放在本機 SQLite 旁
+LEADER_RETRY_INTERVAL = 30  # 未取得 leader 時重試間隔（秒）
+JOB_RUNNING_TIMEOUT = 3600  # 執行中超過此秒數視為中斷，同一個 run id 可重新執行
+JOB_HISTORY_DAYS = 30  # 排程執行記錄保留天數
 
 line_bot_api = LineBotApi(YOUR_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(YOUR_CHANNEL_SECRET)
 
-# [優化] 使用字典而非全局變量
-processed_messages = {}
+# [優化] 重複事件檢查: memory 為單一程序；sqlite 讓多個 worker 共用
 DUPLICATE_CHECK_WINDOW = 300
-session_states = {}
-session_lock = threading.Lock()  # [新增] 線程安全鎖
+DEDUP_BACKEND = os.environ.get('DEDUP_BACKEND', 'memory')
+
+# [優化] Session 儲存: memory 僅限單一程序；sqlite 讓多個 worker 共用並在重啟後保留
+SESSION_STORE_BACKEND = os.environ.get('SESSION_STORE', 'sqlite')
+
+# [優化] 寫入 outbox 設定
+LOCAL_DB_PATH = os.environ.get('LOCAL_DB_PATH', 'bot_state.db')  # 本機 SQLite 檔案
+SHEETS_WRITE_QUOTA_PER_MINUTE = 60  # Google Sheets 每位使用者每分鐘寫入上限
+OUTBOX_FLUSH_INTERVAL = 5  # 背景送出間隔（秒）
+OUTBOX_COALESCE_SECONDS = 0.5  # 收到新寫入後稍等，讓同一波寫入合併送出
+OUTBOX_BATCH_LIMIT = 500  # 每次最多處理幾筆
+OUTBOX_MAX_BACKOFF = 300  # 重試最長間隔（秒）
+OUTBOX_CLAIM_TIMEOUT = 120  # 其他程序領取後逾時未完成即可重領（秒）
+OUTBOX_UNRESOLVED_MAX_ATTEMPTS = 8  # 更新找不到對應的列（新增列也不在 outbox）超過次數即移到 dead letter
+
+# [優化] 出勤本機封存: 以 NumPy 欄位檔 + memory map 保存全部歷史，只增量同步
+ATTENDANCE_ARCHIVE_DIR = os.environ.get('ATTENDANCE_ARCHIVE_DIR', 'attendance_archive')
+ARCHIVE_RESYNC_DAYS = 7  # 近幾天的列可能還會補上離場，同步時重新讀取
+
+# [優化] 出勤表分區: 已結束的月份由排程移到「出勤時數計算_YYYY-MM」工作表，主表只保留近期的列
+ATTENDANCE_HEADERS = ["日期", "姓名", "簽到時間", "離場時間", "出勤時數", "備註", "更新時間"]
+ATTENDANCE_PARTITION_PREFIX = f"{ATTENDANCE_SHEET_NAME}_"
+ATTENDANCE_ROLLOVER_GRACE_DAYS = 10  # 月底後幾天才移出（需大於 ARCHIVE_RESYNC_DAYS）
+ATTENDANCE_ROLLOVER_HOUR = 3  # 每天幾點（台灣時間）檢查是否有月份可移出
+ROLLOVER_PAUSE_SECONDS = 300  # 移出期間暫停 outbox 送出的上限（秒）
+PERIOD_PENDING_TIMEOUT = 30  # 離場寫入超過此秒數仍未累加總計即視為中斷，重建總計不再等待
+
+# [優化] 出勤資料後端: sheets 以試算表為主；sqlite / memory 只存在本機；
+# mirror 由本機 SQLite 負責讀寫，試算表經由 outbox 非同步同步給辦公室人員查看
+ATTENDANCE_BACKEND = os.environ.get('ATTENDANCE_BACKEND', 'sheets')
 
-# Google Sheets 連線
-try:
+# [優化] Webhook 非同步處理設定
+EVENT_WORKER_COUNT = int(os.environ.get('EVENT_WORKER_COUNT', 4))  # 背景處理線程數
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 50))  # 每個線程的佇列上限
+# 分派模式: queue 依 Session key 雜湊到固定線程；partitioned 同一則 webhook 內的事件依
+# Session key 分區，各分區在線程池中同時處理，分區內（以及跨 webhook 的同一分區）維持順序
+WEBHOOK_DISPATCH_MODE = os.environ.get('WEBHOOK_DISPATCH_MODE', 'queue')
+DISPATCH_POOL_SIZE = int(os.environ.get('DISPATCH_POOL_SIZE', 8))  # partitioned 模式的線程數
+REPLY_TOKEN_TTL_SECONDS = 50  # reply token 有效時間（保守估計）
+WARM_START_WAIT_SECONDS = 60  # 事件線程最多等待預熱幾秒
+
+# [優化] 訊息處理的記錄: 放入佇列由背景線程寫出，DEBUG 記錄依事件抽樣
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # text 或 json（每行一筆 JSON）
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.1))  # DEBUG 時記錄完整流程的事件比例
+LOG_QUEUE_SIZE = 10000  # 記錄佇列上限，滿了就丟棄並計數
+
+# [優化] Sheets 連線管理
+SHEETS_CONNECT_TIMEOUT = 5  # 建立連線逾時（秒）
+SHEETS_READ_TIMEOUT = 30  # 等待回應逾時（秒）
+SHEETS_POOL_SIZE = 10  # keep-alive 連線池大小
+SHEETS_TOKEN_REFRESH_MARGIN = 600  # token 到期前幾秒先在背景更新
+SHEETS_BREAKER_THRESHOLD = 5  # 連續失敗幾次後斷路
+SHEETS_BREAKER_COOLDOWN = 30  # 斷路後多久放行一次試探（秒）
+SHEETS_MAINTENANCE_INTERVAL = 30  # 背景檢查連線與 token 的間隔（秒）
+SHEETS_RECONNECT_MAX_BACKOFF = 300  # 重新連線最長間隔（秒）
+
+# [優化] 薪資匯出: 依日期分段讀取本機資料、邊產生邊送出，記憶體用量與匯出範圍無關
+EXPORT_TOKEN = os.environ.get('EXPORT_TOKEN')  # 未設定時停用 /export/attendance
+EXPORT_CHUNK_DAYS = 31  # 每次讀取幾天的出勤列
+EXPORT_CSV_FLUSH_ROWS = 1000  # CSV 每累積幾列送出一次
+
+# [優化] Google Sheets 連線: 第一次使用時才連線，試算表只開啟一次，
+# 所有工作表由同一次 metadata 讀取取得；啟動時不必等待 Google 回應
+gsheet_client = None
+spreadsheet = None
+worksheet = None
+attendance_sheet = None
+summary_sheet = None
+attendance_partitions = {}  # 分區工作表名稱 -> worksheet
+sheets_credentials = None
+sheets_session = None
+sheets_connect_attempted = False
+sheets_connect_lock = threading.Lock()
+
+class SheetsUnavailableError(Exception):
+    """Sheets 斷路中，呼叫直接失敗而不等待逾時"""
+
+class CircuitBreaker:
+    """連續失敗達門檻後斷路，冷卻時間過後放行一次試探呼叫"""
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None  # 最近一次斷路（試探失敗會重設），用來計算冷卻
+        self.first_opened_at = None  # 這次斷路開始的時間，恢復前不會重設
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+    
+    def is_open(self):
+        """冷卻中（不含可試探的半開狀態）"""
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+    
+    def open_seconds(self):
+        """從第一次斷路起算的秒數；試探失敗不會重新計時"""
+        with self.lock:
+            return time.monotonic() - self.first_opened_at if self.first_opened_at is not None else 0
+    
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial_in_flight:
+                raise SheetsUnavailableError("Google Sheets 暫時無法使用（斷路中）")
+            self.trial_in_flight = True
+    
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log.info("✅ Google Sheets 已恢復，解除斷路")
+            self.failures = 0
+            self.opened_at = None
+            self.first_opened_at = None
+            self.trial_in_flight = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.failures >= self.threshold:
+                now = time.monotonic()
+                if self.opened_at is None:
+                    log.warning("⚠️ Google Sheets 連續失敗 %d 次，斷路 %s 秒", self.failures, self.cooldown)
+                    self.first_opened_at = now
+                self.opened_at = now
+
+sheets_breaker = CircuitBreaker(SHEETS_BREAKER_THRESHOLD, SHEETS_BREAKER_COOLDOWN)
+
+def is_sheets_degraded_error(error):
+    """連線問題、逾時與 5xx 才算 Google 異常；4xx（含配額）代表服務有回應"""
+    if isinstance(error, RequestException):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return error.code >= 500
+    return False
+
+def build_sheets_session(creds):
+    """keep-alive 連線池；只有讀取在連線錯誤或 5xx 時自動重試"""
+    session = AuthorizedSession(creds)
+    retry = Retry(total=2, connect=2, read=1, backoff_factor=0.5,
+                  status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET']),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=SHEETS_POOL_SIZE, pool_maxsize=SHEETS_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    return session
+
+def connect_sheets():
+    """授權並開啟試算表一次，缺少的工作表才建立"""
+    global gsheet_client, spreadsheet, worksheet, attendance_sheet, summary_sheet
+    global sheets_credentials, sheets_session, attendance_partitions
+    timings = []
+    step = time.perf_counter()
+    
     creds_json = json.loads(GOOGLE_SHEETS_CREDENTIALS_JSON)
     scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/drive']
     creds = Credentials.from_service_account_info(creds_json, scopes=scope)
-    gsheet_client = gspread.authorize(creds)
-    worksheet = gsheet_client.open(GOOGLE_SHEET_NAME).worksheet(WORKSHEET_NAME)
+    session = build_sheets_session(creds)
+    client = gspread.Client(auth=creds, session=session)
+    client.set_timeout((SHEETS_CONNECT_TIMEOUT, SHEETS_READ_TIMEOUT))
+    # 換發 token 用獨立的 HTTP 請求；傳入 AuthorizedSession 會在換發時再觸發一次授權
+    creds.refresh(GoogleAuthRequest())
+    timings.append(("授權", time.perf_counter() - step))
+    
+    step = time.perf_counter()
+    workbook = sheets_call('open', client.open, GOOGLE_SHEET_NAME)
+    timings.append(("開啟試算表", time.perf_counter() - step))
+    
+    step = time.perf_counter()
+    sheets_by_title = {sheet.title: sheet for sheet in sheets_call('worksheets', workbook.worksheets)}
+    timings.append(("讀取工作表清單", time.perf_counter() - step))
     
+    if WORKSHEET_NAME not in sheets_by_title:
+        raise gspread.exceptions.WorksheetNotFound(WORKSHEET_NAME)
+    
+    step = time.perf_counter()
+    attendance = sheets_by_title.get(ATTENDANCE_SHEET_NAME)
+    summary = sheets_by_title.get(DAILY_SUMMARY_SHEET)
+    if attendance is None:
+        attendance = sheets_call('add_worksheet', workbook.add_worksheet,
+                                 title=ATTENDANCE_SHEET_NAME, rows=1000, cols=10)
+        sheets_call('append_row', attendance.append_row, ATTENDANCE_HEADERS)
+        log.info("✅ 已建立出勤時數計算表")
+    if summary is None:
+        summary = sheets_call('add_worksheet', workbook.add_worksheet,
+                              title=DAILY_SUMMARY_SHEET, rows=1000, cols=10)
+        headers = ["統計日期", "姓名", "總出勤天數", "統計時間"]
+        sheets_call('append_row', summary.append_row, headers)
+        log.info("✅ 已建立每日統整表")
+    if ATTENDANCE_SHEET_NAME not in sheets_by_title or DAILY_SUMMARY_SHEET not in sheets_by_title:
+        timings.append(("建立工作表", time.perf_counter() - step))
+    
+    old_session = sheets_session
+    sheets_credentials = creds
+    sheets_session = session
+    gsheet_client = client
+    spreadsheet = workbook
+    worksheet = sheets_by_title[WORKSHEET_NAME]
+    attendance_sheet = attendance
+    summary_sheet = summary
+    attendance_partitions = {title: sheet for title, sheet in sheets_by_title.items()
+                             if ATTENDANCE_PARTITION_PATTERN.match(title)}
+    if old_session is not None:
+        old_session.close()
+    sheets_breaker.record_success()
+    log.info("✅ Google Sheets 連線成功！(%s)", ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings))
+
+def sheets_configured():
+    """已連線，或有憑證可在之後連線"""
+    return attendance_sheet is not None or bool(GOOGLE_SHEETS_CREDENTIALS_JSON)
+
+def sheets_outbox_enabled():
+    """只有 sheets / mirror 後端會把寫入排進 outbox；本機後端不必連線 Google"""
+    return ATTENDANCE_BACKEND in ('sheets', 'mirror') and sheets_configured()
+
+def ensure_sheets():
+    """第一次呼叫時連線 Google Sheets，回傳出勤表是否可用
+    
+    已經指定 attendance_sheet（例如測試時換成模擬工作表）就不再連線；
+    連線失敗時由背景線程重試，這裡不會再等待
+    """
+    global sheets_connect_attempted
+    if not sheets_connect_attempted:
+        with sheets_connect_lock:
+            if not sheets_connect_attempted:
+                if attendance_sheet is None:
+                    try:
+                        connect_sheets()
+                    except Exception as e:
+                        log.error("❌ Google Sheets 連線失敗，稍後在背景重試: %s", e)
+                sheets_connect_attempted = True
+    return attendance_sheet is not None
+
+def refresh_sheets_token_if_due():
+    """token 快到期時先更新，請求路徑不必等待換發"""
+    creds = sheets_credentials
+    if creds is None or creds.expiry is None:
+        return
+    # google-auth 的 expiry 為不含時區的 UTC 時間
+    remaining = (creds.expiry - datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)).total_seconds()
+    if remaining > SHEETS_TOKEN_REFRESH_MARGIN:
+        return
     try:
-        attendance_sheet = gsheet_client.open(GOOGLE_SHEET_NAME).worksheet(ATTENDANCE_SHEET_NAME)
-    except gspread.exceptions.WorksheetNotFound:
-        workbook = gsheet_client.open(GOOGLE_SHEET_NAME)
-        attendance_sheet = workbook.add_worksheet(title=ATTENDANCE_SHEET_NAME, rows=1000, cols=10)
-        headers = ["日期", "姓名", "簽到時間", "離場時間", "出勤時數", "備註", "更新時間"]
-        attendance_sheet.append_row(headers)
-        print("✅ 已建立出勤時數計算表")
+        creds.refresh(GoogleAuthRequest())
+        log.info("🔑 已更新 Google token（原剩 %d 秒）", remaining)
+    except Exception as e:
+        sheets_breaker.record_failure()
+        log.warning("⚠️ 更新 Google token 失敗: %s", e)
+
+def sheets_maintenance():
+    """背景線程: 連線失敗或長時間斷路時重新連線，並提前更新 token"""
+    backoff = SHEETS_MAINTENANCE_INTERVAL
+    while True:
+        time.sleep(backoff)
+        try:
+            if not GOOGLE_SHEETS_CREDENTIALS_JSON:
+                continue
+            needs_reconnect = (
+                (sheets_connect_attempted and attendance_sheet is None)
+                or sheets_breaker.open_seconds() >= SHEETS_BREAKER_COOLDOWN * 3
+            )
+            if needs_reconnect:
+                try:
+                    with sheets_connect_lock:
+                        connect_sheets()
+                    backoff = SHEETS_MAINTENANCE_INTERVAL
+                except Exception as e:
+                    backoff = min(SHEETS_RECONNECT_MAX_BACKOFF, backoff * 2)
+                    log.error("❌ Google Sheets 重新連線失敗，%d 秒後再試: %s", backoff, e)
+                continue
+            refresh_sheets_token_if_due()
+        except Exception as e:
+            log.error("❌ Sheets 背景維護錯誤: %s", e)
+
+sheets_maintenance_thread = threading.Thread(target=sheets_maintenance, daemon=True, name='sheets-maintenance')
+
+# [優化] 效能指標: 以 Prometheus 文字格式從 /metrics 輸出
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+class Counter:
+    """累計計數器"""
+    
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+class Histogram:
+    """延遲分布，bucket 為累積計數"""
     
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}  # labels -> [各 bucket 計數..., sum, count]
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, data in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, data):
+                    labels = _format_labels(self.label_names, key, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.label_names, key, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {data[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {data[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {data[-1]}")
+        return lines
+
+class Gauge:
+    """目前值，於輸出時呼叫 func 取得"""
+    
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        metrics_registry.append(self)
+    
+    def render(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+metrics_registry = []
+
+# handle_message 各分支: report=日報, add_staff=新增, checkout=離場, crew_checkout=人員離場,
+# period_query=查詢本期出勤, period_refresh=重新整理出勤, status=系統狀態, rejected=無權限, duplicate=重複, unknown=未識別
+command_latency = Histogram('bot_command_latency_seconds', 'handle_message latency by command', ('command',))
+sheets_call_latency = Histogram('bot_sheets_call_latency_seconds', 'Google Sheets API call latency', ('method',))
+sheets_calls_total = Counter('bot_sheets_calls_total', 'Google Sheets API calls', ('method', 'status'))
+gc_collect_seconds = Histogram('bot_after_request_gc_seconds', 'Time spent in gc.collect() after each request',
+                               buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+def sheets_call(method, func, *args, **kwargs):
+    """呼叫 gspread 並記錄次數與延遲；斷路中直接丟出 SheetsUnavailableError"""
     try:
-        summary_sheet = gsheet_client.open(GOOGLE_SHEET_NAME).worksheet(DAILY_SUMMARY_SHEET)
-    except gspread.exceptions.WorksheetNotFound:
-        workbook = gsheet_client.open(GOOGLE_SHEET_NAME)
-        summary_sheet = workbook.add_worksheet(title=DAILY_SUMMARY_SHEET, rows=1000, cols=10)
-        headers = ["統計日期", "姓名", "總出勤天數", "統計時間"]
-        summary_sheet.append_row(headers)
-        print("✅ 已建立每日統整表")
+        sheets_breaker.before_call()
+    except SheetsUnavailableError:
+        sheets_calls_total.inc(method=method, status='rejected')
+        raise
+    started = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        sheets_calls_total.inc(method=method, status='error')
+        if is_sheets_degraded_error(e):
+            sheets_breaker.record_failure()
+        else:
+            sheets_breaker.record_success()
+        raise
+    finally:
+        sheets_call_latency.observe(time.perf_counter() - started, method=method)
+    sheets_breaker.record_success()
+    sheets_calls_total.inc(method=method, status='ok')
+    return result
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# [優化] 結構化記錄: 呼叫端只把未格式化的記錄放進佇列，格式化與寫 stdout 在背景線程；
+# 每個事件有 correlation id，DEBUG 記錄以事件為單位抽樣，同一事件的流程不會只記一半
+log_records_dropped = Counter('bot_log_records_dropped_total', 'Log records dropped because the log queue was full')
+log_context = threading.local()  # event_id, sampled
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+log_listener = None
+log_listener_pid = None
+log_listener_lock = threading.Lock()
+
+def start_log_context(event):
+    """事件開始處理: 以 webhookEventId 為 correlation id 並決定是否抽樣 DEBUG 記錄"""
+    event_id = getattr(event, 'webhook_event_id', None) or uuid.uuid4().hex
+    log_context.event_id = event_id[:12]
+    log_context.sampled = zlib.crc32(event_id.encode()) < LOG_DEBUG_SAMPLE_RATE * 0x100000000
+
+def clear_log_context():
+    log_context.event_id = None
+    log_context.sampled = True
+
+class LogContextFilter(logging.Filter):
+    """在呼叫端線程加上 correlation id，並丟掉未抽樣事件的 DEBUG 記錄"""
     
-    print("✅ Google Sheets 連線成功！")
-except Exception as e:
-    print(f"❌ Google Sheets 連線失敗: {e}")
-    worksheet = None
-    attendance_sheet = None
-    summary_sheet = None
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and not getattr(log_context, 'sampled', True):
+            return False
+        record.event_id = getattr(log_context, 'event_id', None)
+        return True
 
-# [優化] 主動垃圾回收
-@app.after_request
-def after_request(response):
-    """每次請求後強制垃圾回收"""
-    gc.collect()
-    return response
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """只放入佇列，不在呼叫端格式化；fork 後的程序第一次記錄時啟動自己的寫出線程"""
+    
+    def prepare(self, record):
+        return record
+    
+    def enqueue(self, record):
+        if log_listener_pid != os.getpid():
+            start_log_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
 
-# [優化] 清理過期資源
-def cleanup_old_sessions():
-    """清理過期的 Session 和 processed_messages"""
-    with session_lock:
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        message = record.getMessage()
+        if record.event_id:
+            message = f"[{record.event_id}] {message}"
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        return message
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'event_id': record.event_id,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def start_log_listener():
+    global log_listener, log_listener_pid
+    with log_listener_lock:
+        if log_listener_pid == os.getpid():
+            return
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else TextLogFormatter())
+        log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        log_listener.start()
+        log_listener_pid = os.getpid()
+
+def flush_logs():
+    """等佇列中的記錄都寫出（測試與程序結束時使用）"""
+    if log_listener_pid == os.getpid():
+        log_queue.join()
+
+atexit.register(flush_logs)
+
+log = logging.getLogger('attendance_bot')
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+log.addFilter(LogContextFilter())
+log.addHandler(LogQueueHandler(log_queue))
+
+# [優化] 出勤列索引: (日期, 姓名) -> 尚未離場的列號，離場時不必再下載整張表
+attendance_row_index = {}
+attendance_index_lock = threading.Lock()
+attendance_index_generation = None  # 建立索引時的 sheet_layout generation，主表刪列後列號失效
+APPENDED_RANGE_PATTERN = re.compile(r"!\$?[A-Z]+\$?(\d+)(?::\$?[A-Z]+\$?(\d+))?$")
+
+def parse_appended_rows(response):
+    """從 append 回應的 updatedRange 取出寫入的起訖列號"""
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (KeyError, TypeError):
+        return None
+    match = APPENDED_RANGE_PATTERN.search(updated_range)
+    if not match:
+        return None
+    start_row = int(match.group(1))
+    end_row = int(match.group(2)) if match.group(2) else start_row
+    return start_row, end_row
+
+PENDING_ROW = -1  # 已寫入 outbox、尚未取得列號
+CLOSED_ROW = -2  # 已離場（含 outbox 中尚未送出的離場），不必再更新
+
+def make_row_key(work_date, person_name):
+    return f"{work_date}|{person_name}"
+
+def split_row_key(row_key):
+    work_date, person_name = row_key.split('|', 1)
+    return work_date, person_name
+
+def attendance_index_key(work_date, person_name):
+    """出勤列索引以正規化姓名為 key，試算表上手動輸入的全形或多空白姓名也對得到"""
+    return work_date, normalize_staff_name(person_name)
+
+# [優化] 本機 SQLite: 每個線程各自一條連線，WAL 模式讓多個程序可同時讀寫
+_local_db = threading.local()
+
+def get_local_db():
+    """取得目前線程的本機 SQLite 連線"""
+    conn = getattr(_local_db, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(LOCAL_DB_PATH, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local_db.conn = conn
+    return conn
+
+def init_outbox():
+    """建立 outbox 資料表"""
+    conn = get_local_db()
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS sheet_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sheet TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            row_key TEXT,
+            target_row INTEGER,
+            cell_range TEXT,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at REAL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_sheet ON sheet_outbox (sheet, id);
+        CREATE TABLE IF NOT EXISTS sheet_row_map (
+            sheet TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            created REAL NOT NULL,
+            PRIMARY KEY (sheet, row_key)
+        );
+        CREATE TABLE IF NOT EXISTS sheet_outbox_dead (
+            id INTEGER PRIMARY KEY,
+            sheet TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            row_key TEXT,
+            cell_range TEXT,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            failed REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sheet_layout (
+            key TEXT PRIMARY KEY,
+            value REAL NOT NULL
+        );
+    """)
+
+init_outbox()
+
+class TokenBucket:
+    """Token bucket，讓寫入速度配合 Sheets 每分鐘配額
+    
+    token 數存在本機 SQLite，所有 worker 程序共用同一個配額，不會變成 N 倍
+    """
+    
+    def __init__(self, name, rate_per_minute, capacity=None):
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        get_local_db().execute("""
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+    
+    def _take(self):
+        """取得一個 token 時回傳 0，否則回傳需要等待的秒數"""
+        conn = get_local_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM rate_limits WHERE name = ?", (self.name,)).fetchone()
+            if row is None:
+                tokens = float(self.capacity)
+            else:
+                # 系統時間回撥時不補充，也不扣回
+                tokens = min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            conn.execute(
+                "INSERT INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (self.name, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+    
+    def acquire(self):
+        """取得一個 token，不足時等待"""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+sheets_write_bucket = TokenBucket('sheets_write', SHEETS_WRITE_QUOTA_PER_MINUTE)
+outbox_wakeup = threading.Event()
+outbox_flush_lock = threading.Lock()
+outbox_dead_letters = Counter('bot_outbox_dead_letters_total', 'Sheet writes moved to the dead-letter table')
+
+def enqueue_sheet_ops(ops):
+    """將寫入動作存進 outbox
+    
+    ops 為 [(sheet, kind, row_key, target_row, cell_range, values), ...]
+    kind: 'append' 新增一列 / 'update' 更新 target_row 的 cell_range 欄位
+    target_row 未知時為 None，送出前再依 row_key 查出列號
+    """
+    conn = get_local_db()
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(
+            "INSERT INTO sheet_outbox (sheet, kind, row_key, target_row, cell_range, payload, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(sheet, kind, row_key, target_row, cell_range, json.dumps(values, ensure_ascii=False), now)
+             for sheet, kind, row_key, target_row, cell_range, values in ops]
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    outbox_wakeup.set()
+
+def get_outbox_size():
+    return get_local_db().execute("SELECT COUNT(*) FROM sheet_outbox").fetchone()[0]
+
+def get_outbox_dead_size():
+    return get_local_db().execute("SELECT COUNT(*) FROM sheet_outbox_dead").fetchone()[0]
+
+def get_pending_row_keys(sheet):
+    """outbox 中尚未送出的列: 回傳 (仍開放的 row_key, 已排定離場的 row_key)"""
+    open_keys = set()
+    closed_keys = set()
+    rows = get_local_db().execute(
+        "SELECT kind, row_key FROM sheet_outbox WHERE sheet = ? AND row_key IS NOT NULL ORDER BY id",
+        (sheet,)
+    ).fetchall()
+    for kind, row_key in rows:
+        if kind == 'append':
+            open_keys.add(row_key)
+            closed_keys.discard(row_key)
+        else:
+            open_keys.discard(row_key)
+            closed_keys.add(row_key)
+    return open_keys, closed_keys
+
+def get_sheet_targets():
+    """outbox 中的工作表名稱 -> worksheet"""
+    ensure_sheets()
+    return {
+        ATTENDANCE_SHEET_NAME: attendance_sheet,
+        DAILY_SUMMARY_SHEET: summary_sheet,
+    }
+
+# 出勤表分區與主表列號變動
+ATTENDANCE_PARTITION_PATTERN = re.compile(rf"^{re.escape(ATTENDANCE_PARTITION_PREFIX)}\d{{4}}-\d{{2}}$")
+
+def attendance_partition_title(day):
+    return f"{ATTENDANCE_PARTITION_PREFIX}{day.year:04d}-{day.month:02d}"
+
+def attendance_partition_titles():
+    """全部分區工作表名稱，依月份排序"""
+    return sorted(attendance_partitions)
+
+def get_attendance_partition(title):
+    """取得分區工作表，不存在時以出勤表的表頭建立"""
+    sheet = attendance_partitions.get(title)
+    if sheet is None:
+        sheet = sheets_call('add_worksheet', spreadsheet.add_worksheet, title=title, rows=1000, cols=10)
+        sheets_call('append_row', sheet.append_row, ATTENDANCE_HEADERS)
+        attendance_partitions[title] = sheet
+        log.info("✅ 已建立出勤分區: %s", title)
+    return sheet
+
+def get_layout_value(key):
+    row = get_local_db().execute("SELECT value FROM sheet_layout WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+def set_layout_value(key, value):
+    get_local_db().execute(
+        "INSERT INTO sheet_layout (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value)
+    )
+
+def is_outbox_paused():
+    """移出主表的列時暫停所有程序送出 outbox"""
+    return get_layout_value('outbox_paused_until') > time.time()
+
+def wait_for_outbox_claims(timeout=60):
+    """等其他程序正在送出的 outbox 完成，回傳是否已沒有進行中的送出"""
+    deadline = time.time() + timeout
+    while True:
+        claimed = get_local_db().execute(
+            "SELECT COUNT(*) FROM sheet_outbox WHERE claimed_by IS NOT NULL AND claimed_at > ?",
+            (time.time() - OUTBOX_CLAIM_TIMEOUT,)
+        ).fetchone()[0]
+        if not claimed:
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(1)
+
+def remap_sheet_rows(sheet, deleted_rows):
+    """工作表刪列後修正 outbox 與列號對照中的列號，並遞增 generation 通知其他程序重建出勤索引"""
+    deleted = sorted(deleted_rows)
+    deleted_set = set(deleted)
+    
+    def shift(row):
+        return row - bisect.bisect_left(deleted, row)
+    
+    conn = get_local_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        mapped = conn.execute("SELECT row_key, row FROM sheet_row_map WHERE sheet = ?", (sheet,)).fetchall()
+        conn.executemany("DELETE FROM sheet_row_map WHERE sheet = ? AND row_key = ?",
+                         [(sheet, row_key) for row_key, row in mapped if row in deleted_set])
+        conn.executemany("UPDATE sheet_row_map SET row = ? WHERE sheet = ? AND row_key = ?",
+                         [(shift(row), sheet, row_key) for row_key, row in mapped if row not in deleted_set])
+        targeted = conn.execute(
+            "SELECT id, target_row FROM sheet_outbox WHERE sheet = ? AND target_row IS NOT NULL", (sheet,)
+        ).fetchall()
+        conn.executemany("UPDATE sheet_outbox SET target_row = ? WHERE id = ?",
+                         [(None if row in deleted_set else shift(row), op_id) for op_id, row in targeted])
+        set_layout_value('generation', get_layout_value('generation') + 1)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def recover_interrupted_rollover():
+    """移出主表的列時在刪列後、修正列號前中斷: 列號對照依試算表現況重建，回傳是否有修正
+    
+    無法確定刪列是否已生效，所以不套用預期的位移，而是重新讀取主表，
+    outbox 中的更新改依 row_key 找列，出勤封存從分區與主表重建
+    """
+    if not get_layout_value('rollover_deleting'):
+        return False
+    values = sheets_call('get_values', attendance_sheet.get_values, 'A2:B')
+    current_rows = {}
+    for row_number, row in enumerate(values, start=2):
+        if len(row) >= 2:
+            current_rows.setdefault(make_row_key(row[0], row[1]), []).append(row_number)
+    
+    conn = get_local_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if not get_layout_value('rollover_deleting'):
+            # 其他程序已經修正
+            conn.execute('COMMIT')
+            return False
+        mapped = conn.execute("SELECT row_key, row FROM sheet_row_map WHERE sheet = ?",
+                              (ATTENDANCE_SHEET_NAME,)).fetchall()
+        conn.executemany("DELETE FROM sheet_row_map WHERE sheet = ? AND row_key = ?",
+                         [(ATTENDANCE_SHEET_NAME, row_key) for row_key, _ in mapped if row_key not in current_rows])
+        conn.executemany(
+            "UPDATE sheet_row_map SET row = ? WHERE sheet = ? AND row_key = ?",
+            [(row if row in current_rows[row_key] else current_rows[row_key][-1], ATTENDANCE_SHEET_NAME, row_key)
+             for row_key, row in mapped if row_key in current_rows]
+        )
+        conn.execute("UPDATE sheet_outbox SET target_row = NULL WHERE sheet = ? AND row_key IS NOT NULL",
+                     (ATTENDANCE_SHEET_NAME,))
+        set_layout_value('generation', get_layout_value('generation') + 1)
+        set_layout_value('rollover_deleting', 0)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    log.warning("⚠️ 上次出勤表移出中斷，已依試算表重建列號對照 (%d 筆)", len(mapped))
+    attendance_archive.sync(rebuild=True)
+    rebuild_attendance_index(reset=True)
+    return True
+
+def _release_outbox_ops(conn, ops, error=None):
+    """送出失敗: 釋放領取並依次數延後重試"""
+    now = time.time()
+    conn.executemany(
+        "UPDATE sheet_outbox SET attempts = attempts + 1, next_attempt = ?, claimed_by = NULL WHERE id = ?",
+        [(now + min(OUTBOX_MAX_BACKOFF, 2 ** op['attempts']), op['id']) for op in ops]
+    )
+    if error is not None:
+        log.warning("❌ outbox 送出失敗 (%d 筆)，稍後重試: %s", len(ops), error)
+
+def _delete_outbox_ops(conn, ops):
+    conn.executemany("DELETE FROM sheet_outbox WHERE id = ?", [(op['id'],) for op in ops])
+
+def _dead_letter_outbox_ops(conn, ops, reason):
+    """無法送出的寫入移到 sheet_outbox_dead，不再占用 outbox，留待人工處理"""
+    if not ops:
+        return
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sheet_outbox_dead (id, sheet, kind, row_key, cell_range, payload, attempts, reason, failed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(op['id'], op['sheet'], op['kind'], op['row_key'], op['cell_range'], op['payload'],
+              op['attempts'] + 1, reason, now) for op in ops]
+        )
+        _delete_outbox_ops(conn, ops)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    outbox_dead_letters.inc(len(ops))
+    log.error("❌ outbox %d 筆寫入移到 dead letter: %s (%s)", len(ops), reason,
+              ", ".join(sorted({op['row_key'] or '' for op in ops}))[:200])
+
+def is_unresolvable_update(conn, op):
+    """更新找不到列號: 沒有 row_key，或重試多次後對應的新增列也已不在 outbox（送出失敗放棄或已移出主表）"""
+    if not op['row_key']:
+        return True
+    if op['attempts'] + 1 < OUTBOX_UNRESOLVED_MAX_ATTEMPTS:
+        return False
+    pending_append = conn.execute(
+        "SELECT 1 FROM sheet_outbox WHERE sheet = ? AND row_key = ? AND kind = 'append' LIMIT 1",
+        (op['sheet'], op['row_key'])
+    ).fetchone()
+    return pending_append is None
+
+def flush_outbox():
+    """把 outbox 中的寫入合併成 append_rows / batch_update 送出，回傳完成筆數"""
+    if not sheets_outbox_enabled():
+        return 0
+    if not ensure_sheets() or sheets_breaker.is_open() or is_outbox_paused():
+        # 未連線、斷路中或正在移出主表的列: 保留在 outbox，不增加重試次數
+        return 0
+    # 上次移出主表的列中斷時，列號對照可能已失效，先修正再送出
+    recover_interrupted_rollover()
+    with outbox_flush_lock:
+        conn = get_local_db()
+        claim_token = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        now = time.time()
+        
+        conn.execute('BEGIN IMMEDIATE')
         try:
-            current_time = time.time()
-            cutoff_date = date.today() - timedelta(days=SESSION_EXPIRE_DAYS)
+            conn.execute(
+                "UPDATE sheet_outbox SET claimed_by = ?, claimed_at = ? WHERE id IN ("
+                "SELECT id FROM sheet_outbox WHERE next_attempt <= ? "
+                "AND (claimed_by IS NULL OR claimed_at < ?) ORDER BY id LIMIT ?)",
+                (claim_token, now, now, now - OUTBOX_CLAIM_TIMEOUT, OUTBOX_BATCH_LIMIT)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        
+        columns = ['id', 'sheet', 'kind', 'row_key', 'target_row', 'cell_range', 'payload', 'attempts']
+        ops = [dict(zip(columns, row)) for row in conn.execute(
+            f"SELECT {', '.join(columns)} FROM sheet_outbox WHERE claimed_by = ? ORDER BY id",
+            (claim_token,)
+        )]
+        if not ops:
+            return 0
+        
+        targets = get_sheet_targets()
+        done_count = 0
+        
+        # 1. 同一張表的新增列合併成一次 append_rows
+        appends = {}
+        for op in ops:
+            if op['kind'] == 'append':
+                appends.setdefault(op['sheet'], []).append(op)
+        
+        for sheet_name, sheet_ops in appends.items():
+            sheet = targets.get(sheet_name)
+            if sheet is None:
+                _release_outbox_ops(conn, sheet_ops, "工作表未連線")
+                continue
+            try:
+                sheets_write_bucket.acquire()
+                response = sheets_call('append_rows', sheet.append_rows,
+                                       [json.loads(op['payload']) for op in sheet_ops])
+            except Exception as e:
+                _release_outbox_ops(conn, sheet_ops, e)
+                continue
             
-            # 清理過期 Session
-            sessions_to_remove = []
-            for session_key, session in session_states.items():
-                try:
-                    session_date = datetime.datetime.strptime(session.work_date, '%Y/%m/%d').date()
-                    if session_date < cutoff_date:
-                        sessions_to_remove.append(session_key)
-                except:
-                    # 民國年格式轉換
-                    try:
-                        parts = session.work_date.split('/')
-                        minguo_year, month, day = [int(p) for p in parts]
-                        session_date = date(minguo_year + 1911, month, day)
-                        if session_date < cutoff_date:
-                            sessions_to_remove.append(session_key)
-                    except:
-                        pass
+            _delete_outbox_ops(conn, sheet_ops)
+            done_count += len(sheet_ops)
+            appended = parse_appended_rows(response)
+            if appended and appended[1] - appended[0] + 1 == len(sheet_ops):
+                row_map = [(sheet_name, op['row_key'], row_number, time.time())
+                           for row_number, op in enumerate(sheet_ops, start=appended[0]) if op['row_key']]
+                conn.executemany(
+                    "INSERT OR REPLACE INTO sheet_row_map (sheet, row_key, row, created) VALUES (?, ?, ?, ?)",
+                    row_map
+                )
+                if sheet_name == ATTENDANCE_SHEET_NAME:
+                    with attendance_index_lock:
+                        for _, row_key, row_number, _ in row_map:
+                            key = attendance_index_key(*split_row_key(row_key))
+                            if attendance_row_index.get(key) == PENDING_ROW:
+                                attendance_row_index[key] = row_number
+        
+        # 2. 同一張表的儲存格更新合併成一次 batch_update
+        updates = {}
+        for op in ops:
+            if op['kind'] == 'update':
+                updates.setdefault(op['sheet'], []).append(op)
+        
+        for sheet_name, sheet_ops in updates.items():
+            sheet = targets.get(sheet_name)
+            if sheet is None:
+                _release_outbox_ops(conn, sheet_ops, "工作表未連線")
+                continue
             
-            for key in sessions_to_remove:
-                del session_states[key]
+            data = []
+            resolved_ops = []
+            unresolved_ops = []
+            for op in sheet_ops:
+                target_row = op['target_row']
+                if not target_row and op['row_key']:
+                    found = conn.execute(
+                        "SELECT row FROM sheet_row_map WHERE sheet = ? AND row_key = ?",
+                        (sheet_name, op['row_key'])
+                    ).fetchone()
+                    target_row = found[0] if found else None
+                if not target_row:
+                    # 對應的新增列還沒送出
+                    unresolved_ops.append(op)
+                    continue
+                start_col, end_col = op['cell_range'].split(':')
+                data.append({
+                    'range': f"{start_col}{target_row}:{end_col}{target_row}",
+                    'values': [json.loads(op['payload'])]
+                })
+                resolved_ops.append(op)
             
-            # 限制 Session 數量
-            if len(session_states) > MAX_SESSIONS:
-                sorted_sessions = sorted(
-                    session_states.items(),
-                    key=lambda x: x[1].created_time
-                )
-                excess_count = len(session_states) - MAX_SESSIONS
-                for i in range(excess_count):
-                    del session_states[sorted_sessions[i][0]]
+            if unresolved_ops:
+                dead_ops = [op for op in unresolved_ops if is_unresolvable_update(conn, op)]
+                _dead_letter_outbox_ops(conn, dead_ops, "找不到對應的列")
+                _release_outbox_ops(conn, [op for op in unresolved_ops if op not in dead_ops])
+            if not data:
+                continue
+            try:
+                sheets_write_bucket.acquire()
+                sheets_call('batch_update', sheet.batch_update, data)
+            except Exception as e:
+                _release_outbox_ops(conn, resolved_ops, e)
+                continue
+            _delete_outbox_ops(conn, resolved_ops)
+            done_count += len(resolved_ops)
+        
+        if done_count:
+            log.info("✅ outbox 已送出 %d 筆寫入", done_count)
+        return done_count
+
+def outbox_flusher():
+    """背景線程: 定期或收到新寫入時送出 outbox"""
+    while True:
+        try:
+            if outbox_wakeup.wait(OUTBOX_FLUSH_INTERVAL):
+                time.sleep(OUTBOX_COALESCE_SECONDS)
+                outbox_wakeup.clear()
+            while flush_outbox() >= OUTBOX_BATCH_LIMIT:
+                pass
+        except Exception as e:
+            log.error("❌ outbox 背景送出錯誤: %s", e)
+
+outbox_thread = threading.Thread(target=outbox_flusher, daemon=True, name='outbox-flusher')
+
+PROJECT_NOTE_PREFIX = "項目: "
+NOTE_SEPARATOR = "｜"
+
+def to_minguo_str(day):
+    return f"{day.year - 1911:03d}/{day.month:02d}/{day.day:02d}"
+
+def format_minutes(minutes):
+    """當天分鐘數轉 'HH:MM'，負數（未填）回傳空字串"""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}" if minutes >= 0 else ""
+
+def build_attendance_note(project_name, *remarks):
+    """備註欄: 「項目: 專案」在前，個人備註與離場備註以「｜」接在後面，離場後仍看得出專案"""
+    parts = [f"{PROJECT_NOTE_PREFIX}{project_name}"] if project_name else []
+    parts.extend(remark for remark in remarks if remark)
+    return NOTE_SEPARATOR.join(parts)
+
+def note_project(note):
+    """備註以「項目: 專案」開頭時回傳專案名稱，否則回傳 None"""
+    if note and note.startswith(PROJECT_NOTE_PREFIX):
+        return note[len(PROJECT_NOTE_PREFIX):].split(NOTE_SEPARATOR, 1)[0]
+    return None
+
+def parse_hhmm_minutes(value):
+    """'HH:MM' 轉成當天分鐘數，無法解析時回傳 -1"""
+    try:
+        hour, minute = [int(p) for p in str(value).split(':')]
+        return hour * 60 + minute
+    except ValueError:
+        return -1
+
+class AttendanceArchive:
+    """出勤歷史的欄位式本機封存
+    
+    前 live_base 列是已移到分區工作表的歷史，之後每一列對應出勤主表的一列
+    （第 live_base + i 列 = 主表第 i + 2 列），欄位分別存成 .npy 並以 mmap 開啟:
+    date_ord 日期序數、name_id / project_id 字典編碼、sign_in / checkout 分鐘數、days 出勤天數。
+    另存依日期排序的 order / sorted_dates，日期範圍查詢只需二分搜尋。
+    """
+    
+    COLUMNS = {
+        'date_ord': np.int32,
+        'name_id': np.int32,
+        'project_id': np.int32,
+        'sign_in': np.int16,
+        'checkout': np.int16,
+        'days': np.float32,
+    }
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.sync_lock = threading.Lock()
+        self.meta_mtime = None
+        self.names = []
+        self.projects = []
+        self.synced_rows = 0
+        self.live_base = 0  # 已移出主表的列數
+        self.data = {name: np.zeros(0, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        self.order = np.zeros(0, dtype=np.int64)
+        self.sorted_dates = np.zeros(0, dtype=np.int32)
+    
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+    
+    def _load_if_changed(self):
+        """其他程序同步後重新開啟 mmap"""
+        meta_path = self._path('meta.json')
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.meta_mtime:
+            return
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        rows = meta['rows']
+        mmap_mode = 'r' if rows else None  # 空陣列無法 mmap
+        try:
+            data = {name: np.load(self._path(f"{name}.npy"), mmap_mode=mmap_mode) for name in self.COLUMNS}
+            order = np.load(self._path('order.npy'), mmap_mode=mmap_mode)
+            sorted_dates = np.load(self._path('sorted_dates.npy'), mmap_mode=mmap_mode)
+        except (FileNotFoundError, ValueError):
+            return
+        if any(len(column) != rows for column in data.values()):
+            # 寫入中途中斷，等下次完整同步
+            return
+        self.data = data
+        self.order = order
+        self.sorted_dates = sorted_dates
+        self.names = meta['names']
+        self.projects = meta['projects']
+        self.synced_rows = rows
+        self.live_base = meta.get('live_base', 0)
+        self.meta_mtime = mtime
+    
+    @property
+    def live_rows(self):
+        """封存中屬於出勤主表的列數"""
+        return self.synced_rows - self.live_base
+    
+    def _save(self, data, names, projects, live_base):
+        os.makedirs(self.directory, exist_ok=True)
+        order = np.argsort(data['date_ord'], kind='stable')
+        arrays = dict(data, order=order, sorted_dates=data['date_ord'][order])
+        for name, array in arrays.items():
+            tmp_path = self._path(f"{name}.tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, self._path(f"{name}.npy"))
+        # meta 最後寫入，讀取端以它判斷是否有新版本
+        tmp_path = self._path('meta.tmp.json')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'rows': len(data['date_ord']), 'names': names, 'projects': projects,
+                       'live_base': live_base}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path('meta.json'))
+    
+    def _resync_start(self):
+        """主表中需要重新讀取的第一列（0 起算）: 近 ARCHIVE_RESYNC_DAYS 天的列中最前面的一列"""
+        cutoff = (date.today() - timedelta(days=ARCHIVE_RESYNC_DAYS)).toordinal()
+        position = int(np.searchsorted(self.sorted_dates, cutoff, side='left'))
+        if position >= len(self.order):
+            return self.live_rows
+        return max(0, min(self.live_rows, int(np.min(self.order[position:])) - self.live_base))
+    
+    @staticmethod
+    def _parse(values, names, projects):
+        """試算表的列轉成欄位陣列，names / projects 為字典編碼表（會就地新增）"""
+        name_ids = {name: i for i, name in enumerate(names)}
+        project_ids = {project: i for i, project in enumerate(projects)}
+        parsed = {name: np.empty(len(values), dtype=dtype) for name, dtype in AttendanceArchive.COLUMNS.items()}
+        for i, row in enumerate(values):
+            row = (list(row) + [""] * 6)[:6]
+            work_day = minguo_to_gregorian(row[0])
+            parsed['date_ord'][i] = work_day.toordinal() if work_day else 0
             
-            # 清理過期的 processed_messages
-            messages_to_remove = [
-                k for k, v in processed_messages.items() 
-                if current_time - v > DUPLICATE_CHECK_WINDOW
-            ]
-            for key in messages_to_remove:
-                del processed_messages[key]
+            name_id = name_ids.get(row[1])
+            if name_id is None:
+                name_id = name_ids[row[1]] = len(names)
+                names.append(row[1])
+            parsed['name_id'][i] = name_id
             
-            print(f"🧹 清理完成: 移除 {len(sessions_to_remove)} 個過期 Session")
-            print(f"📊 當前 Session 數: {len(session_states)}")
+            project_id = -1
+            project = note_project(row[5])
+            if project is not None:
+                project_id = project_ids.get(project)
+                if project_id is None:
+                    project_id = project_ids[project] = len(projects)
+                    projects.append(project)
+            parsed['project_id'][i] = project_id
             
-            # 強制垃圾回收
-            gc.collect()
+            parsed['sign_in'][i] = parse_hhmm_minutes(row[2])
+            parsed['checkout'][i] = parse_hhmm_minutes(row[3])
+            try:
+                parsed['days'][i] = float(row[4]) if row[4] != "" else np.nan
+            except ValueError:
+                parsed['days'][i] = np.nan
+        return parsed
+    
+    def _exclusive(self):
+        """跨程序的封存寫入鎖，回傳已上鎖的檔案（關閉即解鎖）"""
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(self._path('.lock'), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+    
+    def _read_partitions(self):
+        """本機還沒有封存時，依月份讀入所有分區工作表"""
+        values = []
+        for title in attendance_partition_titles():
+            values.extend(sheets_call('get_values', attendance_partitions[title].get_values, 'A2:F'))
+        return values
+    
+    def sync(self, full=False, rebuild=False):
+        """從出勤表增量同步，回傳讀取的列數
+        
+        完整同步只重新讀取主表；已移到分區的列不會再變動，除非本機封存是空的或 rebuild
+        """
+        if not ensure_sheets():
+            return 0
+        with self.sync_lock:
+            with self._exclusive():
+                self._load_if_changed()
+                live_base = self.live_base
+                names = list(self.names)
+                projects = list(self.projects)
+                archived = {name: np.asarray(self.data[name][:live_base]) for name in self.COLUMNS}
+                if rebuild or (self.meta_mtime is None and attendance_partitions):
+                    partition_values = self._read_partitions()
+                    names, projects = [], []
+                    archived = self._parse(partition_values, names, projects)
+                    live_base = len(partition_values)
+                    full = True
+                
+                start = 0 if full else self._resync_start()
+                values = sheets_call('get_values', attendance_sheet.get_values, f"A{start + 2}:F")
+                if start + len(values) < self.live_rows and start > 0:
+                    # 試算表被刪列或重排，改為完整同步
+                    start = 0
+                    values = sheets_call('get_values', attendance_sheet.get_values, 'A2:F')
+                
+                if live_base + start == 0:
+                    # 完全重建時字典也重建，移除已不存在的姓名
+                    names, projects = [], []
+                parsed = self._parse(values, names, projects)
+                kept = slice(self.live_base, self.live_base + start)
+                data = {name: np.concatenate([archived[name], np.asarray(self.data[name][kept]), parsed[name]])
+                        for name in self.COLUMNS}
+                self._save(data, names, projects, live_base)
+                self._load_if_changed()
+            log.info("✅ 出勤封存同步: 讀取 %d 列，共 %d 列", len(values), self.synced_rows)
+            return len(values)
+    
+    def roll_over(self, moved_values, live_values):
+        """主表的列移到分區後，把移出的列併入歷史部分，主表部分換成移出後的主表內容"""
+        with self.sync_lock:
+            with self._exclusive():
+                self._load_if_changed()
+                names = list(self.names)
+                projects = list(self.projects)
+                moved = self._parse(moved_values, names, projects)
+                live = self._parse(live_values, names, projects)
+                data = {name: np.concatenate([np.asarray(self.data[name][:self.live_base]), moved[name], live[name]])
+                        for name in self.COLUMNS}
+                self._save(data, names, projects, self.live_base + len(moved_values))
+                self._load_if_changed()
+    
+    def _range_rows(self, first_day, last_day):
+        """日期範圍內的列位置（二分搜尋），None 表示不限"""
+        self._load_if_changed()
+        low = int(np.searchsorted(self.sorted_dates, first_day.toordinal() if first_day else 1, side='left'))
+        high = (int(np.searchsorted(self.sorted_dates, last_day.toordinal(), side='right'))
+                if last_day else len(self.sorted_dates))
+        return np.asarray(self.order[low:high])
+    
+    def rows_between(self, first_day=None, last_day=None):
+        """日期範圍內的列，回傳 [(民國日期, 姓名, 簽到, 離場, 天數或 None, 專案或 None)]"""
+        rows = self._range_rows(first_day, last_day)
+        result = []
+        for row in rows:
+            name = self.names[int(self.data['name_id'][row])]
+            if not name:
+                continue
+            days = float(self.data['days'][row])
+            project_id = int(self.data['project_id'][row])
+            result.append((
+                to_minguo_str(date.fromordinal(int(self.data['date_ord'][row]))),
+                name,
+                format_minutes(int(self.data['sign_in'][row])),
+                format_minutes(int(self.data['checkout'][row])),
+                None if np.isnan(days) else days,
+                self.projects[project_id] if project_id >= 0 else None,
+            ))
+        return result
+    
+    def totals_by_person(self, first_day, last_day):
+        """日期範圍內每人出勤天數總計，回傳 [(姓名, 天數)] 依姓名排序"""
+        rows = self._range_rows(first_day, last_day)
+        if not len(rows):
+            return []
+        name_ids = np.asarray(self.data['name_id'])[rows]
+        days = np.nan_to_num(np.asarray(self.data['days'])[rows])
+        totals = np.bincount(name_ids, weights=days, minlength=len(self.names))
+        present = np.unique(name_ids)
+        return sorted((self.names[i], float(totals[i])) for i in present if self.names[i])
+    
+    def daily_max_by_person(self, first_day, last_day):
+        """日期範圍內每天每人的最高出勤天數，回傳 [(民國日期, 姓名, 天數)]"""
+        rows = self._range_rows(first_day, last_day)
+        days = np.asarray(self.data['days'])[rows]
+        valid = ~np.isnan(days)
+        frame = pd.DataFrame({
+            'date_ord': np.asarray(self.data['date_ord'])[rows][valid],
+            'name_id': np.asarray(self.data['name_id'])[rows][valid],
+            'days': days[valid],
+        })
+        summary = frame.groupby(['date_ord', 'name_id'])['days'].max()
+        return [
+            (to_minguo_str(date.fromordinal(int(date_ord))), self.names[name_id], float(max_days))
+            for (date_ord, name_id), max_days in summary.items()
+            if self.names[name_id]
+        ]
+    
+    def totals_by_period(self):
+        """全部歷史依薪資週期與人員加總，回傳 {(週期起日 ISO, 姓名): 天數}"""
+        self._load_if_changed()
+        date_ords = np.asarray(self.data['date_ord'])
+        valid = date_ords > 0
+        unique_ords, inverse = np.unique(date_ords[valid], return_inverse=True)
+        period_starts = np.array([get_pay_period(date.fromordinal(int(o)))[0].toordinal() for o in unique_ords],
+                                 dtype=np.int32)
+        frame = pd.DataFrame({
+            'period': period_starts[inverse] if len(unique_ords) else np.zeros(0, dtype=np.int32),
+            'name_id': np.asarray(self.data['name_id'])[valid],
+            'days': np.nan_to_num(np.asarray(self.data['days'])[valid]),
+        })
+        summary = frame.groupby(['period', 'name_id'])['days'].sum()
+        return {
+            (date.fromordinal(int(period)).isoformat(), self.names[name_id]): float(days)
+            for (period, name_id), days in summary.items()
+            if self.names[name_id]
+        }
+    
+    def open_rows(self):
+        """尚未離場的列，回傳 [(民國日期, 姓名, 試算表列號)]"""
+        self._load_if_changed()
+        date_ords = np.asarray(self.data['date_ord'])
+        mask = (date_ords > 0) & (np.asarray(self.data['checkout']) < 0)
+        mask[:self.live_base] = False
+        positions = np.nonzero(mask)[0]
+        name_ids = np.asarray(self.data['name_id'])[positions]
+        return [
+            (to_minguo_str(date.fromordinal(int(date_ords[position]))), self.names[name_id],
+             int(position) - self.live_base + 2)
+            for position, name_id in zip(positions, name_ids)
+            if self.names[name_id]
+        ]
+    
+    def closed_keys(self, work_date):
+        """某一天最後一列已離場的人，回傳正規化姓名的集合"""
+        work_day = minguo_to_gregorian(work_date)
+        if work_day is None:
+            return set()
+        closed = {}
+        for row in sorted(self._range_rows(work_day, work_day)):
+            name = self.names[int(self.data['name_id'][row])]
+            if name:
+                closed[normalize_staff_name(name)] = self.data['checkout'][row] >= 0
+        return {key for key, is_closed in closed.items() if is_closed}
+    
+    def rows_for_day(self, day):
+        """某一天的列，回傳 [(姓名, 簽到分鐘, 專案或 None)]"""
+        rows = self._range_rows(day, day)
+        return [
+            (self.names[int(self.data['name_id'][row])],
+             int(self.data['sign_in'][row]),
+             self.projects[int(self.data['project_id'][row])] if self.data['project_id'][row] >= 0 else None)
+            for row in sorted(rows)
+            if self.names[int(self.data['name_id'][row])]
+        ]
+
+attendance_archive = AttendanceArchive(ATTENDANCE_ARCHIVE_DIR)
+
+def rebuild_attendance_index(reset=False):
+    """以增量同步後的封存重建出勤列索引；reset 表示主表刪過列，舊索引的列號都不再保留"""
+    global attendance_index_generation
+    if not ensure_sheets():
+        return
+    
+    try:
+        generation = get_layout_value('generation')
+        attendance_archive.sync()
+        new_index = {}
+        # 同一天同一人有多列時，與舊邏輯相同取最後一列
+        for work_date, person_name, row_number in attendance_archive.open_rows():
+            new_index[attendance_index_key(work_date, person_name)] = row_number
+        
+        # outbox 中尚未送出的新增列視為開放，已排定離場的列則不再開放
+        pending_open, pending_closed = get_pending_row_keys(ATTENDANCE_SHEET_NAME)
+        for row_key in pending_closed:
+            new_index[attendance_index_key(*split_row_key(row_key))] = CLOSED_ROW
+        for row_key in pending_open:
+            new_index[attendance_index_key(*split_row_key(row_key))] = PENDING_ROW
+        
+        last_read_row = attendance_archive.live_rows + 1
+        with attendance_index_lock:
+            # 保留讀取後才 append 的列
+            newer = {} if reset else {k: v for k, v in attendance_row_index.items()
+                                      if v > last_read_row and k not in new_index}
+            attendance_row_index.clear()
+            attendance_row_index.update(new_index)
+            attendance_row_index.update(newer)
+            attendance_index_generation = generation
+        log.info("✅ 已重建出勤索引: %d 筆未離場記錄", len(new_index))
+    except Exception as e:
+        log.error("❌ 重建出勤索引失敗: %s", e)
+
+# [優化] 出勤表分區: 已結束的月份移到「出勤時數計算_YYYY-MM」，主表只留近期的列
+def rollover_attendance(today=None):
+    """把寬限期前已結束月份的列從主表移到分區工作表，回傳移出的列數
+    
+    移出期間暫停所有程序送出 outbox；outbox 還有出勤表的寫入時不移出，留給下次執行
+    """
+    if not ensure_sheets():
+        raise SheetsUnavailableError("Google Sheets 未連線")
+    today = today or date.today()
+    cutoff = (today - timedelta(days=ATTENDANCE_ROLLOVER_GRACE_DAYS)).replace(day=1).toordinal()
+    
+    flush_outbox()
+    set_layout_value('outbox_paused_until', time.time() + ROLLOVER_PAUSE_SECONDS)
+    try:
+        with outbox_flush_lock:
+            if not wait_for_outbox_claims():
+                raise RuntimeError("其他程序的 outbox 送出未完成")
+            pending = get_local_db().execute(
+                "SELECT COUNT(*) FROM sheet_outbox WHERE sheet = ?", (ATTENDANCE_SHEET_NAME,)
+            ).fetchone()[0]
+            if pending:
+                raise RuntimeError(f"outbox 還有 {pending} 筆出勤寫入")
+            
+            # 以未格式化的值讀取再原樣寫入分區，天數與時數在分區中仍是數字（SUM、樞紐分析才算得到）
+            values = sheets_call('get_values', attendance_sheet.get_values, 'A2:G',
+                                 value_render_option='UNFORMATTED_VALUE')
+            moved_rows = []  # 主表列號
+            moved_values = []  # 出勤封存用的文字列
+            live_values = []
+            by_partition = {}
+            for row_number, row in enumerate(values, start=2):
+                text_row = [str(value) for value in row]
+                work_day = minguo_to_gregorian(text_row[0]) if row else None
+                if work_day and work_day.toordinal() < cutoff:
+                    moved_rows.append(row_number)
+                    moved_values.append(text_row)
+                    by_partition.setdefault(attendance_partition_title(work_day), []).append(row)
+                else:
+                    live_values.append(text_row)
+            if not moved_rows:
+                log.info("ℹ️ 出勤表沒有需要移出的月份")
+                return 0
             
+            # 先寫分區再刪主表；上次中途失敗時已寫入分區的列不重複寫
+            for title, rows in sorted(by_partition.items()):
+                partition = get_attendance_partition(title)
+                existing = {}
+                for row in sheets_call('get_values', partition.get_values, 'A2:G',
+                                       value_render_option='UNFORMATTED_VALUE'):
+                    key = tuple(str(value) for value in row)
+                    existing[key] = existing.get(key, 0) + 1
+                new_rows = []
+                for row in rows:
+                    key = tuple(str(value) for value in row)
+                    if existing.get(key):
+                        existing[key] -= 1
+                    else:
+                        new_rows.append(row)
+                if new_rows:
+                    sheets_write_bucket.acquire()
+                    sheets_call('append_rows', partition.append_rows, new_rows)
+                log.info("📦 %s: 移入 %d 列", title, len(new_rows))
+            
+            # 連續的列合併成一個刪除範圍，由下往上刪，前面的列號不受影響
+            runs = []
+            for row_number in moved_rows:
+                if runs and runs[-1][1] == row_number - 1:
+                    runs[-1][1] = row_number
+                else:
+                    runs.append([row_number, row_number])
+            # 刪列與修正列號不是同一個交易: 先記下正在刪列，中途失敗時由 recover_interrupted_rollover 依試算表現況修正
+            set_layout_value('rollover_deleting', time.time())
+            sheets_write_bucket.acquire()
+            sheets_call('batch_update', spreadsheet.batch_update, {'requests': [
+                {'deleteDimension': {'range': {'sheetId': attendance_sheet.id, 'dimension': 'ROWS',
+                                               'startIndex': first - 1, 'endIndex': last}}}
+                for first, last in reversed(runs)
+            ]})
+            remap_sheet_rows(ATTENDANCE_SHEET_NAME, moved_rows)
+            attendance_archive.roll_over(moved_values, live_values)
+            set_layout_value('rollover_deleting', 0)
+    finally:
+        set_layout_value('outbox_paused_until', 0)
+        outbox_wakeup.set()
+    
+    rebuild_attendance_index(reset=True)
+    log.info("✅ 出勤表已移出 %d 列到 %d 個分區", len(moved_rows), len(by_partition))
+    return len(moved_rows)
+
+# [優化] 出勤資料存取: 簽到、離場、範圍查詢與每日統整都經由 AttendanceRepository
+class AttendanceRepository(ABC):
+    """出勤資料存取介面，統計查詢預設由 query_range 計算
+    
+    子類別須實作標示 @abstractmethod 的讀寫方法，缺少時在建立實例就會失敗
+    出勤列以 (民國日期, 姓名, 簽到, 離場, 天數或 None, 專案或 None) 表示
+    """
+    
+    name = None
+    
+    def is_available(self, need_summary=False):
+        return True
+    
+    def warm(self):
+        """啟動時預先載入需要的狀態"""
+    
+    def refresh(self, full=False):
+        """讀取前同步外部資料，本機後端不需要"""
+    
+    @abstractmethod
+    def append_sign_ins(self, work_date, project_name, people, sign_in_time):
+        """寫入多人簽到記錄，people 為 [{'name': ..., 'note': ...}, ...]"""
+    
+    @abstractmethod
+    def record_checkouts(self, work_date, checkouts):
+        """寫入離場，checkouts 為 [(姓名, 離場時間, 天數, 備註), ...]
+        
+        回傳 (已更新姓名, 先前已離場的姓名, 找不到簽到列的姓名)
+        """
+    
+    @abstractmethod
+    def append_rows(self, rows):
+        """直接寫入完整的出勤列（補登用），rows 為試算表格式 [日期, 姓名, 簽到, 離場, 天數, 備註, 更新時間]"""
+    
+    @abstractmethod
+    def query_range(self, first_day=None, last_day=None):
+        """日期範圍內（含頭尾）的出勤列，None 表示不限"""
+    
+    @abstractmethod
+    def summary_rows(self):
+        """每日統整的全部列 [(民國日期, 姓名, 天數, 統計時間)]"""
+    
+    @abstractmethod
+    def write_daily_summary(self, rows):
+        """新增每日統整列 [[民國日期, 姓名, 天數, 統計時間], ...]"""
+    
+    def summarized_pairs(self):
+        return {(row[0], row[1]) for row in self.summary_rows()}
+    
+    def daily_max_by_person(self, first_day, last_day):
+        """日期範圍內每天每人的最高出勤天數，回傳 [(民國日期, 姓名, 天數)]"""
+        best = {}
+        for work_date, person_name, _, _, days, _ in self.query_range(first_day, last_day):
+            if days is None:
+                continue
+            key = (work_date, person_name)
+            if key not in best or days > best[key]:
+                best[key] = days
+        return sorted((work_date, person_name, days) for (work_date, person_name), days in best.items())
+    
+    def totals_by_period(self):
+        """全部歷史依薪資週期與人員加總，回傳 {(週期起日 ISO, 姓名): 天數}"""
+        totals = {}
+        for work_date, person_name, _, _, days, _ in self.query_range():
+            work_day = minguo_to_gregorian(work_date)
+            if work_day is None:
+                continue
+            key = (get_pay_period(work_day)[0].isoformat(), person_name)
+            totals[key] = totals.get(key, 0.0) + (days or 0.0)
+        return totals
+    
+    def iter_range(self, first_day, last_day, chunk_days=EXPORT_CHUNK_DAYS):
+        """依日期分段產生 query_range 的列（日期遞增），每次只載入 chunk_days 天"""
+        day = first_day
+        while day <= last_day:
+            chunk_end = min(day + timedelta(days=chunk_days - 1), last_day)
+            yield from self.query_range(day, chunk_end)
+            day = chunk_end + timedelta(days=1)
+    
+    def rows_for_day(self, day):
+        """某一天的列，回傳 [(姓名, 簽到分鐘, 專案或 None)]"""
+        return [(person_name, parse_hhmm_minutes(sign_in), project_name)
+                for _, person_name, sign_in, _, _, project_name in self.query_range(day, day)]
+
+class SheetsAttendanceRepository(AttendanceRepository):
+    """以 Google 試算表為主: 寫入經由 outbox，讀取經由出勤封存"""
+    
+    name = 'sheets'
+    
+    def is_available(self, need_summary=False):
+        if need_summary:
+            return ensure_sheets() and summary_sheet is not None
+        # 寫入先存進 outbox，連線中斷時等背景重新連線後再送出
+        return ensure_sheets() or sheets_configured()
+    
+    def warm(self):
+        rebuild_attendance_index()
+    
+    def refresh(self, full=False):
+        attendance_archive.sync(full=full)
+    
+    def append_sign_ins(self, work_date, project_name, people, sign_in_time):
+        update_time = now_taipei_str()
+        enqueue_sheet_ops([
+            (ATTENDANCE_SHEET_NAME, 'append', make_row_key(work_date, person['name']), None, None,
+             build_sign_in_row(work_date, project_name, person['name'], sign_in_time,
+                               person['note'], update_time))
+            for person in people
+        ])
+        with attendance_index_lock:
+            for person in people:
+                attendance_row_index[attendance_index_key(work_date, person['name'])] = PENDING_ROW
+        return True
+    
+    def record_checkouts(self, work_date, checkouts):
+        """依出勤列索引排入 D:F 更新；已離場的人不再更新，索引與封存都沒有的姓名才重建一次索引"""
+        if attendance_index_generation not in (None, get_layout_value('generation')):
+            # 其他程序已把舊月份移出主表，索引的列號都要重算
+            rebuild_attendance_index(reset=True)
+        with attendance_index_lock:
+            missing = {attendance_index_key(work_date, name)[1] for name, *_ in checkouts
+                       if attendance_index_key(work_date, name) not in attendance_row_index}
+        closed_keys = attendance_archive.closed_keys(work_date) if missing else set()
+        if missing - closed_keys:
+            # 其他程序寫入的列不在本地索引中，重建一次再查
+            rebuild_attendance_index()
+            closed_keys = attendance_archive.closed_keys(work_date)
+        
+        ops = []
+        updated_names = []
+        closed_names = []
+        failed_names = []
+        with attendance_index_lock:
+            for person_name, checkout_time, days, remark in checkouts:
+                index_key = attendance_index_key(work_date, person_name)
+                target_row = attendance_row_index.get(index_key)
+                if target_row == CLOSED_ROW or (target_row is None and index_key[1] in closed_keys):
+                    closed_names.append(person_name)
+                    continue
+                if not target_row:
+                    failed_names.append(person_name)
+                    continue
+                ops.append((ATTENDANCE_SHEET_NAME, 'update', make_row_key(work_date, person_name),
+                            target_row if target_row > 0 else None, 'D:F',
+                            [checkout_time.strftime('%H:%M'), days, remark]))
+                updated_names.append(person_name)
+        
+        if ops:
+            enqueue_sheet_ops(ops)
+            with attendance_index_lock:
+                for person_name in updated_names:
+                    attendance_row_index[attendance_index_key(work_date, person_name)] = CLOSED_ROW
+        return updated_names, closed_names, failed_names
+    
+    def append_rows(self, rows):
+        """不經 outbox，一次 append_rows 寫入；失敗直接丟出讓呼叫端重試"""
+        if not ensure_sheets():
+            raise SheetsUnavailableError("Google Sheets 未連線")
+        sheets_write_bucket.acquire()
+        sheets_call('append_rows', attendance_sheet.append_rows, rows)
+    
+    def query_range(self, first_day=None, last_day=None):
+        return attendance_archive.rows_between(first_day, last_day)
+    
+    def daily_max_by_person(self, first_day, last_day):
+        return attendance_archive.daily_max_by_person(first_day, last_day)
+    
+    def totals_by_period(self):
+        """封存的總計加上 outbox 中尚未送出的離場"""
+        totals = attendance_archive.totals_by_period()
+        pending = get_local_db().execute(
+            "SELECT row_key, payload FROM sheet_outbox WHERE sheet = ? AND kind = 'update'",
+            (ATTENDANCE_SHEET_NAME,)
+        ).fetchall()
+        for row_key, payload in pending:
+            work_date, person_name = split_row_key(row_key)
+            work_day = minguo_to_gregorian(work_date)
+            if work_day is None:
+                continue
+            key = (get_pay_period(work_day)[0].isoformat(), person_name)
+            totals[key] = totals.get(key, 0.0) + float(json.loads(payload)[1])
+        return totals
+    
+    def rows_for_day(self, day):
+        return attendance_archive.rows_for_day(day)
+    
+    def summary_rows(self):
+        values = sheets_call('get_values', summary_sheet.get_values, 'A2:D')
+        return [tuple((list(row) + [""] * 4)[:4]) for row in values if len(row) >= 2]
+    
+    def summarized_pairs(self):
+        """每日統整表加上 outbox 中尚未送出的統整列，送出失敗時下一次統整不會重複寫入"""
+        pairs = super().summarized_pairs()
+        pending = get_local_db().execute(
+            "SELECT payload FROM sheet_outbox WHERE sheet = ? AND kind = 'append'", (DAILY_SUMMARY_SHEET,)
+        ).fetchall()
+        for (payload,) in pending:
+            row = json.loads(payload)
+            pairs.add((row[0], row[1]))
+        return pairs
+    
+    def write_daily_summary(self, rows):
+        enqueue_sheet_ops([
+            (DAILY_SUMMARY_SHEET, 'append', None, None, None, list(row))
+            for row in rows
+        ])
+
+def parse_summary_days(value):
+    try:
+        return float(value) if value != "" else None
+    except (TypeError, ValueError):
+        return None
+
+class SQLiteAttendanceRepository(AttendanceRepository):
+    """出勤資料存在本機 SQLite (WAL)，多個程序共用"""
+    
+    name = 'sqlite'
+    
+    def __init__(self):
+        get_local_db().executescript("""
+            CREATE TABLE IF NOT EXISTS attendance (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                work_date TEXT NOT NULL,
+                work_ord INTEGER NOT NULL,
+                person_name TEXT NOT NULL,
+                sign_in TEXT NOT NULL DEFAULT '',
+                checkout TEXT NOT NULL DEFAULT '',
+                days REAL,
+                note TEXT NOT NULL DEFAULT '',
+                updated TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS attendance_by_ord ON attendance (work_ord);
+            CREATE INDEX IF NOT EXISTS attendance_by_person ON attendance (work_date, person_name);
+            CREATE TABLE IF NOT EXISTS attendance_summary (
+                work_date TEXT NOT NULL,
+                person_name TEXT NOT NULL,
+                days REAL,
+                updated TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (work_date, person_name)
+            );
+        """)
+    
+    @staticmethod
+    def _work_ord(work_date):
+        work_day = minguo_to_gregorian(work_date)
+        return work_day.toordinal() if work_day else 0
+    
+    def is_empty(self):
+        return get_local_db().execute("SELECT 1 FROM attendance LIMIT 1").fetchone() is None
+    
+    def append_sign_ins(self, work_date, project_name, people, sign_in_time):
+        update_time = now_taipei_str()
+        work_ord = self._work_ord(work_date)
+        rows = []
+        for person in people:
+            row = build_sign_in_row(work_date, project_name, person['name'], sign_in_time,
+                                    person['note'], update_time)
+            rows.append((work_date, work_ord, row[1], row[2], row[5], row[6]))
+        get_local_db().executemany(
+            "INSERT INTO attendance (work_date, work_ord, person_name, sign_in, note, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        return True
+    
+    def record_checkouts(self, work_date, checkouts):
+        """更新同一天同一人最後一筆尚未離場的列"""
+        update_time = now_taipei_str()
+        updated_names = []
+        closed_names = []
+        failed_names = []
+        conn = get_local_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for person_name, checkout_time, days, remark in checkouts:
+                cursor = conn.execute(
+                    "UPDATE attendance SET checkout = ?, days = ?, note = ?, updated = ? WHERE id = ("
+                    "SELECT id FROM attendance WHERE work_date = ? AND person_name = ? AND checkout = '' "
+                    "ORDER BY id DESC LIMIT 1)",
+                    (checkout_time.strftime('%H:%M'), days, remark, update_time, work_date, person_name)
+                )
+                if cursor.rowcount:
+                    updated_names.append(person_name)
+                elif conn.execute("SELECT 1 FROM attendance WHERE work_date = ? AND person_name = ? LIMIT 1",
+                                  (work_date, person_name)).fetchone():
+                    closed_names.append(person_name)
+                else:
+                    failed_names.append(person_name)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return updated_names, closed_names, failed_names
+    
+    def append_rows(self, rows):
+        conn = get_local_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                "INSERT INTO attendance (work_date, work_ord, person_name, sign_in, checkout, days, note, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(work_date, self._work_ord(work_date), person_name, sign_in, checkout,
+                  parse_summary_days(days), note, updated)
+                 for work_date, person_name, sign_in, checkout, days, note, updated in rows]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def query_range(self, first_day=None, last_day=None):
+        rows = get_local_db().execute(
+            "SELECT work_date, person_name, sign_in, checkout, days, note FROM attendance "
+            "WHERE work_ord BETWEEN ? AND ? ORDER BY work_ord, id",
+            (first_day.toordinal() if first_day else 1, last_day.toordinal() if last_day else date.max.toordinal())
+        ).fetchall()
+        return [(work_date, person_name, sign_in, checkout, days, note_project(note))
+                for work_date, person_name, sign_in, checkout, days, note in rows]
+    
+    def summary_rows(self):
+        return get_local_db().execute(
+            "SELECT work_date, person_name, days, updated FROM attendance_summary ORDER BY rowid"
+        ).fetchall()
+    
+    def write_daily_summary(self, rows):
+        get_local_db().executemany(
+            "INSERT OR REPLACE INTO attendance_summary (work_date, person_name, days, updated) VALUES (?, ?, ?, ?)",
+            [tuple(row) for row in rows]
+        )
+    
+    def import_rows(self, rows, summary_rows=()):
+        """匯入既有資料（出勤列格式與 query_range 相同）"""
+        conn = get_local_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                "INSERT INTO attendance (work_date, work_ord, person_name, sign_in, checkout, days, note) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(work_date, self._work_ord(work_date), person_name, sign_in, checkout, days,
+                  f"{PROJECT_NOTE_PREFIX}{project_name}" if project_name else "")
+                 for work_date, person_name, sign_in, checkout, days, project_name in rows]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO attendance_summary (work_date, person_name, days, updated) VALUES (?, ?, ?, ?)",
+                [(work_date, person_name, parse_summary_days(days), updated)
+                 for work_date, person_name, days, updated in summary_rows]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+class InMemoryAttendanceRepository(AttendanceRepository):
+    """出勤資料只存在記憶體，供測試與單次執行使用"""
+    
+    name = 'memory'
+    
+    def __init__(self):
+        self.rows = []  # [民國日期, 日期序數, 姓名, 簽到, 離場, 天數, 備註]
+        self.summary = {}  # (民國日期, 姓名) -> (天數, 統計時間)
+        self.lock = threading.Lock()
+    
+    def append_sign_ins(self, work_date, project_name, people, sign_in_time):
+        work_day = minguo_to_gregorian(work_date)
+        work_ord = work_day.toordinal() if work_day else 0
+        with self.lock:
+            for person in people:
+                row = build_sign_in_row(work_date, project_name, person['name'], sign_in_time, person['note'], "")
+                self.rows.append([work_date, work_ord, row[1], row[2], "", None, row[5]])
+        return True
+    
+    def record_checkouts(self, work_date, checkouts):
+        updated_names = []
+        closed_names = []
+        failed_names = []
+        with self.lock:
+            for person_name, checkout_time, days, remark in checkouts:
+                rows = [r for r in self.rows if r[0] == work_date and r[2] == person_name]
+                row = next((r for r in reversed(rows) if not r[4]), None)
+                if row is None:
+                    (closed_names if rows else failed_names).append(person_name)
+                    continue
+                row[4:7] = [checkout_time.strftime('%H:%M'), days, remark]
+                updated_names.append(person_name)
+        return updated_names, closed_names, failed_names
+    
+    def append_rows(self, rows):
+        with self.lock:
+            for work_date, person_name, sign_in, checkout, days, note, _ in rows:
+                work_day = minguo_to_gregorian(work_date)
+                self.rows.append([work_date, work_day.toordinal() if work_day else 0, person_name,
+                                  sign_in, checkout, parse_summary_days(days), note])
+    
+    def query_range(self, first_day=None, last_day=None):
+        low = first_day.toordinal() if first_day else 1
+        high = last_day.toordinal() if last_day else date.max.toordinal()
+        with self.lock:
+            rows = sorted((r for r in self.rows if low <= r[1] <= high), key=lambda r: r[1])
+            return [(r[0], r[2], r[3], r[4], r[5], note_project(r[6])) for r in rows]
+    
+    def summary_rows(self):
+        with self.lock:
+            return [(work_date, person_name, days, updated)
+                    for (work_date, person_name), (days, updated) in self.summary.items()]
+    
+    def write_daily_summary(self, rows):
+        with self.lock:
+            for work_date, person_name, days, updated in rows:
+                self.summary[(work_date, person_name)] = (days, updated)
+
+class MirroredAttendanceRepository(AttendanceRepository):
+    """本機 SQLite 負責所有讀寫，寫入後同步到試算表（試算表經由 outbox 非同步送出）"""
+    
+    name = 'mirror'
+    
+    def __init__(self, primary, replica):
+        self.primary = primary
+        self.replica = replica
+    
+    def warm(self):
+        if not self.replica.is_available():
+            return
+        if self.primary.is_empty():
+            # 第一次啟用時由試算表匯入既有歷史
+            self.replica.refresh(full=True)
+            rows = self.replica.query_range()
+            summary_rows = self.replica.summary_rows() if self.replica.is_available(need_summary=True) else []
+            self.primary.import_rows(rows, summary_rows)
+            log.info("✅ 已由試算表匯入 %d 列出勤、%d 列統整", len(rows), len(summary_rows))
+        self.replica.warm()
+    
+    def _replicate(self, method, *args):
+        """同步失敗只記錄，本機資料為準"""
+        if not self.replica.is_available(need_summary=(method == 'write_daily_summary')):
+            return
+        try:
+            getattr(self.replica, method)(*args)
         except Exception as e:
-            print(f"❌ 清理失敗: {e}")
+            log.warning("⚠️ 試算表同步失敗 (%s): %s", method, e)
+    
+    def append_sign_ins(self, work_date, project_name, people, sign_in_time):
+        if not self.primary.append_sign_ins(work_date, project_name, people, sign_in_time):
+            return False
+        self._replicate('append_sign_ins', work_date, project_name, people, sign_in_time)
+        return True
+    
+    def record_checkouts(self, work_date, checkouts):
+        updated_names, closed_names, failed_names = self.primary.record_checkouts(work_date, checkouts)
+        if updated_names:
+            updated = set(updated_names)
+            self._replicate('record_checkouts', work_date, [c for c in checkouts if c[0] in updated])
+        return updated_names, closed_names, failed_names
+    
+    def append_rows(self, rows):
+        self.primary.append_rows(rows)
+        self._replicate('append_rows', rows)
+    
+    def query_range(self, first_day=None, last_day=None):
+        return self.primary.query_range(first_day, last_day)
+    
+    def summary_rows(self):
+        return self.primary.summary_rows()
+    
+    def write_daily_summary(self, rows):
+        self.primary.write_daily_summary(rows)
+        self._replicate('write_daily_summary', rows)
+
+if ATTENDANCE_BACKEND == 'sqlite':
+    attendance_repo = SQLiteAttendanceRepository()
+elif ATTENDANCE_BACKEND == 'memory':
+    attendance_repo = InMemoryAttendanceRepository()
+elif ATTENDANCE_BACKEND == 'mirror':
+    attendance_repo = MirroredAttendanceRepository(SQLiteAttendanceRepository(), SheetsAttendanceRepository())
+else:
+    attendance_repo = SheetsAttendanceRepository()
+
+# [優化] 主動垃圾回收
+@app.after_request
+def after_request(response):
+    """每次請求後強制垃圾回收"""
+    started = time.perf_counter()
+    gc.collect()
+    gc_collect_seconds.observe(time.perf_counter() - started)
+    return response
+
+def parse_session_date(work_date):
+    """Session 日期轉 date，支援西元與民國年格式"""
+    try:
+        return datetime.datetime.strptime(work_date, '%Y/%m/%d').date()
+    except ValueError:
+        return minguo_to_gregorian(work_date)
+
+# [優化] 清理過期資源
+def cleanup_old_sessions():
+    """清理過期的 Session"""
+    try:
+        current_time = time.time()
+        cutoff_date = date.today() - timedelta(days=SESSION_EXPIRE_DAYS)
+        
+        # 清理過期 Session
+        sessions = session_store.find()
+        expired = []
+        remaining = []
+        for session in sessions:
+            session_date = parse_session_date(session.work_date)
+            if session_date and session_date < cutoff_date:
+                expired.append(session)
+            else:
+                remaining.append(session)
+        
+        # 限制 Session 數量
+        if len(remaining) > MAX_SESSIONS:
+            remaining.sort(key=lambda s: s.created_time)
+            expired.extend(remaining[:len(remaining) - MAX_SESSIONS])
+        
+        session_store.remove(expired)
+        
+        # 清理過期的 outbox 列號對照
+        get_local_db().execute(
+            "DELETE FROM sheet_row_map WHERE created < ?",
+            (current_time - SESSION_EXPIRE_DAYS * 86400,)
+        )
+        # 清理舊的排程執行記錄
+        get_local_db().execute(
+            "DELETE FROM job_runs WHERE started < ?",
+            (current_time - JOB_HISTORY_DAYS * 86400,)
+        )
+        
+        log.info("🧹 清理完成: 移除 %d 個過期 Session", len(expired))
+        log.info("📊 當前 Session 數: %d", session_store.count())
+        
+        # 強制垃圾回收
+        gc.collect()
+        return len(expired)
+        
+    except Exception as e:
+        log.error("❌ 清理失敗: %s", e)
+        raise
 
 def keep_alive():
     """防止服務休眠"""
@@ -156,187 +2093,737 @@ def keep_alive():
             render_url = os.environ.get('RENDER_URL', 'https://my-bot-project-1.onrender.com')
             try:
                 urllib.request.urlopen(f"{render_url}/health", timeout=5)
-                print("[KEEPALIVE] ✅ 防止休眠")
+                log.info("[KEEPALIVE] ✅ 防止休眠")
             except:
-                print("[KEEPALIVE] ⚠️ Ping 失敗")
+                log.warning("[KEEPALIVE] ⚠️ Ping 失敗")
         except Exception as e:
-            print(f"[KEEPALIVE] ❌ {e}")
+            log.error("[KEEPALIVE] ❌ %s", e)
+
+keep_alive_thread = threading.Thread(target=keep_alive, daemon=True, name='keep-alive')
 
-keep_alive_thread = threading.Thread(target=keep_alive, daemon=True)
-keep_alive_thread.start()
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Prometheus 指標"""
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @app.route("/health", methods=['GET'])
 def health_check():
     """健康檢查端點"""
     return json.dumps({
         'status': 'ok',
-        'sessions': len(session_states),
+        'sessions': session_store.count(),
+        'queue_depth': get_event_queue_depth(),
+        'outbox_pending': get_outbox_size(),
+        'outbox_dead': get_outbox_dead_size(),
+        'sheets': ('breaker_open' if sheets_breaker.is_open()
+                   else 'connected' if attendance_sheet is not None else 'disconnected'),
+        'scheduler_leader': scheduler_leader.is_leader(),
+        'jobs': get_job_status(),
         'memory_info': f'{gc.get_count()}'
     }), 200, {'Content-Type': 'application/json'}
 
-def is_duplicate_message(user_id, message_text, timestamp):
-    """檢查重複訊息"""
-    msg_hash = hashlib.md5(f"{user_id}{message_text}{timestamp}".encode()).hexdigest()
-    current_time = time.time()
+class TimeBucketedDedup:
+    """以每秒一格的環狀桶記錄已處理的事件 id
     
-    # 清理過期訊息記錄
-    to_delete = [k for k, v in processed_messages.items() if current_time - v > DUPLICATE_CHECK_WINDOW]
-    for k in to_delete:
-        del processed_messages[k]
+    每一格只在時間經過時被清空一次，每個 id 也只被刪除一次，過期成本為攤銷 O(1)
+    秒數取自 time.monotonic()，系統時間回撥不影響；傳入的 now 若比之前小，記到最新的一格
+    """
     
-    if msg_hash in processed_messages:
-        return True
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self.buckets = [[-1, []] for _ in range(window_seconds)]  # [秒, 該秒的 id]
+        self.seen = {}  # event_id -> 記錄的秒數
+        self.last_second = None
+        self.lock = threading.Lock()
+    
+    def _expire(self, now_second):
+        """清空經過的格子，回傳記錄用的秒數（不早於已見過的最新秒數）"""
+        if self.last_second is None:
+            self.last_second = now_second
+            return now_second
+        steps = min(now_second - self.last_second, self.window)
+        for second in range(now_second - steps + 1, now_second + 1):
+            bucket = self.buckets[second % self.window]
+            for event_id in bucket[1]:
+                if self.seen.get(event_id) == bucket[0]:
+                    del self.seen[event_id]
+            bucket[0] = second
+            bucket[1] = []
+        # 時間倒退時不能記到已被清空過的舊格子，否則該 id 永遠不會過期
+        self.last_second = max(self.last_second, now_second)
+        return self.last_second
+    
+    def _record(self, event_id, now_second):
+        bucket = self.buckets[now_second % self.window]
+        if bucket[0] != now_second:
+            bucket[0] = now_second
+            bucket[1] = []
+        bucket[1].append(event_id)
+        self.seen[event_id] = now_second
+    
+    def add(self, event_id, now=None):
+        """只記錄，不檢查"""
+        now_second = int(now if now is not None else time.monotonic())
+        with self.lock:
+            now_second = self._expire(now_second)
+            self._record(event_id, now_second)
+    
+    def check_and_add(self, event_id, now=None):
+        """已在時間窗內看過則回傳 True，否則記錄並回傳 False"""
+        now_second = int(now if now is not None else time.monotonic())
+        with self.lock:
+            now_second = self._expire(now_second)
+            if event_id in self.seen:
+                return True
+            self._record(event_id, now_second)
+            return False
+    
+    def size(self):
+        return len(self.seen)
+
+class SQLiteDedup:
+    """以本機 SQLite 記錄已處理的事件 id，多個 worker 共用"""
+    
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self.last_purge = 0
+        get_local_db().executescript("""
+            CREATE TABLE IF NOT EXISTS processed_events (
+                event_id TEXT PRIMARY KEY,
+                seen_at INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_processed_events_seen ON processed_events (seen_at);
+        """)
+    
+    def _purge(self, now_second):
+        # 每秒最多清一次，靠 seen_at 索引只碰到過期的列
+        if now_second != self.last_purge:
+            self.last_purge = now_second
+            get_local_db().execute("DELETE FROM processed_events WHERE seen_at < ?",
+                                   (now_second - self.window,))
     
-    processed_messages[msg_hash] = current_time
+    def add(self, event_id, now=None):
+        now_second = int(now if now is not None else time.time())
+        self._purge(now_second)
+        get_local_db().execute("INSERT OR REPLACE INTO processed_events (event_id, seen_at) VALUES (?, ?)",
+                               (event_id, now_second))
+    
+    def check_and_add(self, event_id, now=None):
+        now_second = int(now if now is not None else time.time())
+        self._purge(now_second)
+        cursor = get_local_db().execute(
+            "INSERT INTO processed_events (event_id, seen_at) VALUES (?, ?) "
+            "ON CONFLICT(event_id) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_at < ?",
+            (event_id, now_second, now_second - self.window)
+        )
+        return cursor.rowcount == 0
+    
+    def size(self):
+        return get_local_db().execute("SELECT COUNT(*) FROM processed_events").fetchone()[0]
+
+if DEDUP_BACKEND == 'sqlite':
+    dedup_store = SQLiteDedup(DUPLICATE_CHECK_WINDOW)
+else:
+    dedup_store = TimeBucketedDedup(DUPLICATE_CHECK_WINDOW)
+
+def is_duplicate_message(event):
+    """檢查重複事件，以 LINE 的 webhookEventId 為鍵"""
+    event_id = getattr(event, 'webhook_event_id', None)
+    if not event_id:
+        # 舊格式沒有 webhookEventId，退回以內容雜湊判斷
+        event_id = hashlib.md5(
+            f"{event.source.user_id}{event.message.text}{event.timestamp}".encode()
+        ).hexdigest()
+        return dedup_store.check_and_add(event_id)
+    
+    # 佇列滿時 webhook 回 503，LINE 重送的事件可能比同一 webhook 中已排入的第一次送達先處理，
+    # 所以第一次送達也要檢查
+    return dedup_store.check_and_add(event_id)
+
+# [優化] 權限檢查
+def get_user_role(user_id):
+    """取得用戶權限等級"""
+    if user_id in ADMIN_USER_IDS:
+        return "ADMIN"
+    elif user_id in MANAGER_USER_IDS:
+        return "MANAGER"
+    return None
+
+def can_access_session(user_id, session):
+    """檢查用戶是否有權限存取 Session"""
+    role = get_user_role(user_id)
+    if role == "ADMIN":
+        return True
+    elif role == "MANAGER":
+        return session.is_authorized(user_id)
     return False
 
-# [優化] 權限檢查
-def get_user_role(user_id):
-    """取得用戶權限等級"""
-    if user_id in ADMIN_USER_IDS:
-        return "ADMIN"
-    elif user_id in MANAGER_USER_IDS:
-        return "MANAGER"
-    return None
+# 出勤寫入函式（經由 attendance_repo）
+def now_taipei_str():
+    return datetime.datetime.now(
+        datetime.timezone(datetime.timedelta(hours=8))
+    ).strftime('%Y-%m-%d %H:%M:%S')
+
+def build_sign_in_row(work_date, project_name, person_name, sign_in_time, note, update_time):
+    return [
+        work_date,
+        person_name,
+        sign_in_time.strftime('%H:%M') if sign_in_time else "",
+        "",
+        "",
+        build_attendance_note(project_name, note),
+        update_time
+    ]
+
+def write_person_to_sheet(work_date, project_name, person_name, sign_in_time, note=""):
+    """寫入簽到記錄"""
+    return write_people_to_sheet(
+        work_date, project_name, [{"name": person_name, "note": note}], sign_in_time
+    )
+
+def write_people_to_sheet(work_date, project_name, people, sign_in_time):
+    """寫入多人簽到記錄（試算表後端由 outbox 合併成一次 append_rows）
+    
+    people 為 [{'name': ..., 'note': ...}, ...]
+    """
+    if not attendance_repo.is_available() or not people:
+        return False
+    
+    try:
+        if not attendance_repo.append_sign_ins(work_date, project_name, people, sign_in_time):
+            return False
+        add_period_deltas([(work_date, person['name'], 0.0) for person in people])
+        log.debug("✅ 已排入 %d 人的簽到記錄", len(people))
+        return True
+    except Exception as e:
+        log.error("❌ 寫入失敗: %s", e)
+        return False
+
+def calculate_attendance_days(sign_in_time, checkout_time):
+    """依簽到與離場時間計算出勤天數與備註"""
+    checkout_hour = checkout_time.hour
+    sign_in_hour = sign_in_time.hour
+    
+    # 計算出勤天數
+    if sign_in_hour < 10:
+        days = 1.0
+        remark = ""
+    elif sign_in_hour < 13:
+        days = 1.0
+        remark = ""
+    else:
+        days = 0.5
+        remark = "下午簽到"
+    
+    # 16:00 前早退
+    if checkout_hour < 16:
+        days = 0.5
+        remark = f"早退({checkout_time.strftime('%H:%M')})"
+    # 17:00 後加班
+    elif checkout_hour >= 17:
+        remark = (remark + " " if remark else "") + "加班"
+    
+    return days, remark.strip()
+
+def update_person_checkout(work_date, person_name, checkout_time, sign_in_time, project_name=None, note=None):
+    """更新離場時間和出勤天數；備註欄保留專案與簽到時的備註"""
+    if not attendance_repo.is_available():
+        return False
+    
+    try:
+        days, remark = calculate_attendance_days(sign_in_time, checkout_time)
+        token = begin_period_update()
+        updated_names = []
+        try:
+            updated_names, _, _ = attendance_repo.record_checkouts(
+                work_date, [(person_name, checkout_time, days, build_attendance_note(project_name, note, remark))]
+            )
+        finally:
+            add_period_deltas([(work_date, person_name, days)] if updated_names else [], token)
+        if updated_names:
+            log.debug("✅ 已排入 %s 的離場記錄: %s 天", person_name, days)
+            return True
+        return False
+    except Exception as e:
+        log.error("❌ 更新失敗: %s", e)
+        return False
+
+def bulk_update_checkout(work_date, people, checkout_time, project_name=None):
+    """整批離場: 試算表後端最多一次讀取，由 outbox 合併成一次 batch_update
+    
+    people 為 StaffRecord 列表
+    回傳 (已更新姓名, 先前已離場的姓名, 未更新姓名)
+    """
+    names = [person.name for person in people]
+    if not attendance_repo.is_available():
+        return [], [], names
+    
+    checkouts = []
+    days_by_name = {}
+    for person in people:
+        days, remark = calculate_attendance_days(person.add_time, checkout_time)
+        checkouts.append((person.name, checkout_time, days, build_attendance_note(project_name, person.note, remark)))
+        days_by_name[person.name] = days
+    
+    token = begin_period_update()
+    try:
+        updated_names, closed_names, failed_names = attendance_repo.record_checkouts(work_date, checkouts)
+    except Exception as e:
+        add_period_deltas([], token)
+        log.error("❌ 整批離場寫入失敗: %s", e)
+        return [], [], names
+    
+    add_period_deltas([(work_date, name, days_by_name[name]) for name in updated_names], token)
+    if updated_names:
+        log.debug("✅ 已排入 %d 人的離場記錄", len(updated_names))
+    return updated_names, closed_names, failed_names
+
+# [優化] 薪資週期出勤總計: 存在本機 SQLite，離場時以增量更新，查詢不必下載整張表
+def get_pay_period(day):
+    """薪資週期: 每月 6–20 日、21 日至次月 5 日，回傳 (起, 訖)"""
+    if day.day <= 5:
+        start_date = (day.replace(day=1) - timedelta(days=1)).replace(day=21)
+        end_date = day.replace(day=5)
+    elif day.day <= 20:
+        start_date = day.replace(day=6)
+        end_date = day.replace(day=20)
+    else:
+        start_date = day.replace(day=21)
+        next_month = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+        end_date = next_month.replace(day=5)
+    return start_date, end_date
+
+def init_period_totals():
+    get_local_db().executescript("""
+        CREATE TABLE IF NOT EXISTS period_totals (
+            period_start TEXT NOT NULL,
+            person_name TEXT NOT NULL,
+            days REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (period_start, person_name)
+        );
+        CREATE TABLE IF NOT EXISTS period_pending (
+            token TEXT PRIMARY KEY,
+            started REAL NOT NULL
+        );
+    """)
+
+init_period_totals()
+
+def begin_period_update():
+    """寫入離場記錄前登記，回傳 token 交給 add_period_deltas
+    
+    記錄與總計不在同一個交易: 登記中的寫入完成前 rebuild_period_totals 會等待，
+    否則重建讀到新記錄後又累加一次，天數會重複計算
+    """
+    token = uuid.uuid4().hex
+    get_local_db().execute("INSERT INTO period_pending (token, started) VALUES (?, ?)", (token, time.time()))
+    return token
+
+def add_period_deltas(deltas, token=None):
+    """累加出勤天數，deltas 為 [(民國日期, 姓名, 天數), ...]；有 token 時同一交易內解除登記"""
+    rows = []
+    for work_date, person_name, days in deltas:
+        work_day = minguo_to_gregorian(work_date)
+        if work_day is None:
+            continue
+        rows.append((get_pay_period(work_day)[0].isoformat(), person_name, days))
+    if not rows and token is None:
+        return
+    conn = get_local_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(
+            "INSERT INTO period_totals (period_start, person_name, days) VALUES (?, ?, ?) "
+            "ON CONFLICT(period_start, person_name) DO UPDATE SET days = days + excluded.days",
+            rows
+        )
+        if token is not None:
+            conn.execute("DELETE FROM period_pending WHERE token = ?", (token,))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def rebuild_period_totals():
+    """由出勤資料（試算表後端另加 outbox 中尚未送出的離場）重建總計，回傳筆數"""
+    attendance_repo.refresh()
+    
+    conn = get_local_db()
+    deadline = time.monotonic() + PERIOD_PENDING_TIMEOUT
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        pending = conn.execute("SELECT COUNT(*) FROM period_pending WHERE started > ?",
+                               (time.time() - PERIOD_PENDING_TIMEOUT,)).fetchone()[0]
+        if not pending:
+            break
+        # 交易中不能有新的登記，等進行中的離場寫入累加完總計再重建
+        conn.execute('ROLLBACK')
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"仍有 {pending} 筆離場寫入進行中，稍後再重建薪資週期總計")
+        time.sleep(0.05)
+    try:
+        conn.execute("DELETE FROM period_pending")
+        totals = attendance_repo.totals_by_period()
+        conn.execute("DELETE FROM period_totals")
+        conn.executemany(
+            "INSERT INTO period_totals (period_start, person_name, days) VALUES (?, ?, ?)",
+            [(period_start, person_name, days) for (period_start, person_name), days in totals.items()]
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    log.info("✅ 已重建薪資週期總計: %d 筆", len(totals))
+    return len(totals)
+
+def get_period_totals(day):
+    """取得 day 所在薪資週期的每人總計，依姓名排序"""
+    period_start = get_pay_period(day)[0].isoformat()
+    return get_local_db().execute(
+        "SELECT person_name, days FROM period_totals WHERE period_start = ? ORDER BY person_name",
+        (period_start,)
+    ).fetchall()
+
+# 薪資匯出
+PAYROLL_HEADERS = {
+    'detail': ["日期", "姓名", "專案", "簽到時間", "離場時間", "出勤天數"],
+    'person': ["姓名", "出勤天數", "出勤日數"],
+    'project': ["專案", "出勤天數", "出勤人次", "人數"],
+}
+
+payroll_exports = Counter('bot_payroll_exports_total', 'Payroll exports', ('format', 'view'))
+
+class PayrollTotals:
+    """掃描明細時順便累計人員與專案合計，只保存每人、每專案各一筆"""
+    
+    def __init__(self):
+        self.people = {}  # 姓名 -> [天數, 出勤日數, 最後出勤日期]
+        self.projects = {}  # 專案 -> [天數, 人次, 姓名]
+    
+    def add(self, work_date, person_name, days, project_name):
+        days = days or 0.0
+        person = self.people.setdefault(person_name, [0.0, 0, None])
+        person[0] += days
+        # 明細依日期遞增，日期改變才算新的一天
+        if person[2] != work_date:
+            person[1] += 1
+            person[2] = work_date
+        project = self.projects.setdefault(project_name or "未指定", [0.0, 0, set()])
+        project[0] += days
+        project[1] += 1
+        project[2].add(person_name)
+    
+    def person_rows(self):
+        return [[person_name, round(days, 2), day_count]
+                for person_name, (days, day_count, _) in sorted(self.people.items())]
+    
+    def project_rows(self):
+        return [[project_name, round(days, 2), visits, len(names)]
+                for project_name, (days, visits, names) in sorted(self.projects.items())]
+
+def parse_export_date(value):
+    """匯出日期: 西元 2024-01-31 或民國 113/01/31"""
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        work_day = minguo_to_gregorian(value)
+        if work_day is None:
+            raise ValueError(f"日期格式錯誤: {value}")
+        return work_day
+
+def parse_export_range(start, end):
+    """未指定時為本期起日到今天"""
+    first_day = parse_export_date(start) if start else get_pay_period(date.today())[0]
+    last_day = parse_export_date(end) if end else date.today()
+    if first_day > last_day:
+        raise ValueError("起日不可晚於迄日")
+    return first_day, last_day
+
+def iter_payroll_detail(first_day, last_day, totals):
+    """逐列產生明細，同時累計到 totals"""
+    for work_date, person_name, sign_in, checkout, days, project_name in attendance_repo.iter_range(first_day, last_day):
+        totals.add(work_date, person_name, days, project_name)
+        yield [work_date, person_name, project_name or "", sign_in, checkout, "" if days is None else days]
+
+def iter_payroll_rows(first_day, last_day, view):
+    """依 view 產生資料列: detail 邊讀邊產生；person / project 讀完明細後產生合計"""
+    totals = PayrollTotals()
+    rows = iter_payroll_detail(first_day, last_day, totals)
+    if view == 'detail':
+        yield from rows
+        return
+    for _ in rows:
+        pass
+    yield from totals.person_rows() if view == 'person' else totals.project_rows()
+
+def stream_payroll_csv(first_day, last_day, view):
+    """每 EXPORT_CSV_FLUSH_ROWS 列送出一段 UTF-8 CSV（含 BOM，Excel 才能正確顯示中文）"""
+    buffer = io.StringIO()
+    buffer.write('\ufeff')
+    writer = csv.writer(buffer)
+    writer.writerow(PAYROLL_HEADERS[view])
+    for count, row in enumerate(iter_payroll_rows(first_day, last_day, view), 1):
+        writer.writerow(row)
+        if count % EXPORT_CSV_FLUSH_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
 
-def can_access_session(user_id, session):
-    """檢查用戶是否有權限存取 Session"""
-    role = get_user_role(user_id)
-    if role == "ADMIN":
-        return True
-    elif role == "MANAGER":
-        return session.is_authorized(user_id)
-    return False
+def xlsx_export_available():
+    return importlib.util.find_spec('openpyxl') is not None
 
-# Google Sheets 操作函式
-def write_person_to_sheet(work_date, project_name, person_name, sign_in_time, note=""):
-    """立即寫入簽到記錄"""
-    if not attendance_sheet:
-        return False
-    
+def write_payroll_xlsx(first_day, last_day, fileobj):
+    """明細、人員合計、專案合計三個工作表；write_only 模式逐列寫入暫存檔，不在記憶體中保留整本"""
+    from openpyxl import Workbook  # 選用套件，只有匯出 XLSX 時才載入
+    workbook = Workbook(write_only=True)
+    totals = PayrollTotals()
+    detail_sheet = workbook.create_sheet("明細")
+    detail_sheet.append(PAYROLL_HEADERS['detail'])
+    for row in iter_payroll_detail(first_day, last_day, totals):
+        detail_sheet.append(row)
+    for title, view, rows in (("人員合計", 'person', totals.person_rows()),
+                              ("專案合計", 'project', totals.project_rows())):
+        sheet = workbook.create_sheet(title)
+        sheet.append(PAYROLL_HEADERS[view])
+        for row in rows:
+            sheet.append(row)
+    workbook.save(fileobj)
+
+def stream_payroll_xlsx(first_day, last_day):
+    """XLSX 為 zip 格式，先寫到暫存檔再分段送出"""
+    with tempfile.TemporaryFile() as f:
+        write_payroll_xlsx(first_day, last_day, f)
+        f.seek(0)
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            yield chunk
+
+def refresh_attendance_for_export():
+    """試算表後端只增量同步出勤封存；失敗時以現有封存匯出"""
     try:
-        update_time = datetime.datetime.now(
-            datetime.timezone(datetime.timedelta(hours=8))
-        ).strftime('%Y-%m-%d %H:%M:%S')
-        
-        new_row = [
-            work_date,
-            person_name,
-            sign_in_time.strftime('%H:%M') if sign_in_time else "",
-            "",
-            "",
-            note if note else f"項目: {project_name}",
-            update_time
-        ]
-        attendance_sheet.append_row(new_row)
-        print(f"✅ 已即時寫入 {person_name} 的簽到記錄")
-        return True
+        attendance_repo.refresh()
     except Exception as e:
-        print(f"❌ 寫入失敗: {e}")
-        return False
+        log.warning("⚠️ 匯出前同步失敗，使用本機資料: %s", e)
 
-def update_person_checkout(work_date, person_name, checkout_time, sign_in_time):
-    """更新離場時間和出勤天數"""
-    if not attendance_sheet:
-        return False
+@app.route("/export/attendance", methods=['GET'])
+def export_attendance():
+    """薪資匯出: ?start=&end=&view=detail|person|project&format=csv|xlsx
+    
+    需 Authorization: Bearer <EXPORT_TOKEN>；在請求線程中產生，不佔用事件處理線程
+    """
+    if not EXPORT_TOKEN:
+        abort(404)
+    auth = request.headers.get('Authorization', '')
+    supplied = auth[len('Bearer '):] if auth.startswith('Bearer ') else ''
+    if not hmac.compare_digest(supplied.encode(), EXPORT_TOKEN.encode()):
+        abort(401)
     
     try:
-        records = attendance_sheet.get_all_records()
-        target_row = None
-        
-        for i, record in enumerate(records, start=2):
-            if record['日期'] == work_date and record['姓名'] == person_name and not record['離場時間']:
-                target_row = i
-        
-        if target_row:
-            checkout_hour = checkout_time.hour
-            sign_in_hour = sign_in_time.hour
-            
-            # 計算出勤天數
-            if sign_in_hour < 10:
-                days = 1.0
-                remark = ""
-            elif sign_in_hour < 13:
-                days = 1.0
-                remark = ""
-            else:
-                days = 0.5
-                remark = "下午簽到"
-            
-            # 16:00 前早退
-            if checkout_hour < 16:
-                days = 0.5
-                remark = f"早退({checkout_time.strftime('%H:%M')})"
-            # 17:00 後加班
-            elif checkout_hour >= 17:
-                remark = (remark + " " if remark else "") + "加班"
-            
-            attendance_sheet.update_cell(target_row, 4, checkout_time.strftime('%H:%M'))
-            attendance_sheet.update_cell(target_row, 5, days)
-            attendance_sheet.update_cell(target_row, 6, remark.strip())
-            print(f"✅ 已更新 {person_name} 的離場記錄: {days} 天")
-            return True
-        
-        return False
-    except Exception as e:
-        print(f"❌ 更新失敗: {e}")
-        return False
+        first_day, last_day = parse_export_range(request.args.get('start'), request.args.get('end'))
+    except ValueError as e:
+        return str(e), 400
+    view = request.args.get('view', 'detail')
+    export_format = request.args.get('format', 'csv')
+    if view not in PAYROLL_HEADERS or export_format not in ('csv', 'xlsx'):
+        return "view 需為 detail / person / project，format 需為 csv / xlsx", 400
+    if export_format == 'xlsx' and not xlsx_export_available():
+        return "未安裝 openpyxl，無法匯出 XLSX", 501
+    
+    refresh_attendance_for_export()
+    payroll_exports.inc(format=export_format, view=view)
+    filename = f"attendance_{first_day:%Y%m%d}_{last_day:%Y%m%d}"
+    if export_format == 'csv':
+        body = stream_payroll_csv(first_day, last_day, view)
+        mimetype = 'text/csv'
+        filename += f"_{view}.csv"
+    else:
+        body = stream_payroll_xlsx(first_day, last_day)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        filename += ".xlsx"
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
 
 # 每日統整
-def daily_summary():
-    """每天 22:00 台灣時間執行統整"""
-    print("\n" + "="*50)
-    print("🕙 22:00 每日統整開始")
-    print("="*50)
-    
-    if not attendance_sheet or not summary_sheet:
-        print("❌ 工作表連線失敗")
-        return
+SUMMARY_BACKFILL_MAX_DAYS = 31  # 最多往回補統整的天數
+
+def daily_summary(include_today=True):
+    """每天 22:00 台灣時間執行統整，並補上之前漏掉的日期
+    
+    資料來自 attendance_repo；已在每日統整中的 (日期, 姓名) 不會重複寫入；回傳寫入筆數
+    """
+    log.info("🕙 22:00 每日統整開始")
+    
+    if not attendance_repo.is_available(need_summary=True):
+        log.error("❌ 工作表連線失敗")
+        raise SheetsUnavailableError("每日統整工作表無法使用")
     
     try:
         today = date.today()
-        minguo_year = today.year - 1911
-        today_str = f"{minguo_year:03d}/{today.month:02d}/{today.day:02d}"
+        last_day = today if include_today else today - timedelta(days=1)
         
-        records = attendance_sheet.get_all_records()
-        df = pd.DataFrame(records)
+        # 先送出 outbox，讓讀到的資料包含所有寫入（僅試算表後端）
+        if sheets_outbox_enabled():
+            flush_outbox()
         
-        today_df = df[df['日期'] == today_str]
-        
-        if today_df.empty:
-            print(f"ℹ️ {today_str} 沒有出勤記錄")
-            return
+        # 已統整的 (日期, 姓名)
+        summarized_pairs = attendance_repo.summarized_pairs()
+        summarized_days = [d for d in (minguo_to_gregorian(work_date) for work_date, _ in summarized_pairs) if d]
+        first_day = max(
+            max(summarized_days) + timedelta(days=1) if summarized_days else date.min,
+            last_day - timedelta(days=SUMMARY_BACKFILL_MAX_DAYS - 1)
+        )
+        if first_day > last_day:
+            log.info("ℹ️ 沒有需要統整的日期")
+            return 0
         
+        # 試算表後端的出勤封存只會讀取新增與近期的列
+        attendance_repo.refresh()
         # 同一天同一人只計最高時數
-        summary_list = []
-        for person_name in today_df['姓名'].unique():
-            person_records = today_df[today_df['姓名'] == person_name]
-            days_list = pd.to_numeric(person_records['出勤時數'], errors='coerce').dropna().tolist()
-            
-            if days_list:
-                max_days = max(days_list)
-                summary_list.append({'姓名': person_name, '總出勤天數': max_days})
-        
-        if not summary_list:
-            print(f"ℹ️ {today_str} 沒有有效的出勤時數")
-            return
+        daily_max = attendance_repo.daily_max_by_person(first_day, last_day)
         
-        summary_df = pd.DataFrame(summary_list)
-        update_time = datetime.datetime.now(
-            datetime.timezone(datetime.timedelta(hours=8))
-        ).strftime('%Y-%m-%d %H:%M:%S')
-        
-        for _, row in summary_df.iterrows():
-            summary_row = [today_str, row['姓名'], row['總出勤天數'], update_time]
-            summary_sheet.append_row(summary_row)
+        update_time = now_taipei_str()
+        summary_rows = [
+            [work_date, person_name, days, update_time]
+            for work_date, person_name, days in daily_max
+            if (work_date, person_name) not in summarized_pairs
+        ]
+        if summary_rows:
+            attendance_repo.write_daily_summary(summary_rows)
+            if sheets_outbox_enabled():
+                flush_outbox()
         
-        print(f"✅ 已統整 {len(summary_df)} 人的 {today_str} 出勤資料")
+        summarized_dates = sorted({row[0] for row in summary_rows})
+        log.info("✅ 已統整 %d 筆出勤資料，日期: %s", len(summary_rows), ', '.join(summarized_dates) or '無')
         
         # 統整後清理垃圾
         gc.collect()
+        return len(summary_rows)
         
     except Exception as e:
-        print(f"❌ 統整失敗: {e}")
+        log.error("❌ 統整失敗: %s", e)
+        raise
+
+# [優化] 排程執行記錄: 每次執行有 run id，同一個 run id 成功後不再執行，多個程序或重啟也不會重複
+def init_job_runs():
+    get_local_db().executescript("""
+        CREATE TABLE IF NOT EXISTS job_runs (
+            run_id TEXT PRIMARY KEY,
+            job TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started REAL NOT NULL,
+            finished REAL,
+            duration REAL,
+            rows INTEGER,
+            error TEXT,
+            pid INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs (job, started);
+    """)
+
+init_job_runs()
+
+job_runs_total = Counter('bot_job_runs_total', 'Scheduled job runs', ('job', 'status'))
+
+def run_job(job_name, run_id, func, *args, **kwargs):
+    """以 run id 執行排程工作並記錄狀態；同一個 run id 已成功或仍在執行中時略過"""
+    conn = get_local_db()
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute("SELECT status, started FROM job_runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row and (row[0] == 'ok' or (row[0] == 'running' and now - row[1] < JOB_RUNNING_TIMEOUT)):
+            conn.execute('COMMIT')
+            log.info("⏭️ %s 已%s，略過", run_id, '完成' if row[0] == 'ok' else '在執行中')
+            job_runs_total.inc(job=job_name, status='skipped')
+            return None
+        conn.execute(
+            "INSERT OR REPLACE INTO job_runs (run_id, job, status, started, pid) VALUES (?, ?, 'running', ?, ?)",
+            (run_id, job_name, now, os.getpid())
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    
+    started = time.perf_counter()
+    status, rows, error = 'ok', None, None
+    try:
+        rows = func(*args, **kwargs)
+    except Exception as e:
+        status, error = 'failed', str(e)[:200]
+    duration = time.perf_counter() - started
+    conn.execute(
+        "UPDATE job_runs SET status = ?, finished = ?, duration = ?, rows = ?, error = ? WHERE run_id = ?",
+        (status, time.time(), duration, rows, error, run_id)
+    )
+    job_runs_total.inc(job=job_name, status=status)
+    log.log(logging.INFO if status == 'ok' else logging.ERROR, "%s %s: %s, %.2fs, %s 筆",
+            '✅' if status == 'ok' else '❌', run_id, status, duration, rows if rows is not None else '-')
+    return rows
+
+def get_job_status():
+    """各排程工作最近一次執行: {工作: {run_id, status, started, duration, rows, error}}"""
+    rows = get_local_db().execute(
+        "SELECT job, run_id, status, started, duration, rows, error FROM job_runs "
+        "WHERE rowid IN (SELECT MAX(rowid) FROM job_runs GROUP BY job) ORDER BY job"
+    ).fetchall()
+    return {
+        job: {'run_id': run_id, 'status': status,
+              'started': datetime.datetime.fromtimestamp(started, datetime.timezone(datetime.timedelta(hours=8)))
+                         .strftime('%Y-%m-%d %H:%M:%S'),
+              'duration': round(duration, 2) if duration is not None else None,
+              'rows': job_rows, 'error': error}
+        for job, run_id, status, started, duration, job_rows, error in rows
+    }
+
+def scheduled_daily_summary(include_today=True):
+    """每日統整以日期為 run id；啟動後的補統整每天最多成功一次"""
+    today = date.today().isoformat()
+    run_id = f"daily_summary:{today}" if include_today else f"daily_summary_catchup:{today}"
+    run_job('daily_summary', run_id, daily_summary, include_today=include_today)
+
+def scheduled_attendance_rollover():
+    """出勤表分區以日期為 run id，失敗時隔天再試"""
+    run_job('attendance_rollover', f"attendance_rollover:{date.today().isoformat()}", rollover_attendance)
+
+def scheduled_cleanup():
+    """清理以排程間隔為 run id"""
+    slot = int(time.time() // (CLEANUP_INTERVAL_HOURS * 3600))
+    run_job('cleanup_old_sessions', f"cleanup_old_sessions:{slot}", cleanup_old_sessions)
+
+class LeaderLock:
+    """以 fcntl 檔案鎖選出唯一的 leader；鎖跟著開啟的檔案，程序結束時系統自動釋放"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+        self.owner_pid = None
+    
+    def try_acquire(self):
+        if self.is_leader():
+            return True
+        lock_file = open(self.path, 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(f"{os.getpid()}\n")
+        lock_file.flush()
+        self.lock_file = lock_file
+        self.owner_pid = os.getpid()
+        return True
+    
+    def is_leader(self):
+        # fork 出來的子程序繼承檔案但不是 leader
+        return self.lock_file is not None and self.owner_pid == os.getpid()
+
+scheduler_leader = LeaderLock(SCHEDULER_LOCK_PATH or f"{LOCAL_DB_PATH}.scheduler.lock")
 
 # 排程設定
 scheduler = BackgroundScheduler(timezone='Asia/Taipei')
@@ -344,15 +2831,147 @@ scheduler = BackgroundScheduler(timezone='Asia/Taipei')
 def start_scheduler():
     """啟動排程器"""
     # 每日統整
-    scheduler.add_job(daily_summary, 'cron', hour=22, minute=0, timezone='Asia/Taipei')
+    scheduler.add_job(scheduled_daily_summary, 'cron', hour=22, minute=0, timezone='Asia/Taipei')
+    # 啟動後補統整休眠期間漏掉的日期（不含今天）
+    scheduler.add_job(scheduled_daily_summary, 'date', kwargs={'include_today': False},
+                      run_date=datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
+                      + timedelta(minutes=1))
     # 定期清理
-    scheduler.add_job(cleanup_old_sessions, 'interval', hours=CLEANUP_INTERVAL_HOURS)
+    scheduler.add_job(scheduled_cleanup, 'interval', hours=CLEANUP_INTERVAL_HOURS)
+    # 出勤表分區: 清晨沒有人簽到離場時移出已結束的月份
+    if ATTENDANCE_BACKEND in ('sheets', 'mirror'):
+        scheduler.add_job(scheduled_attendance_rollover, 'cron', hour=ATTENDANCE_ROLLOVER_HOUR, minute=0,
+                          timezone='Asia/Taipei')
     scheduler.start()
-    print("✅ 已啟動排程器")
-    print(f"   - 每日 22:00 (台灣時間) 統整出勤")
-    print(f"   - 每 {CLEANUP_INTERVAL_HOURS} 小時清理過期 Session")
+    log.info("✅ 已啟動排程器")
+    log.info("   - 每日 22:00 (台灣時間) 統整出勤")
+    log.info("   - 每 %d 小時清理過期 Session", CLEANUP_INTERVAL_HOURS)
+    if ATTENDANCE_BACKEND in ('sheets', 'mirror'):
+        log.info("   - 每日 %02d:00 (台灣時間) 移出已結束月份的出勤列", ATTENDANCE_ROLLOVER_HOUR)
+
+def scheduler_leader_loop():
+    """取得 leader 鎖後啟動排程器；未取得時定期重試，接手已結束的 leader"""
+    while not scheduler_leader.try_acquire():
+        time.sleep(LEADER_RETRY_INTERVAL)
+    log.info("👑 取得排程 leader (pid %d)", os.getpid())
+    start_scheduler()
+
+scheduler_leader_thread = threading.Thread(target=scheduler_leader_loop, daemon=True, name='scheduler-leader')
+
+# [優化] 人員名單: 以姓名為 key 的有序 dict，新增/查詢/離場都是 O(1)
+class StaffRecord:
+    __slots__ = ['name', 'add_time', 'note']
+    
+    def __init__(self, name, add_time, note=None):
+        self.name = name
+        self.add_time = add_time
+        self.note = note
 
-start_scheduler()
+STAFF_NAME_NOTE_PATTERN = re.compile(r"\(.*?\)")
+
+def normalize_staff_name(name):
+    """姓名正規化: 全形轉半形、去掉括號備註與所有空白"""
+    normalized = STAFF_NAME_NOTE_PATTERN.sub("", unicodedata.normalize('NFKC', name or ""))
+    return "".join(normalized.casefold().split())
+
+def staff_name_deletions(key):
+    """刪去一個字的所有變化；兩個姓名有共同的變化時，編輯距離不超過 1（或相鄰兩字對調）"""
+    return {key[:i] + key[i + 1:] for i in range(len(key))}
+
+class StaffRoster:
+    """依加入順序保存的人員名單
+    
+    另以正規化姓名建立索引，查詢時全形、空白與括號備註不影響比對；
+    刪字索引讓打錯一個字的姓名也能在 O(姓名長度) 內找到建議
+    """
+    __slots__ = ['records', 'by_key', 'near']
+    
+    def __init__(self, records=()):
+        self.records = {}
+        self.by_key = {}  # 正規化姓名 -> [StaffRecord]，舊資料可能有多人對到同一個 key
+        self.near = {}  # 刪去一字的正規化姓名 -> {正規化姓名}
+        for record in records:
+            if record.name not in self.records:
+                self._insert(record)
+    
+    def _insert(self, record):
+        self.records[record.name] = record
+        key = normalize_staff_name(record.name)
+        self.by_key.setdefault(key, []).append(record)
+        for variant in staff_name_deletions(key):
+            self.near.setdefault(variant, set()).add(key)
+    
+    def __contains__(self, name):
+        return name in self.records or normalize_staff_name(name) in self.by_key
+    
+    def __len__(self):
+        return len(self.records)
+    
+    def __iter__(self):
+        return iter(list(self.records.values()))
+    
+    def get(self, name):
+        """完全相同的姓名優先，其次是唯一對到的正規化姓名；對到多人時回傳 None"""
+        record = self.records.get(name)
+        if record is not None:
+            return record
+        matches = self.by_key.get(normalize_staff_name(name), ())
+        return matches[0] if len(matches) == 1 else None
+    
+    def suggest(self, name, limit=3):
+        """找不到時的建議姓名: 正規化後相同的多人，或編輯距離 1 的姓名"""
+        key = normalize_staff_name(name)
+        if key in self.by_key:
+            return [record.name for record in self.by_key[key]][:limit]
+        keys = set(self.near.get(key, ()))
+        for variant in staff_name_deletions(key):
+            if variant in self.by_key:
+                keys.add(variant)
+            keys.update(self.near.get(variant, ()))
+        return sorted(record.name for k in keys for record in self.by_key[k])[:limit]
+    
+    def add(self, name, add_time, note=None):
+        """已在名單中（含正規化後相同的姓名）回傳 False"""
+        if name in self:
+            return False
+        self._insert(StaffRecord(name, add_time, note))
+        return True
+    
+    def merge(self, other):
+        """併入另一份名單中尚未出現的人，保留原本的順序"""
+        for record in other:
+            if record.name not in self.records:
+                self._insert(record)
+    
+    def remove(self, names):
+        """移除登記後寫入失敗的人"""
+        for name in names:
+            record = self.records.pop(name, None)
+            if record is None:
+                continue
+            key = normalize_staff_name(name)
+            matches = [r for r in self.by_key.get(key, ()) if r is not record]
+            if matches:
+                self.by_key[key] = matches
+                continue
+            self.by_key.pop(key, None)
+            for variant in staff_name_deletions(key):
+                keys = self.near.get(variant)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.near[variant]
+    
+    def to_json(self):
+        return json.dumps([
+            {"name": r.name, "add_time": r.add_time.isoformat(), "note": r.note}
+            for r in self.records.values()
+        ], ensure_ascii=False)
+    
+    @classmethod
+    def from_json(cls, staff_json):
+        return cls(StaffRecord(p['name'], datetime.datetime.fromisoformat(p['add_time']), p['note'])
+                   for p in json.loads(staff_json))
 
 # Session 管理類別
 class DailySession:
@@ -361,10 +2980,14 @@ class DailySession:
     def __init__(self, work_date, project_name=""):
         self.work_date = work_date
         self.project_name = project_name
-        self.staff = []
+        self.staff = StaffRoster()
         self.created_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
         self.authorized_users = set()
     
+    @property
+    def key(self):
+        return make_session_key(self.work_date, self.project_name)
+    
     def add_authorized_user(self, user_id):
         self.authorized_users.add(user_id)
     
@@ -375,32 +2998,443 @@ class DailySession:
         if add_time is None:
             add_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
         
-        if name not in [s['name'] for s in self.staff]:
-            if write_person_to_sheet(self.work_date, self.project_name, name, add_time, note or ""):
-                self.staff.append({"name": name, "add_time": add_time, "note": note})
-                return True
-        return False
+        with get_session_lock(self.key):
+            if not session_store.claim_staff(self, [{'name': name, 'note': note}], add_time):
+                return False
+            if not write_person_to_sheet(self.work_date, self.project_name, name, add_time, note or ""):
+                session_store.release_staff(self, [name])
+                return False
+            return True
+    
+    def add_staff_batch(self, staff_list, add_time=None):
+        """整批新增人員，只寫入尚未在名單中的人，回傳新增的姓名"""
+        if add_time is None:
+            add_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
+        
+        with get_session_lock(self.key):
+            # 先登記到名單（同一份名單內正規化後相同的姓名只登記一次），只寫入登記成功的人
+            new_people = session_store.claim_staff(
+                self, [person for person in staff_list if normalize_staff_name(person['name'])], add_time
+            )
+            if not new_people:
+                return []
+            if not write_people_to_sheet(self.work_date, self.project_name, new_people, add_time):
+                session_store.release_staff(self, [person['name'] for person in new_people])
+                return []
+            return [person['name'] for person in new_people]
     
     def get_summary(self):
         summary = f"📋 {self.work_date}\n"
         summary += f"👥 目前人數: {len(self.staff)} 人\n"
         summary += "人員:\n"
         for i, person in enumerate(self.staff, 1):
-            summary += f"  {i}. {person['name']}\n"
+            summary += f"  {i}. {person.name}\n"
         return summary
 
-def get_or_create_session(work_date, project_name, user_id):
-    """取得或建立 Session - 線程安全"""
-    with session_lock:
-        if project_name is None:
-            project_name = ""
+    def staff_to_json(self):
+        return self.staff.to_json()
+    
+    @staticmethod
+    def staff_from_json(staff_json):
+        return StaffRoster.from_json(staff_json)
+
+def make_session_key(work_date, project_name):
+    return f"{work_date}_{project_name}"
+
+# [優化] 分段鎖: 同一 Session 的新增/離場互斥，不同班組落在不同分段，不會互相等待
+session_locks = [threading.RLock() for _ in range(SESSION_LOCK_STRIPES)]
+
+def get_session_lock(session_key):
+    return session_locks[zlib.crc32(session_key.encode()) % SESSION_LOCK_STRIPES]
+
+def normalize_project_name(name):
+    """專案名稱正規化: 全形轉半形、忽略大小寫與空白"""
+    return "".join(unicodedata.normalize('NFKC', name or "").casefold().split())
+
+class ProjectNameIndex:
+    """專案名稱索引: 正規化名稱精確比對 + 單字/雙字 n-gram 部分比對，不必掃描所有 Session"""
+    
+    def __init__(self):
+        self.exact = {}  # (日期, 正規化名稱) -> keys
+        self.grams = {}  # (日期, n-gram) -> keys
+        self.short_names = {}  # (日期, 單字名稱) -> keys，供「查詢字串包含名稱」比對
+        self.entries = {}  # key -> (日期, 正規化名稱)
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def _grams(text):
+        grams = set(text)
+        grams.update(text[i:i + 2] for i in range(len(text) - 1))
+        return grams
+    
+    def add(self, session_key, work_date, project_name):
+        normalized = normalize_project_name(project_name)
+        with self.lock:
+            if session_key in self.entries:
+                return
+            self.entries[session_key] = (work_date, normalized)
+            self.exact.setdefault((work_date, normalized), set()).add(session_key)
+            for gram in self._grams(normalized):
+                self.grams.setdefault((work_date, gram), set()).add(session_key)
+            if len(normalized) == 1:
+                self.short_names.setdefault((work_date, normalized), set()).add(session_key)
+    
+    def remove(self, session_key):
+        with self.lock:
+            entry = self.entries.pop(session_key, None)
+            if entry is None:
+                return
+            work_date, normalized = entry
+            self.exact.get((work_date, normalized), set()).discard(session_key)
+            for gram in self._grams(normalized):
+                self.grams.get((work_date, gram), set()).discard(session_key)
+            self.short_names.get((work_date, normalized), set()).discard(session_key)
+    
+    def match(self, work_date, query):
+        """依優先順序回傳候選 key: [精確, 開頭相符, 名稱包含查詢, 查詢包含名稱]"""
+        normalized = normalize_project_name(query)
+        if not normalized:
+            return []
+        with self.lock:
+            exact = set(self.exact.get((work_date, normalized), ()))
+            
+            # 名稱包含查詢字串: 必須含有查詢字串的每個 n-gram
+            query_grams = [g for g in self._grams(normalized) if len(g) == min(2, len(normalized))]
+            postings = [self.grams.get((work_date, g), set()) for g in query_grams]
+            contains = set.intersection(*postings) if postings else set()
+            contains = {k for k in contains if normalized in self.entries[k][1]} - exact
+            prefix = {k for k in contains if self.entries[k][1].startswith(normalized)}
+            contains -= prefix
+            
+            # 查詢字串包含名稱: 名稱至少有一個 n-gram 出現在查詢字串中
+            contained = set()
+            for char in set(normalized):
+                contained |= self.short_names.get((work_date, char), set())
+            for i in range(len(normalized) - 1):
+                contained |= self.grams.get((work_date, normalized[i:i + 2]), set())
+            contained = {k for k in contained
+                         if self.entries[k][1] and self.entries[k][1] in normalized} - exact - prefix - contains
+        return [exact, prefix, contains, contained]
+
+class BaseSessionStore:
+    """兩種 Session 儲存共用的專案名稱比對"""
+    
+    def match_project(self, work_date, project_name, user_id=None):
+        """依專案名稱找 Session: 精確 > 開頭相符 > 部分相符；user_id 有值時只看該用戶被授權的"""
+        for keys in self.name_index.match(work_date, project_name):
+            if not keys:
+                continue
+            candidates = self._sessions_by_keys(keys)
+            if user_id is not None:
+                candidates = [s for s in candidates if s.is_authorized(user_id)]
+            if candidates:
+                return min(candidates, key=lambda s: s.created_time)
+        return None
+
+class InMemorySessionStore(BaseSessionStore):
+    """單一程序內的 Session 儲存，依日期與授權用戶建立索引"""
+    
+    def __init__(self):
+        self.sessions = {}
+        self.by_date = {}
+        self.by_user = {}
+        self.name_index = ProjectNameIndex()
+        self.lock = threading.RLock()
+    
+    def get(self, work_date, project_name):
+        with self.lock:
+            return self.sessions.get(make_session_key(work_date, project_name))
+    
+    def get_or_create(self, work_date, project_name, user_id):
+        session_key = make_session_key(work_date, project_name)
+        with self.lock:
+            session = self.sessions.get(session_key)
+            if session is None:
+                session = DailySession(work_date, project_name)
+                self.sessions[session_key] = session
+                self.by_date.setdefault(work_date, set()).add(session_key)
+                self.name_index.add(session_key, work_date, project_name)
+            if user_id and not session.is_authorized(user_id):
+                session.add_authorized_user(user_id)
+                self.by_user.setdefault(user_id, set()).add(session_key)
+            return session
+    
+    def save(self, session):
+        """記憶體中的物件就是本體，不需另外寫回"""
+        pass
+    
+    def claim_staff(self, session, people, add_time):
+        """登記尚未在名單中的人，回傳登記成功的 people；單一程序內由 Session 鎖保護"""
+        return [person for person in people if session.staff.add(person['name'], add_time, person['note'])]
+    
+    def release_staff(self, session, names):
+        session.staff.remove(names)
+    
+    def find(self, work_date=None, user_id=None):
+        """依日期及/或授權用戶查詢，依建立時間排序"""
+        with self.lock:
+            if work_date is None and user_id is None:
+                keys = self.sessions.keys()
+            elif user_id is None:
+                keys = self.by_date.get(work_date, ())
+            elif work_date is None:
+                keys = self.by_user.get(user_id, ())
+            else:
+                keys = self.by_date.get(work_date, set()) & self.by_user.get(user_id, set())
+            sessions = [self.sessions[k] for k in keys]
+        return sorted(sessions, key=lambda s: s.created_time)
+    
+    def _sessions_by_keys(self, keys):
+        with self.lock:
+            return [self.sessions[k] for k in keys if k in self.sessions]
+    
+    def remove(self, sessions):
+        with self.lock:
+            for session in sessions:
+                session_key = make_session_key(session.work_date, session.project_name)
+                if self.sessions.pop(session_key, None) is None:
+                    continue
+                self.name_index.remove(session_key)
+                self.by_date.get(session.work_date, set()).discard(session_key)
+                for user_id in session.authorized_users:
+                    self.by_user.get(user_id, set()).discard(session_key)
+    
+    def count(self):
+        return len(self.sessions)
+
+class SQLiteSessionStore(BaseSessionStore):
+    """以本機 SQLite (WAL) 保存 Session，多個程序共用且重啟後保留"""
+    
+    def __init__(self):
+        self.name_index = ProjectNameIndex()
+        self.indexed_rowid = 0  # 專案名稱索引已載入到的 rowid
+        self.index_lock = threading.Lock()
+        get_local_db().executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_key TEXT PRIMARY KEY,
+                work_date TEXT NOT NULL,
+                project_name TEXT NOT NULL,
+                created_time TEXT NOT NULL,
+                staff TEXT NOT NULL DEFAULT '[]'
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_date ON sessions (work_date);
+            CREATE TABLE IF NOT EXISTS session_users (
+                session_key TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                PRIMARY KEY (session_key, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_session_users_user ON session_users (user_id);
+        """)
+    
+    def _load(self, where="", params=()):
+        rows = get_local_db().execute(
+            "SELECT s.work_date, s.project_name, s.created_time, s.staff, "
+            "GROUP_CONCAT(u.user_id, ',') FROM sessions s "
+            "LEFT JOIN session_users u ON u.session_key = s.session_key "
+            f"{where} GROUP BY s.session_key ORDER BY s.created_time",
+            params
+        ).fetchall()
+        sessions = []
+        for work_date, project_name, created_time, staff_json, users in rows:
+            session = DailySession(work_date, project_name)
+            session.created_time = datetime.datetime.fromisoformat(created_time)
+            session.staff = DailySession.staff_from_json(staff_json)
+            session.authorized_users = set(users.split(',')) if users else set()
+            sessions.append(session)
+        return sessions
+    
+    def get(self, work_date, project_name):
+        sessions = self._load("WHERE s.session_key = ?", (make_session_key(work_date, project_name),))
+        return sessions[0] if sessions else None
+    
+    def _sessions_by_keys(self, keys):
+        keys = list(keys)
+        return self._load(f"WHERE s.session_key IN ({', '.join('?' * len(keys))})", keys)
+    
+    def _refresh_name_index(self):
+        """載入其他程序新建的 Session 名稱"""
+        with self.index_lock:
+            rows = get_local_db().execute(
+                "SELECT rowid, session_key, work_date, project_name FROM sessions WHERE rowid > ? ORDER BY rowid",
+                (self.indexed_rowid,)
+            ).fetchall()
+            for rowid, session_key, work_date, project_name in rows:
+                self.name_index.add(session_key, work_date, project_name)
+                self.indexed_rowid = rowid
+    
+    def match_project(self, work_date, project_name, user_id=None):
+        self._refresh_name_index()
+        return super().match_project(work_date, project_name, user_id)
+    
+    def get_or_create(self, work_date, project_name, user_id):
+        session_key = make_session_key(work_date, project_name)
+        conn = get_local_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO sessions (session_key, work_date, project_name, created_time) "
+                "VALUES (?, ?, ?, ?)",
+                (session_key, work_date, project_name,
+                 datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).isoformat())
+            )
+            if user_id:
+                conn.execute("INSERT OR IGNORE INTO session_users (session_key, user_id) VALUES (?, ?)",
+                             (session_key, user_id))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self.get(work_date, project_name)
+    
+    def _update_staff(self, session, change):
+        """在 BEGIN IMMEDIATE 內讀出資料庫的名單、併入這份物件的名單、套用 change 後寫回
         
-        session_key = f"{work_date}_{project_name}"
-        if session_key not in session_states:
-            session_states[session_key] = DailySession(work_date, project_name)
+        多個程序同時修改同一份名單時依序進行，不會互相覆蓋；回傳 change 的結果
+        """
+        conn = get_local_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT staff FROM sessions WHERE session_key = ?", (session.key,)).fetchone()
+            merged = DailySession.staff_from_json(row[0]) if row else StaffRoster()
+            merged.merge(session.staff)
+            result = change(merged)
+            conn.execute(
+                "INSERT INTO sessions (session_key, work_date, project_name, created_time, staff) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(session_key) DO UPDATE SET staff = excluded.staff",
+                (session.key, session.work_date, session.project_name,
+                 session.created_time.isoformat(), merged.to_json())
+            )
+            conn.executemany("INSERT OR IGNORE INTO session_users (session_key, user_id) VALUES (?, ?)",
+                             [(session.key, user_id) for user_id in session.authorized_users])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        session.staff = merged
+        return result
+    
+    def save(self, session):
+        """寫回名單；名單只會增加，以姓名合併避免不同程序互相覆蓋"""
+        self._update_staff(session, lambda roster: None)
+    
+    def claim_staff(self, session, people, add_time):
+        """登記尚未在名單中的人，回傳登記成功的 people
         
-        session_states[session_key].add_authorized_user(user_id)
-        return session_states[session_key]
+        檢查與登記在同一個交易內，多個 worker 同時新增同一人時只有一個會登記成功並寫入出勤列
+        """
+        return self._update_staff(session, lambda roster: [
+            person for person in people if roster.add(person['name'], add_time, person['note'])
+        ])
+    
+    def release_staff(self, session, names):
+        """出勤列寫入失敗時取消登記"""
+        self._update_staff(session, lambda roster: roster.remove(names))
+    
+    def find(self, work_date=None, user_id=None):
+        """依日期及/或授權用戶查詢，依建立時間排序"""
+        conditions = []
+        params = []
+        if work_date is not None:
+            conditions.append("s.work_date = ?")
+            params.append(work_date)
+        if user_id is not None:
+            conditions.append("s.session_key IN (SELECT session_key FROM session_users WHERE user_id = ?)")
+            params.append(user_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._load(where, params)
+    
+    def remove(self, sessions):
+        keys = [(make_session_key(s.work_date, s.project_name),) for s in sessions]
+        if not keys:
+            return
+        conn = get_local_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany("DELETE FROM sessions WHERE session_key = ?", keys)
+            conn.executemany("DELETE FROM session_users WHERE session_key = ?", keys)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        for (session_key,) in keys:
+            self.name_index.remove(session_key)
+    
+    def count(self):
+        return get_local_db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+if SESSION_STORE_BACKEND == 'memory':
+    session_store = InMemorySessionStore()
+else:
+    session_store = SQLiteSessionStore()
+
+def warm_session_store():
+    """以今天的出勤資料預熱 Session，只補上尚未存在的人員"""
+    today = date.today()
+    today_str = to_minguo_str(today)
+    tz = datetime.timezone(datetime.timedelta(hours=8))
+    
+    by_project = {}
+    unattributed = []
+    for person_name, sign_in, project_name in attendance_repo.rows_for_day(today):
+        if project_name is not None:
+            by_project.setdefault(project_name, []).append((person_name, sign_in))
+        else:
+            unattributed.append((person_name, sign_in))
+    
+    # 有個別備註的列不含專案名稱，只有當天唯一專案時才能歸屬
+    if len(by_project) == 1 and unattributed:
+        next(iter(by_project.values())).extend(unattributed)
+    
+    warmed = 0
+    for project_name, rows in by_project.items():
+        session = session_store.get_or_create(today_str, project_name, None)
+        with get_session_lock(session.key):
+            for person_name, sign_in in rows:
+                if sign_in >= 0:
+                    add_time = datetime.datetime(today.year, today.month, today.day,
+                                                 sign_in // 60, sign_in % 60, tzinfo=tz)
+                else:
+                    add_time = session.created_time
+                if session.staff.add(person_name, add_time):
+                    warmed += 1
+            session_store.save(session)
+    
+    log.info("✅ Session 預熱完成: %d 個專案, 補上 %d 人", len(by_project), warmed)
+
+def warm_start():
+    """預熱出勤資料（試算表後端為同步封存並重建出勤索引）、Session 與薪資週期總計"""
+    try:
+        timings = []
+        step = time.perf_counter()
+        if not attendance_repo.is_available():
+            return
+        timings.append(("連線", time.perf_counter() - step))
+        for name, func in (("出勤資料", attendance_repo.warm), ("Session", warm_session_store),
+                           ("薪資週期總計", rebuild_period_totals)):
+            step = time.perf_counter()
+            try:
+                func()
+            except Exception as e:
+                log.error("❌ %s預熱失敗: %s", name, e)
+            timings.append((name, time.perf_counter() - step))
+        log.info("✅ 預熱完成 (%s)", ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings))
+    finally:
+        warm_start_done.set()
+
+def get_or_create_session(work_date, project_name, user_id):
+    """取得或建立 Session - 線程安全"""
+    if project_name is None:
+        project_name = ""
+    return session_store.get_or_create(work_date, project_name, user_id)
+
+def get_accessible_sessions(user_id, work_date=None):
+    """用戶可存取的 Session，走日期與授權用戶索引"""
+    role = get_user_role(user_id)
+    if role == "ADMIN":
+        return session_store.find(work_date=work_date)
+    elif role == "MANAGER":
+        return session_store.find(work_date=work_date, user_id=user_id)
+    return []
 
 def find_session_for_user(user_id, project_name=None, work_date=None):
     """智能找到用戶要操作的 Session"""
@@ -412,50 +3446,48 @@ def find_session_for_user(user_id, project_name=None, work_date=None):
         work_date = today_str
     
     role = get_user_role(user_id)
-    accessible_sessions = []
-    
-    print(f"[查找] 用戶角色: {role}, 目標日期: {work_date}, 指定專案: {project_name}")
-    
-    for session_key, session in session_states.items():
-        # 確保日期匹配
-        if session.work_date == work_date:
-            if role == "ADMIN":
-                accessible_sessions.append(session)
-                print(f"  [管理員] 可存取: {session.project_name}")
-            elif role == "MANAGER" and session.is_authorized(user_id):
-                accessible_sessions.append(session)
-                print(f"  [經理] 可存取: {session.project_name}")
-    
-    print(f"[查找] 共找到 {len(accessible_sessions)} 個可存取的 Session")
+    log.debug("[查找] 用戶角色: %s, 目標日期: %s, 指定專案: %s", role, work_date, project_name)
+    if role is None:
+        return None
     
-    # 情況1: 指定了專案名稱 - 精確匹配
+    # 情況1: 指定了專案名稱 - 由專案名稱索引比對
     if project_name:
-        for session in accessible_sessions:
-            if session.project_name == project_name:
-                print(f"[匹配] 精確匹配成功: {project_name}")
-                return session
-        # 如果精確匹配失敗，嘗試部分匹配
-        for session in accessible_sessions:
-            if project_name in session.project_name or session.project_name in project_name:
-                print(f"[匹配] 部分匹配成功: {session.project_name}")
-                return session
-        print(f"[匹配] 找不到專案: {project_name}")
-        return None
+        session = session_store.match_project(work_date, project_name,
+                                              None if role == "ADMIN" else user_id)
+        if session:
+            log.debug("[匹配] 匹配成功: %s", session.project_name)
+        else:
+            log.debug("[匹配] 找不到專案: %s", project_name)
+        return session
     
     # 情況2: 沒指定專案名稱
+    accessible_sessions = get_accessible_sessions(user_id, work_date)
+    log.debug("[查找] 共找到 %d 個可存取的 Session", len(accessible_sessions))
+    
     if len(accessible_sessions) == 0:
-        print(f"[查找] 沒有可用的 Session")
+        log.debug("[查找] 沒有可用的 Session")
         return None
     elif len(accessible_sessions) == 1:
-        print(f"[查找] 唯一 Session: {accessible_sessions[0].project_name}")
+        log.debug("[查找] 唯一 Session: %s", accessible_sessions[0].project_name)
         return accessible_sessions[0]
     else:
         # 多個專案，返回最近的
         latest = max(accessible_sessions, key=lambda s: s.created_time)
-        print(f"[查找] 返回最新的 Session: {latest.project_name}")
+        log.debug("[查找] 返回最新的 Session: %s", latest.project_name)
         return latest
 
 # 解析函式
+# [優化] 正規表示式在載入時編譯一次，解析時不再重複編譯
+REPORT_DATE_PATTERN = re.compile(r"^(\d{3}/\d{2}/\d{2})")
+STAFF_INDEX_PATTERN = re.compile(r"^\d+[\.\、]")
+STAFF_NOTE_PATTERN = re.compile(r"\((.+)\)")
+ADD_STAFF_PROJECT_PATTERN = re.compile(r"新增[:：]\s*(.+?)@(.+?)(?:\s*\((.+)\))?$")
+ADD_STAFF_PATTERN = re.compile(r"新增[:：]\s*(.+?)(?:\s*\((.+)\))?$")
+CHECKOUT_STAFF_PROJECT_PATTERN = re.compile(r"(?:離場|下班)[:：]\s*(.+?)@(.+?)$")
+CHECKOUT_STAFF_PATTERN = re.compile(r"(?:離場|下班)[:：]\s*(.+?)$")
+CREW_PROJECT_PATTERN = re.compile(r"@(.+?)$")
+EVENT_PROJECT_PATTERN = re.compile(r"@(.+?)(?:\s*\(.+\))?$")
+
 def parse_full_attendance_report(text):
     """解析完整日報"""
     try:
@@ -463,7 +3495,7 @@ def parse_full_attendance_report(text):
         if len(lines) < 2:
             return None
         
-        date_match = re.match(r"^(\d{3}/\d{2}/\d{2})", lines[0])
+        date_match = REPORT_DATE_PATTERN.match(lines[0])
         if not date_match:
             return None
         work_date = date_match.group(1)
@@ -487,8 +3519,8 @@ def parse_full_attendance_report(text):
             if not line or "共計" in line or "便當" in line:
                 continue
             
-            clean_line = re.sub(r"^\d+[\.\、]", "", line).strip()
-            note_match = re.search(r"\((.+)\)", clean_line)
+            clean_line = STAFF_INDEX_PATTERN.sub("", line, count=1).strip()
+            note_match = STAFF_NOTE_PATTERN.search(clean_line)
             
             if note_match:
                 note = note_match.group(1)
@@ -503,17 +3535,18 @@ def parse_full_attendance_report(text):
         
         return {"date": work_date, "project_name": project_name, "staff": staff_list}
     except Exception as e:
-        print(f"❌ 解析日報錯誤: {e}")
+        log.error("❌ 解析日報錯誤: %s", e)
         return None
 
 def parse_add_staff(text):
     """解析新增人員指令"""
-    match = re.search(r"新增[:：]\s*(.+?)@(.+?)(?:\s*\((.+)\))?$", text.strip())
+    text = text.strip()
+    match = ADD_STAFF_PROJECT_PATTERN.search(text)
     if match:
         return {"name": match.group(1).strip(), "project": match.group(2).strip(), 
                 "note": match.group(3).strip() if match.group(3) else None}
     
-    match = re.search(r"新增[:：]\s*(.+?)(?:\s*\((.+)\))?$", text.strip())
+    match = ADD_STAFF_PATTERN.search(text)
     if match:
         return {"name": match.group(1).strip(), "project": None,
                 "note": match.group(2).strip() if match.group(2) else None}
@@ -521,15 +3554,64 @@ def parse_add_staff(text):
 
 def parse_checkout_staff(text):
     """解析離場指令"""
-    match = re.search(r"(?:離場|下班)[:：]\s*(.+?)@(.+?)$", text.strip())
+    text = text.strip()
+    match = CHECKOUT_STAFF_PROJECT_PATTERN.search(text)
     if match:
         return {"name": match.group(1).strip(), "project": match.group(2).strip()}
     
-    match = re.search(r"(?:離場|下班)[:：]\s*(.+?)$", text.strip())
+    match = CHECKOUT_STAFF_PATTERN.search(text)
     if match:
         return {"name": match.group(1).strip(), "project": None}
     return None
 
+# [優化] 指令路由: 一次掃描訊息找出所有觸發詞，再依優先順序決定指令並解析欄位
+# 用前瞻比對讓重疊的觸發詞（例如「人員離場：」裡的「離場：」）也會被找到
+COMMAND_TRIGGER_PATTERN = re.compile(
+    r"(?=(\d{3}/\d{2}/\d{2}|人員離場|人員下班|人員|出工|新增|離場[:：]|下班[:：]))"
+)
+COMMAND_TRIGGER_FLAGS = {
+    "人員離場": ("staff", "crew"),
+    "人員下班": ("staff", "crew"),
+    "人員": ("staff",),
+    "出工": ("staff",),
+    "新增": ("add",),
+    "離場:": ("checkout",), "離場：": ("checkout",),
+    "下班:": ("checkout",), "下班：": ("checkout",),
+}
+# 完整比對的指令: 文字 -> (指令, 需要的角色)
+EXACT_COMMANDS = {
+    "查詢本期出勤": ("period_query", None),
+    "重新整理出勤": ("period_refresh", "ADMIN"),
+    "系統狀態": ("status", "ADMIN"),
+}
+
+def route_command(text, user_role=None):
+    """判斷指令類型並解析欄位，回傳 (指令, 解析結果)；無法識別時回傳 ("unknown", None)
+    
+    text 需已去除前後空白；解析失敗時解析結果為 None
+    """
+    exact = EXACT_COMMANDS.get(text)
+    if exact:
+        command, required_role = exact
+        if required_role is None or required_role == user_role:
+            return command, None
+        return "unknown", None
+    
+    flags = set()
+    for token in COMMAND_TRIGGER_PATTERN.findall(text):
+        flags.update(COMMAND_TRIGGER_FLAGS.get(token, ("date",)))
+    
+    if "date" in flags and "staff" in flags:
+        return "report", parse_full_attendance_report(text)
+    if "add" in flags:
+        return "add_staff", parse_add_staff(text)
+    if "checkout" in flags:
+        return "checkout", parse_checkout_staff(text)
+    if "crew" in flags:
+        project_match = CREW_PROJECT_PATTERN.search(text)
+        return "crew_checkout", {"project": project_match.group(1).strip() if project_match else None}
+    return "unknown", None
+
 def minguo_to_gregorian(minguo_str):
     """民國年轉西元年"""
     try:
@@ -539,23 +3621,286 @@ def minguo_to_gregorian(minguo_str):
     except:
         return None
 
+# [優化] 事件佇列: 同一個 Session 的事件固定交給同一個線程，依序處理
+event_queues = [queue.Queue(maxsize=EVENT_QUEUE_SIZE) for _ in range(EVENT_WORKER_COUNT)]
+pending_report_keys = {}  # user_id -> 尚在佇列中的日報 Session key
+pending_report_lock = threading.Lock()
+warm_start_done = threading.Event()
+
+def resolve_event_session_key(event):
+    """決定事件的排序鍵，同一個 Session 的事件會得到相同的鍵"""
+    if not isinstance(event, MessageEvent) or not isinstance(event.message, TextMessage):
+        return "_other"
+    
+    user_id = event.source.user_id or "_unknown"
+    message_text = event.message.text.strip()
+    user_role = get_user_role(user_id)
+    # 路由結果隨事件帶到 handle_message，日報不必解析兩次
+    command, parsed = event._route = route_command(message_text, user_role)
+    
+    if command == "report":
+        if parsed:
+            session_key = f"{parsed['date']}_{parsed['project_name']}"
+            with pending_report_lock:
+                pending_report_keys[user_id] = session_key
+            return session_key
+        return user_id
+    
+    if not user_role:
+        return user_id
+    
+    project_match = EVENT_PROJECT_PATTERN.search(message_text)
+    project_name = project_match.group(1).strip() if project_match else None
+    
+    if project_name is None:
+        # 日報還在佇列中時，後續指令跟著日報走
+        with pending_report_lock:
+            pending_key = pending_report_keys.get(user_id)
+        if pending_key:
+            return pending_key
+    
+    session = find_session_for_user(user_id, project_name)
+    if session:
+        return f"{session.work_date}_{session.project_name}"
+    return user_id
+
+class WebhookDelivery:
+    """一次 webhook 傳送: 記錄事件數、分區數，全部事件處理完時記錄耗時"""
+    __slots__ = ['received', 'event_count', 'partitions', 'remaining', 'lock']
+    
+    def __init__(self, event_count):
+        self.received = time.perf_counter()
+        self.event_count = event_count
+        self.partitions = 0
+        self.remaining = event_count
+        self.lock = threading.Lock()
+    
+    def event_done(self):
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining != 0:
+                return
+        elapsed = time.perf_counter() - self.received
+        delivery_latency.observe(elapsed, mode=WEBHOOK_DISPATCH_MODE)
+        delivery_size.observe(self.event_count, mode=WEBHOOK_DISPATCH_MODE)
+        partitions = f" / {self.partitions} 個分區" if self.partitions else ""
+        log.info("⏱️ webhook 處理完成: %d 個事件%s, %.2fs", self.event_count, partitions, elapsed,
+                 extra={'fields': {'events': self.event_count, 'partitions': self.partitions, 'seconds': elapsed}})
+
+delivery_latency = Histogram('bot_webhook_delivery_seconds',
+                             'Time from receiving a webhook to finishing all of its events', ('mode',))
+delivery_size = Histogram('bot_webhook_delivery_events', 'Events per webhook delivery', ('mode',),
+                          buckets=(1, 2, 5, 10, 20, 50, 100))
+events_rejected = Counter('bot_events_rejected_total', 'Events rejected with 503 because the worker queue was full')
+
+def finish_event_delivery(event):
+    """事件處理完（或放棄）時通知所屬的 webhook，每個事件只計一次"""
+    delivery = getattr(event, '_delivery', None)
+    if delivery is not None:
+        event._delivery = None
+        delivery.event_done()
+
+def process_event(event):
+    """實際處理單一事件"""
+    start_log_context(event)
+    try:
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+            handle_message(event)
+    finally:
+        release_pending_report(event)
+        finish_event_delivery(event)
+        clear_log_context()
+
+def release_pending_report(event):
+    """事件處理完或被拒絕時，移除它留下的日報 Session key"""
+    user_id = getattr(event.source, 'user_id', None)
+    with pending_report_lock:
+        # 只有佇列中最新的日報處理完才移除
+        if user_id in pending_report_keys and pending_report_keys[user_id] == getattr(event, '_session_key', None):
+            del pending_report_keys[user_id]
+
+def event_worker(worker_queue):
+    """背景線程: 依序處理分配到的事件，預熱完成前先等待"""
+    warm_start_done.wait(WARM_START_WAIT_SECONDS)
+    while True:
+        event = worker_queue.get()
+        try:
+            process_event(event)
+        except Exception as e:
+            log.exception("❌ 事件處理失敗: %s", e)
+        finally:
+            worker_queue.task_done()
+
+def enqueue_event(event):
+    """將事件依 Session key 分配到固定的線程佇列
+    
+    佇列已滿時丟出 queue.Full，不在 webhook 線程同步處理（會插隊到同 Session 的事件前面，也會拖慢回應）
+    """
+    session_key = resolve_event_session_key(event)
+    event._session_key = session_key
+    worker_queue = event_queues[zlib.crc32(session_key.encode()) % EVENT_WORKER_COUNT]
+    try:
+        worker_queue.put_nowait(event)
+    except queue.Full:
+        release_pending_report(event)
+        raise
+
+def start_event_workers():
+    """啟動事件處理線程"""
+    for i, worker_queue in enumerate(event_queues):
+        threading.Thread(target=event_worker, args=(worker_queue,), daemon=True,
+                         name=f"event-worker-{i}").start()
+    log.info("✅ 已啟動 %d 個事件處理線程", EVENT_WORKER_COUNT)
+
+class PartitionedDispatcher:
+    """同一分區的事件依序處理，不同分區在線程池中同時處理
+    
+    分區正在處理時，之後的 webhook 帶來的同分區事件排在後面，不會插隊
+    """
+    
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.pool = None
+        self.pending = {}  # 分區 key -> 等待處理的事件
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+    
+    def submit(self, key, events):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='partition')
+            backlog = self.pending.get(key)
+            if backlog is not None:
+                backlog.extend(events)
+                return
+            self.pending[key] = deque(events)
+        self.pool.submit(self._drain, key)
+    
+    def _drain(self, key):
+        warm_start_done.wait(WARM_START_WAIT_SECONDS)
+        while True:
+            with self.lock:
+                backlog = self.pending[key]
+                if not backlog:
+                    del self.pending[key]
+                    if not self.pending:
+                        self.idle.notify_all()
+                    return
+                event = backlog.popleft()
+            try:
+                process_event(event)
+            except Exception as e:
+                log.exception("❌ 事件處理失敗: %s", e)
+    
+    def depth(self):
+        with self.lock:
+            return sum(len(backlog) for backlog in self.pending.values())
+    
+    def wait_idle(self, timeout=None):
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.pending, timeout)
+
+partitioned_dispatcher = PartitionedDispatcher(DISPATCH_POOL_SIZE)
+
+def dispatch_partitioned(events, delivery):
+    """依 Session key 分區，保留分區內的原始順序"""
+    partitions = {}
+    for event in events:
+        event._delivery = delivery
+        try:
+            session_key = resolve_event_session_key(event)
+        except Exception as e:
+            log.error("❌ 事件分區失敗: %s", e)
+            finish_event_delivery(event)
+            continue
+        event._session_key = session_key
+        partitions.setdefault(session_key, []).append(event)
+    delivery.partitions = len(partitions)
+    for session_key, partition_events in partitions.items():
+        partitioned_dispatcher.submit(session_key, partition_events)
+
+def get_event_queue_depth():
+    return sum(q.qsize() for q in event_queues) + partitioned_dispatcher.depth()
+
+def wait_for_events(timeout=None):
+    """等待兩種分派模式中已收到的事件都處理完"""
+    for worker_queue in event_queues:
+        worker_queue.join()
+    partitioned_dispatcher.wait_idle(timeout)
+
+Gauge('bot_event_queue_depth', 'Events waiting in worker queues', get_event_queue_depth)
+Gauge('bot_sessions', 'Sessions in the session store', lambda: session_store.count())
+Gauge('bot_dedup_entries', 'Event ids in the dedup table', lambda: dedup_store.size())
+Gauge('bot_outbox_pending', 'Sheet writes waiting in the outbox', get_outbox_size)
+Gauge('bot_outbox_dead', 'Sheet writes in the dead-letter table', get_outbox_dead_size)
+Gauge('bot_sheets_breaker_open', 'Whether the Sheets circuit breaker is open', lambda: int(sheets_breaker.is_open()))
+Gauge('bot_scheduler_leader', 'Whether this process runs scheduled jobs', lambda: int(scheduler_leader.is_leader()))
+
+def send_reply(event, reply_text):
+    """回覆訊息，reply token 過期或失效時改用 push"""
+    message = TextSendMessage(text=reply_text)
+    token_age = time.time() - event.timestamp / 1000
+    
+    if token_age < REPLY_TOKEN_TTL_SECONDS:
+        try:
+            line_bot_api.reply_message(event.reply_token, message)
+            return True
+        except LineBotApiError as e:
+            log.warning("⚠️ reply 失敗，改用 push: %s", e)
+    
+    source = event.source
+    target_id = (getattr(source, 'group_id', None) or getattr(source, 'room_id', None)
+                 or getattr(source, 'user_id', None))
+    if not target_id:
+        return False
+    line_bot_api.push_message(target_id, message)
+    return True
+
 # Webhook 處理
 @app.route("/callback", methods=['POST'])
 def callback():
+    """驗證簽章後立即回應 200，事件依 WEBHOOK_DISPATCH_MODE 交給背景線程處理"""
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     
     try:
-        handler.handle(body, signature)
-        return 'OK', 200
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         return 'Invalid signature', 403
     except Exception as e:
-        print(f"❌ Callback 錯誤: {e}")
+        log.error("❌ Callback 錯誤: %s", e)
         return 'Internal Server Error', 500
+    
+    delivery = WebhookDelivery(len(events))
+    if WEBHOOK_DISPATCH_MODE == 'partitioned':
+        dispatch_partitioned(events, delivery)
+        return 'OK', 200
+    
+    for index, event in enumerate(events):
+        event._delivery = delivery
+        try:
+            enqueue_event(event)
+        except queue.Full:
+            # 回 503 讓 LINE 重送整個 webhook，已排入的事件重送時由去重略過；
+            # 之後的事件也不排入，重送時才會依原本順序處理
+            rejected = events[index:]
+            events_rejected.inc(len(rejected))
+            log.warning("⚠️ 事件佇列已滿，回 503 讓 LINE 重送 %d 個事件", len(rejected))
+            for rejected_event in rejected:
+                rejected_event._delivery = delivery
+                finish_event_delivery(rejected_event)
+            return 'Service Unavailable', 503
+        except Exception as e:
+            log.error("❌ 事件排入佇列失敗: %s", e)
+            finish_event_delivery(event)
+    return 'OK', 200
 
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
+    started = time.perf_counter()
+    command = "unknown"
+    user_id = ""
+    message_text = ""
     try:
         user_id = event.source.user_id
         message_text = event.message.text.strip()
@@ -564,47 +3909,50 @@ def handle_message(event):
             timestamp, tz=datetime.timezone(datetime.timedelta(hours=8))
         )
         
-        print(f"\n[訊息] User: {user_id[-8:]}, Text: {message_text[:30]}, Time: {message_time.strftime('%H:%M')}")
+        log.debug("[訊息] User: %s, Text: %s, Time: %s", user_id[-8:], message_text[:30], message_time.strftime('%H:%M'))
         
         # 權限檢查
         user_role = get_user_role(user_id)
         if not user_role:
-            print(f"[拒絕] 無權限用戶")
+            command = "rejected"
+            log.debug("[拒絕] 無權限用戶")
             return
 
         # 重複檢查
-        if is_duplicate_message(user_id, message_text, timestamp):
-            print(f"[重複] 已處理過")
+        if is_duplicate_message(event):
+            command = "duplicate"
+            log.debug("[重複] 已處理過")
             return
         
         reply_text = None
+        route = getattr(event, '_route', None) or route_command(message_text, user_role)
+        command, parsed = route
         
         # === 完整日報 ===
-        if re.search(r"\d{3}/\d{2}/\d{2}", message_text) and any(char in message_text for char in ["人員", "出工"]):
-            print("📝 處理日報")
-            report_data = parse_full_attendance_report(message_text)
+        if command == "report":
+            log.debug("📝 處理日報")
+            report_data = parsed
             if report_data:
-                print(f"[解析] 日期: {report_data['date']}, 專案: {report_data['project_name']}, 人數: {len(report_data['staff'])}")
+                log.debug("[解析] 日期: %s, 專案: %s, 人數: %d",
+                          report_data['date'], report_data['project_name'], len(report_data['staff']))
                 session = get_or_create_session(report_data['date'], report_data['project_name'], user_id)
                 session.project_name = report_data['project_name']
                 
-                success_count = 0
-                for staff in report_data['staff']:
-                    if session.add_staff_and_write(staff['name'], staff['note'], message_time):
-                        success_count += 1
+                added_names = session.add_staff_batch(report_data['staff'], message_time)
+                success_count = len(added_names)
                 
-                print(f"[Session] 已建立 Key: {report_data['date']}_{report_data['project_name']}")
-                print(f"[寫入] 成功: {success_count}/{len(report_data['staff'])}")
+                log.debug("[Session] 已建立 Key: %s", session.key)
+                log.debug("[寫入] 成功: %d/%d", success_count, len(report_data['staff']))
                 
                 reply_text = f"✅ 已記錄 {success_count} 人\n專案: {report_data['project_name'][:20]}...\n日期: {report_data['date']}"
             else:
-                print("[解析失敗] 無法解析日報")
+                log.warning("[解析失敗] 無法解析日報")
                 reply_text = "❌ 日報格式錯誤"
         
         # === 新增人員 ===
-        elif "新增" in message_text:
-            print("➕ 新增人員")
-            staff_info = parse_add_staff(message_text)
+        elif command == "add_staff":
+            log.debug("➕ 新增人員")
+            staff_info = parsed
             if staff_info:
                 valid_session = find_session_for_user(user_id, staff_info.get('project'))
                 if valid_session:
@@ -616,126 +3964,165 @@ def handle_message(event):
                     reply_text = f"❌ 找不到專案「{staff_info['project']}」"
                 else:
                     # 多專案情況
-                    active_projects = [s.project_name for s in session_states.values() 
-                                     if can_access_session(user_id, s) and s.project_name]
-                    if len(set(active_projects)) > 1:
-                        reply_text = f"⚠️ 有多個專案，請用: 新增：名字@專案名稱\n可用: {', '.join(set(active_projects)[:3])}"
+                    active_projects = sorted({s.project_name for s in get_accessible_sessions(user_id)
+                                              if s.project_name})
+                    if len(active_projects) > 1:
+                        reply_text = f"⚠️ 有多個專案，請用: 新增：名字@專案名稱\n可用: {', '.join(active_projects[:3])}"
                     else:
                         reply_text = "❌ 請先提交完整日報"
         
         # === 單筆離場 ===
-        elif ("離場:" in message_text or "離場：" in message_text or 
-              "下班:" in message_text or "下班：" in message_text):
-            print("🚶 單筆離場")
-            checkout_info = parse_checkout_staff(message_text)
+        elif command == "checkout":
+            log.debug("🚶 單筆離場")
+            checkout_info = parsed
             if checkout_info:
                 valid_session = find_session_for_user(user_id, checkout_info.get('project'))
                 if valid_session:
-                    person_data = next((p for p in valid_session.staff if p['name'] == checkout_info['name']), None)
+                    person_data = valid_session.staff.get(checkout_info['name'])
                     if person_data:
-                        if update_person_checkout(valid_session.work_date, checkout_info['name'], 
-                                                 message_time, person_data['add_time']):
-                            reply_text = f"✅ {checkout_info['name']} 已離場 ({message_time.strftime('%H:%M')})"
+                        # 以名單上的姓名寫入，與簽到列一致
+                        with get_session_lock(valid_session.key):
+                            updated = update_person_checkout(valid_session.work_date, person_data.name,
+                                                             message_time, person_data.add_time,
+                                                             valid_session.project_name, person_data.note)
+                        if updated:
+                            reply_text = f"✅ {person_data.name} 已離場 ({message_time.strftime('%H:%M')})"
                         else:
                             reply_text = f"⚠️ 更新失敗，可能已記錄過"
                     else:
                         reply_text = f"❌ 找不到 {checkout_info['name']} 的簽到記錄"
+                        suggestions = valid_session.staff.suggest(checkout_info['name'])
+                        if suggestions:
+                            reply_text += f"\n是不是: {'、'.join(suggestions)}？請用: 離場：{suggestions[0]}"
                 elif checkout_info.get('project'):
                     reply_text = f"❌ 找不到專案「{checkout_info['project']}」"
                 else:
                     reply_text = "❌ 請指定專案名稱"
         
         # === 通用離場 ===
-        elif "人員離場" in message_text or "人員下班" in message_text:
-            print("⬜ 全員離場")
-            project_match = re.search(r"@(.+?)$", message_text)
-            project_name = project_match.group(1).strip() if project_match else None
+        elif command == "crew_checkout":
+            log.debug("⬜ 全員離場")
+            project_name = parsed['project']
             valid_session = find_session_for_user(user_id, project_name)
             
             if valid_session and valid_session.staff:
                 default_checkout_time = message_time.replace(hour=16, minute=50, second=0, microsecond=0)
-                count = 0
-                for person in valid_session.staff:
-                    if update_person_checkout(valid_session.work_date, person['name'], 
-                                            default_checkout_time, person['add_time']):
-                        count += 1
-                reply_text = f"✅ 已記錄 {count} 人離場 (預設 16:50)\n專案: {valid_session.project_name}"
+                with get_session_lock(valid_session.key):
+                    updated_names, closed_names, failed_names = bulk_update_checkout(
+                        valid_session.work_date, list(valid_session.staff), default_checkout_time,
+                        valid_session.project_name
+                    )
+                reply_text = f"✅ 已記錄 {len(updated_names)} 人離場 (預設 16:50)\n專案: {valid_session.project_name}"
+                if closed_names:
+                    reply_text += f"\nℹ️ 已離場 {len(closed_names)} 人"
+                if failed_names:
+                    reply_text += f"\n⚠️ 未完成 {len(failed_names)} 人: {', '.join(failed_names[:5])}"
             elif project_name:
                 reply_text = f"❌ 找不到專案「{project_name}」"
             else:
-                active_projects = [s.project_name for s in session_states.values() 
-                                 if can_access_session(user_id, s) and s.project_name]
-                if len(set(active_projects)) > 1:
+                active_projects = {s.project_name for s in get_accessible_sessions(user_id)
+                                   if s.project_name}
+                if len(active_projects) > 1:
                     reply_text = f"⚠️ 有多個專案，請用: 人員離場@專案名稱"
                 else:
                     reply_text = "❌ 找不到有效的日報記錄"
         
         # === 查詢出勤 ===
-        elif message_text == "查詢本期出勤":
-            print("📊 查詢出勤")
-            if attendance_sheet:
+        elif command == "period_query":
+            log.debug("📊 查詢出勤")
+            try:
+                start_date, end_date = get_pay_period(date.today())
+                totals = get_period_totals(date.today())
+                if totals:
+                    reply_text = f"📅 本期 ({start_date.strftime('%m/%d')}-{end_date.strftime('%m/%d')}) 統計：\n"
+                    for person_name, days in totals:
+                        reply_text += f"• {person_name}: {days} 天\n"
+                else:
+                    reply_text = "本期無出勤記錄"
+            except Exception as e:
+                reply_text = f"❌ 查詢失敗: {str(e)[:50]}"
+                log.error("查詢錯誤: %s", e)
+        
+        # === 重新整理出勤總計 ===
+        elif command == "period_refresh":
+            if attendance_repo.is_available():
                 try:
-                    today = date.today()
-                    if today.day <= 5:
-                        start_date = (today.replace(day=1) - timedelta(days=1)).replace(day=21)
-                        end_date = today.replace(day=5)
-                    elif today.day <= 20:
-                        start_date = today.replace(day=6)
-                        end_date = today.replace(day=20)
-                    else:
-                        start_date = today.replace(day=21)
-                        next_month = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
-                        end_date = next_month.replace(day=5)
-                    
-                    records = attendance_sheet.get_all_records()
-                    if records:
-                        df = pd.DataFrame(records)
-                        df['日期'] = pd.to_datetime(df['日期'].apply(minguo_to_gregorian), errors='coerce')
-                        
-                        period_df = df.dropna(subset=['日期'])
-                        period_df = period_df[
-                            (period_df['日期'] >= pd.to_datetime(start_date)) &
-                            (period_df['日期'] <= pd.to_datetime(end_date))
-                        ]
-                        
-                        if not period_df.empty:
-                            period_df['出勤時數'] = pd.to_numeric(period_df['出勤時數'], errors='coerce')
-                            summary = period_df.groupby('姓名')['出勤時數'].sum().reset_index()
-                            reply_text = f"📅 本期 ({start_date.strftime('%m/%d')}-{end_date.strftime('%m/%d')}) 統計：\n"
-                            for _, row in summary.iterrows():
-                                reply_text += f"• {row['姓名']}: {row['出勤時數']} 天\n"
-                        else:
-                            reply_text = "本期無出勤記錄"
-                    else:
-                        reply_text = "試算表無資料"
+                    if sheets_outbox_enabled():
+                        flush_outbox()
+                    attendance_repo.refresh(full=True)
+                    count = rebuild_period_totals()
+                    reply_text = f"✅ 已重新整理出勤總計 ({count} 筆)"
                 except Exception as e:
-                    reply_text = f"❌ 查詢失敗: {str(e)[:50]}"
-                    print(f"查詢錯誤: {e}")
+                    reply_text = f"❌ 重新整理失敗: {str(e)[:50]}"
             else:
                 reply_text = "❌ Google Sheets 未連線"
         
         # === 系統狀態查詢 ===
-        elif message_text == "系統狀態" and user_role == "ADMIN":
+        elif command == "status":
             reply_text = f"📊 系統狀態\n"
-            reply_text += f"Session 數: {len(session_states)}\n"
-            reply_text += f"今日專案: {len([s for s in session_states.values() if s.work_date == date.today().strftime('%Y/%m/%d')])}"
+            today = date.today()
+            today_str = f"{today.year - 1911:03d}/{today.month:02d}/{today.day:02d}"
+            reply_text += f"Session 數: {session_store.count()}\n"
+            reply_text += f"今日專案: {len(session_store.find(work_date=today_str))}"
+            for job, run in get_job_status().items():
+                reply_text += f"\n{job}: {run['status']} {run['started'][5:16]}"
+                if run['duration'] is not None:
+                    reply_text += f" ({run['duration']}s, {run['rows'] if run['rows'] is not None else '-'} 筆)"
         
         # === 發送回覆 ===
         if reply_text:
             try:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-                print(f"✅ 已回覆: {reply_text[:30]}")
+                if send_reply(event, reply_text):
+                    log.debug("✅ 已回覆: %s", reply_text[:30])
             except Exception as e:
-                print(f"❌ 回覆失敗: {e}")
+                log.error("❌ 回覆失敗: %s", e)
         else:
             # 即使沒有處理，也不回覆（避免 reply token 錯誤）
-            print(f"⚠️ 未識別的指令，不回覆")
+            log.debug("⚠️ 未識別的指令，不回覆")
         
     except Exception as e:
-        print(f"❌ 處理錯誤: {e}")
+        log.exception("❌ 處理錯誤: %s", e)
         # 發生錯誤時不要嘗試回覆，避免 Invalid reply token
+    finally:
+        elapsed = time.perf_counter() - started
+        command_latency.observe(elapsed, command=command)
+        # 每則訊息一筆 INFO 記錄（訊息內容只在 DEBUG 記錄），其餘流程細節為 DEBUG
+        log.info("[訊息] %s User: %s, %.3fs", command, user_id[-8:], elapsed,
+                 extra={'fields': {'command': command, 'user': user_id[-8:], 'seconds': elapsed}})
+
+# [優化] 背景服務延後到第一個請求才啟動: 事件線程、outbox、排程、keep-alive，
+# Sheets 連線與預熱在背景線程進行，載入模組時不必等待 Google
+background_started = False
+background_lock = threading.Lock()
+
+def start_background_services():
+    """啟動背景線程與排程（只執行一次），並在背景連線 Sheets 與預熱"""
+    global background_started
+    if background_started:
+        return
+    with background_lock:
+        if background_started:
+            return
+        step = time.perf_counter()
+        # partitioned 模式由 PartitionedDispatcher 的線程池處理，不需要佇列線程
+        if WEBHOOK_DISPATCH_MODE != 'partitioned':
+            start_event_workers()
+        outbox_thread.start()
+        keep_alive_thread.start()
+        sheets_maintenance_thread.start()
+        scheduler_leader_thread.start()
+        threading.Thread(target=warm_start, daemon=True, name='warm-start').start()
+        background_started = True
+    log.info("🚀 背景服務已啟動 (%.2fs)，Sheets 連線與預熱在背景進行", time.perf_counter() - step)
+
+@app.before_request
+def ensure_background_services():
+    start_background_services()
+
+log.info("🚀 模組載入完成: 函式庫 %.2fs, 初始化 %.2fs",
+         STARTUP_IMPORTS_DONE - STARTUP_STARTED, time.perf_counter() - STARTUP_IMPORTS_DONE)
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
-    print(f"🚀 啟動伺服器 port {port}")
+    log.info("🚀 啟動伺服器 port %s", port)
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,300 @@
+# --- LINE 聊天記錄補登 ---
+# 把 LINE 匯出的聊天記錄 (.txt) 中的日報、新增、離場重新整理成出勤列，整批寫入出勤後端
+# 用法:
+#   python backfill.py 匯出檔.txt              # 依 ATTENDANCE_BACKEND 寫入，進度存在 匯出檔.txt.checkpoint
+#   python backfill.py 匯出檔.txt --dry-run    # 只解析與統計，不寫入
+#   python backfill.py 匯出檔.txt --restart    # 忽略之前的進度，從頭開始
+#
+# 檔案逐行讀取，記憶體中只保留當天的 Session 與尚未寫出的一批出勤列；
+# 每批寫入成功後才記錄進度（下一個日期標題在檔案中的位置），中斷後重新執行會從該處繼續
+import os
+import re
+import sys
+import json
+import time
+import datetime
+import argparse
+
+import app
+
+BACKFILL_BATCH_ROWS = int(os.environ.get('BACKFILL_BATCH_ROWS', 500))  # 每次寫入的列數
+BACKFILL_MAX_RETRIES = 5  # 單批寫入失敗的重試次數
+TAIPEI_TZ = datetime.timezone(datetime.timedelta(hours=8))
+
+# 日期標題: 2024/10/16（三）、2024/10/16 (Wed)、2024.10.16 星期三
+DAY_HEADER_PATTERN = re.compile(r'^(\d{4})[/.](\d{1,2})[/.](\d{1,2})(?:\s*[（(]?\S*[)）]?)?\s*$')
+# 訊息: 時間<TAB>發送者<TAB>內容；中文版時間可能帶 上午/下午
+MESSAGE_PATTERN = re.compile(r'^(上午|下午)?(\d{1,2}):(\d{2})\t([^\t]*)(?:\t(.*))?$')
+
+def unquote_message(text):
+    """多行訊息在匯出檔中以雙引號包住，內部的 " 寫成 \"\" """
+    if len(text) >= 2 and text.startswith('"') and text.endswith('"'):
+        return text[1:-1].replace('""', '"')
+    return text
+
+def closes_quote(text):
+    """結尾連續的 " 為奇數個時，最後一個是結束引號"""
+    return (len(text) - len(text.rstrip('"'))) % 2 == 1
+
+def read_export(path, offset=0):
+    """逐行讀取匯出檔
+
+    產生 ("day", 日期, 該行位置) 與 ("message", 時間, 發送者, 內容)；
+    以雙引號開頭的多行訊息在引號結束前，不會把內容中的日期或時間誤判為新的一行
+    """
+    current_day = None
+    message = None  # [時間, 發送者, 內容行]
+    in_quote = False
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        position = offset
+        for raw in f:
+            line_start = position
+            position += len(raw)
+            line = raw.decode('utf-8-sig' if line_start == 0 else 'utf-8', errors='replace').rstrip('\r\n')
+
+            if in_quote:
+                message[2].append(line)
+                in_quote = not closes_quote(line)
+                continue
+
+            day_match = DAY_HEADER_PATTERN.match(line)
+            if day_match:
+                if message:
+                    yield ("message", message[0], message[1], unquote_message("\n".join(message[2])))
+                    message = None
+                current_day = datetime.date(*(int(g) for g in day_match.groups()))
+                yield ("day", current_day, line_start)
+                continue
+
+            message_match = MESSAGE_PATTERN.match(line)
+            if message_match and current_day:
+                if message:
+                    yield ("message", message[0], message[1], unquote_message("\n".join(message[2])))
+                half, hour, minute, sender, text = message_match.groups()
+                hour = int(hour) % 12 + 12 if half == '下午' else (int(hour) % 12 if half == '上午' else int(hour))
+                message_time = datetime.datetime(current_day.year, current_day.month, current_day.day,
+                                                 hour, int(minute), tzinfo=TAIPEI_TZ)
+                text = text or ""
+                message = [message_time, sender, [text]]
+                in_quote = text.startswith('"') and not closes_quote(text[1:])
+            elif message:
+                message[2].append(line)
+    if message:
+        yield ("message", message[0], message[1], unquote_message("\n".join(message[2])))
+
+class BackfillDay:
+    """一天聊天記錄的 Session 與離場狀態，規則與 handle_message 相同"""
+
+    def __init__(self, day):
+        self.day_str = app.to_minguo_str(day)
+        self.sessions = {}  # session key -> DailySession
+        self.name_index = app.ProjectNameIndex()
+        self.checkouts = {}  # (session key, 姓名) -> (離場時間, 天數, 備註)
+        self.stats = {"report": 0, "add_staff": 0, "checkout": 0, "crew_checkout": 0, "skipped": 0}
+
+    def _find_session(self, sender, project_name):
+        """指定專案時依名稱比對當天的 Session；未指定時取該發送者最近的，沒有則取當天最近的"""
+        if project_name:
+            for keys in self.name_index.match(self.day_str, project_name):
+                if keys:
+                    return min((self.sessions[k] for k in keys), key=lambda s: s.created_time)
+            return None
+        candidates = [s for s in self.sessions.values() if s.work_date == self.day_str]
+        own = [s for s in candidates if s.is_authorized(sender)]
+        if own or candidates:
+            return max(own or candidates, key=lambda s: s.created_time)
+        return None
+
+    def _checkout(self, session, record, checkout_time):
+        key = (session.key, record.name)
+        if key in self.checkouts:
+            return False
+        days, remark = app.calculate_attendance_days(record.add_time, checkout_time)
+        self.checkouts[key] = (checkout_time, days, remark)
+        return True
+
+    def handle(self, message_time, sender, text):
+        command, parsed = app.route_command(text.strip(), "ADMIN")
+        if command in ("report", "add_staff", "checkout") and not parsed:
+            self.stats["skipped"] += 1
+            return
+
+        if command == "report":
+            session_key = app.make_session_key(parsed['date'], parsed['project_name'])
+            session = self.sessions.get(session_key)
+            if session is None:
+                session = app.DailySession(parsed['date'], parsed['project_name'])
+                session.created_time = message_time
+                self.sessions[session_key] = session
+                self.name_index.add(session_key, parsed['date'], parsed['project_name'])
+            session.add_authorized_user(sender)
+            for person in parsed['staff']:
+                if person['name']:
+                    session.staff.add(person['name'], message_time, person['note'])
+        elif command == "add_staff":
+            session = self._find_session(sender, parsed.get('project'))
+            if session is None:
+                self.stats["skipped"] += 1
+                return
+            session.staff.add(parsed['name'], message_time, parsed['note'])
+        elif command == "checkout":
+            session = self._find_session(sender, parsed.get('project'))
+            record = session.staff.get(parsed['name']) if session else None
+            if record is None:
+                self.stats["skipped"] += 1
+                return
+            self._checkout(session, record, message_time)
+        elif command == "crew_checkout":
+            session = self._find_session(sender, parsed['project'])
+            if session is None:
+                self.stats["skipped"] += 1
+                return
+            default_checkout_time = message_time.replace(hour=16, minute=50, second=0, microsecond=0)
+            for record in session.staff:
+                self._checkout(session, record, default_checkout_time)
+        else:
+            return
+        self.stats[command] += 1
+
+    def rows(self, update_time):
+        """依 Session 建立順序產生試算表格式的出勤列"""
+        rows = []
+        for session in sorted(self.sessions.values(), key=lambda s: s.created_time):
+            for record in session.staff:
+                row = app.build_sign_in_row(session.work_date, session.project_name, record.name,
+                                            record.add_time, record.note, update_time)
+                checkout = self.checkouts.get((session.key, record.name))
+                if checkout:
+                    checkout_time, days, remark = checkout
+                    row[3:6] = [checkout_time.strftime('%H:%M'), days,
+                                app.build_attendance_note(session.project_name, record.note, remark)]
+                rows.append(row)
+        return rows
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {"offset": 0, "days": 0, "rows": 0}
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    """先寫暫存檔再改名，中斷時不會留下寫一半的進度"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def backfill_row_key(work_date, project_name, person_name):
+    """補登去重的 key: (民國日期, 專案, 正規化姓名)"""
+    work_date, person_key = app.attendance_index_key(work_date, person_name)
+    return work_date, project_name or None, person_key
+
+def existing_row_keys(rows):
+    """出勤後端中與這批列同一日期範圍、已存在的 key"""
+    days = [day for day in (app.minguo_to_gregorian(row[0]) for row in rows) if day]
+    if not days:
+        return set()
+    # 先送出 outbox 並同步，讀到的資料才包含之前寫入的批次
+    if app.sheets_outbox_enabled():
+        app.flush_outbox()
+    app.attendance_repo.refresh()
+    return {
+        backfill_row_key(work_date, project_name, person_name)
+        for work_date, person_name, _, _, _, project_name in app.attendance_repo.query_range(min(days), max(days))
+    }
+
+def drop_existing_rows(rows):
+    """略過後端已有的列（中斷後重跑、匯出檔重疊），同一批中重複的列也只留第一筆"""
+    seen = existing_row_keys(rows)
+    fresh_rows = []
+    for row in rows:
+        key = backfill_row_key(row[0], app.note_project(row[5]), row[1])
+        if key in seen:
+            continue
+        seen.add(key)
+        fresh_rows.append(row)
+    return fresh_rows
+
+def write_batch(rows):
+    """寫入一批出勤列，略過已存在的列，暫時性錯誤以指數退避重試；回傳實際寫入的列數"""
+    for attempt in range(BACKFILL_MAX_RETRIES + 1):
+        try:
+            fresh_rows = drop_existing_rows(rows)
+            if fresh_rows:
+                app.attendance_repo.append_rows(fresh_rows)
+            return len(fresh_rows)
+        except Exception as e:
+            if attempt == BACKFILL_MAX_RETRIES:
+                raise
+            wait = min(2 ** attempt, 60)
+            print(f"⚠️ 寫入失敗，{wait}s 後重試 ({attempt + 1}/{BACKFILL_MAX_RETRIES}): {e}")
+            time.sleep(wait)
+
+def run_backfill(path, dry_run=False, restart=False, batch_rows=BACKFILL_BATCH_ROWS):
+    checkpoint_path = path + ".checkpoint"
+    checkpoint = {"offset": 0, "days": 0, "rows": 0} if restart else load_checkpoint(checkpoint_path)
+    if checkpoint["offset"]:
+        print(f"↪️ 從上次進度繼續: 已完成 {checkpoint['days']} 天、{checkpoint['rows']} 列")
+
+    if not dry_run and not app.attendance_repo.is_available():
+        print("❌ 出勤後端無法使用")
+        return 1
+
+    started = time.perf_counter()
+    totals = {"report": 0, "add_staff": 0, "checkout": 0, "crew_checkout": 0, "skipped": 0, "duplicate": 0}
+    pending_rows = []
+    current = None
+
+    def finish_day(next_offset):
+        """當天結束: 產生出勤列，累積到一批就寫出並記錄進度"""
+        nonlocal current
+        if current is not None:
+            pending_rows.extend(current.rows(app.now_taipei_str()))
+            for name, count in current.stats.items():
+                totals[name] += count
+            checkpoint["days"] += 1
+            current = None
+        if pending_rows and (len(pending_rows) >= batch_rows or next_offset is None):
+            written = len(pending_rows)
+            if not dry_run:
+                written = write_batch(pending_rows)
+                totals["duplicate"] += len(pending_rows) - written
+            checkpoint["rows"] += written
+            pending_rows.clear()
+            checkpoint["offset"] = next_offset if next_offset is not None else os.path.getsize(path)
+            if not dry_run:
+                save_checkpoint(checkpoint_path, checkpoint)
+            elapsed = time.perf_counter() - started
+            print(f"📦 {'已解析' if dry_run else '已寫入'} {checkpoint['days']} 天、{checkpoint['rows']} 列 ({elapsed:.1f}s)")
+
+    for item in read_export(path, checkpoint["offset"]):
+        if item[0] == "day":
+            finish_day(item[2])
+            current = BackfillDay(item[1])
+        elif current is not None:
+            _, message_time, sender, text = item
+            current.handle(message_time, sender, text)
+    finish_day(None)
+
+    print(f"✅ 補登完成: {checkpoint['days']} 天、{checkpoint['rows']} 列 "
+          f"(日報 {totals['report']}、新增 {totals['add_staff']}、離場 {totals['checkout']}、"
+          f"全員離場 {totals['crew_checkout']}、略過 {totals['skipped']}、已存在 {totals['duplicate']})")
+    if not dry_run:
+        if app.sheets_outbox_enabled():
+            app.flush_outbox()
+        app.attendance_repo.refresh()
+        app.rebuild_period_totals()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="由 LINE 聊天記錄匯出檔補登出勤")
+    parser.add_argument('file', help="LINE 匯出的聊天記錄 .txt")
+    parser.add_argument('--dry-run', action='store_true', help="只解析與統計，不寫入")
+    parser.add_argument('--restart', action='store_true', help="忽略之前的進度，從頭開始")
+    parser.add_argument('--batch-rows', type=int, default=BACKFILL_BATCH_ROWS, help="每次寫入的列數")
+    args = parser.parse_args()
+    return run_backfill(args.file, args.dry_run, args.restart, args.batch_rows)
+
+if __name__ == "__main__":
+    sys.exit(main())
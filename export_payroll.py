@@ -0,0 +1,56 @@
+# --- 薪資匯出 ---
+# 與 /export/attendance 相同的內容，直接由本機出勤資料產生
+# 用法:
+#   python export_payroll.py --start 2024-01-01 --end 2024-12-31                 # 明細 CSV 輸出到 stdout
+#   python export_payroll.py --start 113/01/01 --view person -o person.csv       # 人員合計
+#   python export_payroll.py --start 2024-01-01 --format xlsx -o payroll.xlsx    # 明細 + 人員 + 專案三個工作表（需 openpyxl）
+import sys
+import argparse
+
+# app 的執行記錄改輸出到 stderr，stdout 只放 CSV
+csv_stdout = sys.stdout.buffer
+sys.stdout = sys.stderr
+
+import app
+
+def main():
+    parser = argparse.ArgumentParser(description="匯出出勤明細與合計")
+    parser.add_argument('--start', help="起日（2024-01-31 或 113/01/31），預設為本期起日")
+    parser.add_argument('--end', help="迄日，預設為今天")
+    parser.add_argument('--view', choices=sorted(app.PAYROLL_HEADERS), default='detail', help="CSV 內容")
+    parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+    parser.add_argument('-o', '--output', help="輸出檔案，CSV 未指定時輸出到 stdout")
+    parser.add_argument('--no-refresh', action='store_true', help="不先同步試算表，直接使用本機資料")
+    args = parser.parse_args()
+
+    try:
+        first_day, last_day = app.parse_export_range(args.start, args.end)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.format == 'xlsx':
+        if not args.output:
+            parser.error("XLSX 需指定 --output")
+        if not app.xlsx_export_available():
+            print("❌ 未安裝 openpyxl，無法匯出 XLSX")
+            return 1
+
+    if not args.no_refresh:
+        app.refresh_attendance_for_export()
+
+    if args.format == 'xlsx':
+        with open(args.output, 'wb') as f:
+            app.write_payroll_xlsx(first_day, last_day, f)
+    else:
+        out = open(args.output, 'wb') if args.output else csv_stdout
+        try:
+            for chunk in app.stream_payroll_csv(first_day, last_day, args.view):
+                out.write(chunk)
+        finally:
+            if args.output:
+                out.close()
+    if args.output:
+        print(f"✅ 已匯出 {first_day} ~ {last_day}: {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,489 @@
+# --- Webhook 重播 / 壓力測試 ---
+# 完全離線: LINE API 與 Google Sheets 都換成本機模擬，可設定延遲、失敗率與每分鐘配額
+# 用法:
+#   python replay_harness.py --crews 50                  # 模擬 50 組工班早上同時回報
+#   python replay_harness.py --crews 50 --record a.jsonl # 同時把產生的 webhook body 存下來
+#   python replay_harness.py --replay a.jsonl            # 重播 webhook body（每行一個 JSON）
+#   python replay_harness.py --sheets-latency 0.3 --sheets-failure-rate 0.05 --sheets-quota 60
+import os
+import sys
+import io
+import re
+import json
+import time
+import hmac
+import base64
+import random
+import hashlib
+import argparse
+import tempfile
+import itertools
+import threading
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 匯入 app 前先給假的設定，不連 LINE / Google Sheets，本機狀態寫到暫存目錄（程序結束時刪除）
+_harness_tmp = tempfile.TemporaryDirectory(prefix="replay_harness_", ignore_cleanup_errors=True)
+HARNESS_DIR = _harness_tmp.name
+os.environ.setdefault('YOUR_CHANNEL_ACCESS_TOKEN', 'harness')
+os.environ.setdefault('YOUR_CHANNEL_SECRET', 'harness-secret')
+os.environ.setdefault('LOCAL_DB_PATH', os.path.join(HARNESS_DIR, 'bot_state.db'))
+os.environ.setdefault('ATTENDANCE_ARCHIVE_DIR', os.path.join(HARNESS_DIR, 'attendance_archive'))
+os.environ.setdefault('RENDER_URL', 'http://127.0.0.1:9')
+os.environ.pop('GOOGLE_SHEETS_CREDENTIALS', None)
+
+import gspread
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app
+
+CHANNEL_SECRET = os.environ['YOUR_CHANNEL_SECRET']
+SURNAMES = "王李張劉陳楊黃趙吳周徐孫馬朱胡郭何林高羅"
+GIVEN = "小明志豪家豪建宏俊傑淑芬美玲雅婷怡君宗翰冠宇國華文雄"
+SITES = ["台北101", "新竹科學園區", "桃園機場", "台中港", "高雄捷運", "台南車站", "基隆港", "宜蘭國道"]
+
+def percentile(values, p):
+    """nearest-rank 百分位數"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+class FakeResponse:
+    """讓 gspread.exceptions.APIError 可以被建立的最小 response"""
+
+    def __init__(self, code, message, status):
+        self.status_code = code
+        self.text = message
+        self._payload = {'error': {'code': code, 'message': message, 'status': status}}
+
+    def json(self):
+        return self._payload
+
+class FakeSheetsBackend:
+    """所有模擬工作表共用的延遲、失敗率與每分鐘配額"""
+
+    def __init__(self, latency=0.0, failure_rate=0.0, quota_per_minute=0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.quota_per_minute = quota_per_minute
+        self.rng = random.Random(seed)
+        self.recent_calls = deque()
+        self.lock = threading.Lock()
+        self.rejected = {'quota': 0, 'failure': 0}
+
+    def call(self):
+        """每次 API 呼叫前執行: 模擬延遲，配額用完或隨機失敗時丟出 APIError"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            now = time.monotonic()
+            while self.recent_calls and now - self.recent_calls[0] >= 60:
+                self.recent_calls.popleft()
+            if self.quota_per_minute and len(self.recent_calls) >= self.quota_per_minute:
+                self.rejected['quota'] += 1
+                raise gspread.exceptions.APIError(FakeResponse(429, 'Quota exceeded (simulated)', 'RESOURCE_EXHAUSTED'))
+            self.recent_calls.append(now)
+            if self.rng.random() < self.failure_rate:
+                self.rejected['failure'] += 1
+                raise gspread.exceptions.APIError(FakeResponse(503, 'Service unavailable (simulated)', 'UNAVAILABLE'))
+
+class FakeWorksheet:
+    """記憶體中的工作表，支援 app 用到的 gspread 方法"""
+
+    RANGE_PATTERN = re.compile(r"^([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$")
+    ids = itertools.count(1)
+
+    def __init__(self, backend, title, headers):
+        self.backend = backend
+        self.id = next(self.ids)
+        self.title = title
+        self.rows = [list(headers)] if headers else []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _column(letters):
+        number = 0
+        for ch in letters:
+            number = number * 26 + ord(ch) - 64
+        return number
+
+    def _parse_range(self, range_name):
+        match = self.RANGE_PATTERN.match(range_name.split('!')[-1].replace('$', ''))
+        first_col = self._column(match.group(1))
+        last_col = self._column(match.group(3) or match.group(1))
+        first_row = int(match.group(2) or 1)
+        last_row = int(match.group(4)) if match.group(4) else None
+        return first_col, first_row, last_col, last_row
+
+    def get_values(self, range_name=None, value_render_option=None, **kwargs):
+        """預設與 Sheets API 相同回傳格式化後的文字；UNFORMATTED_VALUE 回傳存入的原始值"""
+        self.backend.call()
+        render = (lambda v: v) if value_render_option == 'UNFORMATTED_VALUE' else str
+        with self.lock:
+            if range_name is None:
+                return [[render(v) for v in row] for row in self.rows]
+            first_col, first_row, last_col, last_row = self._parse_range(range_name)
+            rows = self.rows[first_row - 1:last_row or len(self.rows)]
+            values = [[render(v) for v in (row + [''] * last_col)[first_col - 1:last_col]] for row in rows]
+        # 與 Sheets API 相同: 去掉每列尾端的空白儲存格
+        for row in values:
+            while row and row[-1] == '':
+                row.pop()
+        return values
+
+    def append_rows(self, values, **kwargs):
+        self.backend.call()
+        with self.lock:
+            start = len(self.rows) + 1
+            self.rows.extend(list(v) for v in values)
+            end = len(self.rows)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{start}:G{end}"}}
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def _write(self, range_name, values):
+        first_col, first_row, _, _ = self._parse_range(range_name)
+        for i, new_values in enumerate(values):
+            while len(self.rows) < first_row + i:
+                self.rows.append([])
+            row = self.rows[first_row - 1 + i]
+            row.extend([''] * (first_col - 1 + len(new_values) - len(row)))
+            row[first_col - 1:first_col - 1 + len(new_values)] = new_values
+
+    def batch_update(self, data, **kwargs):
+        self.backend.call()
+        with self.lock:
+            for item in data:
+                self._write(item['range'], item['values'])
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self.backend.call()
+        with self.lock:
+            self._write(range_name, values)
+
+class FakeSpreadsheet:
+    """記憶體中的試算表: 新增工作表與 deleteDimension 刪列（出勤表分區與移出）"""
+
+    def __init__(self, backend, *worksheets):
+        self.backend = backend
+        self.sheets = {sheet.title: sheet for sheet in worksheets}
+
+    def worksheets(self):
+        self.backend.call()
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        self.backend.call()
+        sheet = self.sheets[title] = FakeWorksheet(self.backend, title, None)
+        return sheet
+
+    def batch_update(self, body, **kwargs):
+        self.backend.call()
+        by_id = {sheet.id: sheet for sheet in self.sheets.values()}
+        for item in body['requests']:
+            target = item['deleteDimension']['range']
+            sheet = by_id[target['sheetId']]
+            with sheet.lock:
+                del sheet.rows[target['startIndex']:target['endIndex']]
+
+class FakeLineBotApi:
+    """取代 LineBotApi: 記錄回覆，可設定延遲與失敗率"""
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {'reply': 0, 'push': 0, 'failed': 0}
+
+    def _call(self, kind):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if self.rng.random() < self.failure_rate:
+                self.calls['failed'] += 1
+                raise LineBotApiError(500, {}, error=Error(message='Internal error (simulated)'))
+            self.calls[kind] += 1
+
+    def reply_message(self, reply_token, messages, **kwargs):
+        self._call('reply')
+
+    def push_message(self, to, messages, **kwargs):
+        self._call('push')
+
+class CompletionTracker:
+    """包住 app.process_event，記錄每個事件處理完成的時間與指令"""
+
+    def __init__(self):
+        self.posted = {}  # webhookEventId -> 送出 POST 的時間
+        self.done = []  # (指令, 送出到處理完成的秒數)
+        self.lock = threading.Lock()
+        self.original = app.process_event
+        app.process_event = self.process_event
+
+    def process_event(self, event):
+        try:
+            self.original(event)
+        finally:
+            finished = time.perf_counter()
+            route = getattr(event, '_route', None)
+            command = route[0] if route else type(event).__name__
+            with self.lock:
+                started = self.posted.get(getattr(event, 'webhook_event_id', None))
+                if started is not None:
+                    self.done.append((command, finished - started))
+
+    def take(self):
+        with self.lock:
+            done, self.done = self.done, []
+        return done
+
+def make_event(user_id, group_id, text, event_id, timestamp_ms=None):
+    return {
+        "type": "message", "mode": "active",
+        "timestamp": timestamp_ms or int(time.time() * 1000),
+        "source": {"type": "group", "groupId": group_id, "userId": user_id},
+        "webhookEventId": event_id,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"rt-{event_id}",
+        "message": {"id": event_id, "type": "text", "text": text},
+    }
+
+def generate_scenario(crews, seed):
+    """產生早上各工班的一天: 日報 -> 補人 -> 個別離場 -> 全員離場 -> 查詢
+
+    回傳 [(階段名稱, [webhook body, ...]), ...]
+    """
+    rng = random.Random(seed)
+    work_date = app.to_minguo_str(app.date.today())
+    used_names = set()
+    phases = {name: [] for name in ("report", "add_staff", "checkout", "crew_checkout", "period_query")}
+    counter = iter(range(1, 10 ** 9))
+
+    def new_name():
+        while True:
+            name = rng.choice(SURNAMES) + "".join(rng.sample(GIVEN, 2))
+            if name not in used_names:
+                used_names.add(name)
+                return name
+
+    def body(user_id, group_id, text):
+        event_id = f"H{next(counter):08d}"
+        return {"destination": "harness", "events": [make_event(user_id, group_id, text, event_id)]}
+
+    for crew in range(crews):
+        user_id = f"U{hashlib.md5(f'crew-{crew}'.encode()).hexdigest()}"
+        group_id = f"C{hashlib.md5(f'group-{crew}'.encode()).hexdigest()}"
+        if user_id not in app.MANAGER_USER_IDS:
+            app.MANAGER_USER_IDS.append(user_id)
+        project = f"{rng.choice(SITES)}第{crew + 1}工區"
+        staff = [new_name() for _ in range(rng.randint(5, 20))]
+        lines = [f"{work_date}", project, "出工人員："]
+        for i, name in enumerate(staff, 1):
+            note = f"({rng.choice(['半天', '借調', '14:00到'])})" if rng.random() < 0.15 else ""
+            lines.append(f"{i}.{name}{note}")
+        lines.append(f"共計：{len(staff)}人")
+        phases["report"].append(body(user_id, group_id, "\n".join(lines)))
+        phases["add_staff"].append(body(user_id, group_id, f"新增：{new_name()}@{project}"))
+        for name in rng.sample(staff, min(2, len(staff))):
+            phases["checkout"].append(body(user_id, group_id, f"離場：{name}@{project}"))
+        phases["crew_checkout"].append(body(user_id, group_id, f"人員離場@{project}"))
+        phases["period_query"].append(body(user_id, group_id, "查詢本期出勤"))
+    return list(phases.items())
+
+def merge_bodies(bodies, events_per_body):
+    """把多個 webhook body 合併，模擬一次傳送帶多個事件"""
+    if events_per_body <= 1:
+        return bodies
+    merged = []
+    for i in range(0, len(bodies), events_per_body):
+        group = bodies[i:i + events_per_body]
+        merged.append({"destination": group[0]["destination"],
+                       "events": [event for body in group for event in body["events"]]})
+    return merged
+
+def load_replay(path, rewrite_timestamps, grant_users):
+    """讀取 webhook body，連續相同指令類型的 body 歸為同一階段
+
+    grant_users 為 True 時，檔案中沒有權限的用戶一律視為 MANAGER
+    """
+    phases = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            body = json.loads(line)
+            kinds = set()
+            for event in body.get('events', []):
+                if rewrite_timestamps:
+                    event['timestamp'] = int(time.time() * 1000)
+                text = (event.get('message') or {}).get('text')
+                if text is None:
+                    kinds.add(event.get('type', 'unknown'))
+                else:
+                    user_id = (event.get('source') or {}).get('userId')
+                    if grant_users and user_id and not app.get_user_role(user_id):
+                        app.MANAGER_USER_IDS.append(user_id)
+                    role = app.get_user_role(user_id)
+                    kinds.add(app.route_command(text.strip(), role)[0])
+            label = "+".join(sorted(kinds)) or "empty"
+            if phases and phases[-1][0] == label:
+                phases[-1][1].append(body)
+            else:
+                phases.append((label, [body]))
+    return phases
+
+def sign(body_text):
+    digest = hmac.new(CHANNEL_SECRET.encode(), body_text.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+def sheets_call_counts():
+    with app.sheets_calls_total.lock:
+        return dict(app.sheets_calls_total.values)
+
+def wait_until_idle(drain_timeout):
+    """等事件佇列清空，再把 outbox 送完；回傳 outbox 是否已清空"""
+    app.wait_for_events()
+    deadline = time.monotonic() + drain_timeout
+    while app.get_outbox_size() and time.monotonic() < deadline:
+        if not app.flush_outbox():
+            time.sleep(0.2)
+    return app.get_outbox_size() == 0
+
+def run_phase(name, bodies, tracker, concurrency, drain_timeout):
+    clients = threading.local()
+    ack_latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def post(body):
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = app.app.test_client()
+        body_text = json.dumps(body, ensure_ascii=False)
+        started = time.perf_counter()
+        with tracker.lock:
+            for event in body.get('events', []):
+                tracker.posted[event.get('webhookEventId')] = started
+        response = client.post('/callback', data=body_text.encode('utf-8'),
+                               headers={'X-Line-Signature': sign(body_text), 'Content-Type': 'application/json'})
+        elapsed = time.perf_counter() - started
+        with lock:
+            ack_latencies.append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    calls_before = sheets_call_counts()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(post, bodies))
+    app.wait_for_events()
+    processed_at = time.perf_counter()
+    drained = wait_until_idle(drain_timeout)
+    drain_seconds = time.perf_counter() - processed_at
+    calls_after = sheets_call_counts()
+
+    done = tracker.take()
+    events = sum(len(body.get('events', [])) for body in bodies)
+    calls = {}
+    for key, value in calls_after.items():
+        delta = value - calls_before.get(key, 0)
+        if delta:
+            calls["/".join(key)] = delta
+    elapsed = processed_at - started
+    return {
+        'phase': name,
+        'events': events,
+        'processed': len(done),
+        'http_status': statuses,
+        'throughput_eps': len(done) / elapsed if elapsed > 0 else 0.0,
+        'ack_p50_ms': percentile(ack_latencies, 50) * 1000,
+        'ack_p99_ms': percentile(ack_latencies, 99) * 1000,
+        'e2e_p50_ms': percentile([d for _, d in done], 50) * 1000,
+        'e2e_p99_ms': percentile([d for _, d in done], 99) * 1000,
+        'sheets_calls': calls,
+        'sheets_calls_per_event': sum(calls.values()) / events if events else 0.0,
+        'outbox_drain_s': drain_seconds,
+        'outbox_drained': drained,
+    }
+
+def print_report(results, backend, line_api, real_stdout):
+    out = real_stdout
+    print(f"\n{'階段':<16}{'事件':>6}{'完成':>6}{'事件/秒':>10}{'ack p50':>10}{'ack p99':>10}"
+          f"{'e2e p50':>10}{'e2e p99':>10}{'Sheets/事件':>13}{'outbox':>10}", file=out)
+    for r in results:
+        drain = f"{r['outbox_drain_s']:.1f}s" + ("" if r['outbox_drained'] else "!")
+        print(f"{r['phase']:<16}{r['events']:>6}{r['processed']:>6}{r['throughput_eps']:>10.1f}"
+              f"{r['ack_p50_ms']:>8.1f}ms{r['ack_p99_ms']:>8.1f}ms{r['e2e_p50_ms']:>8.1f}ms{r['e2e_p99_ms']:>8.1f}ms"
+              f"{r['sheets_calls_per_event']:>13.2f}{drain:>10}", file=out)
+    print("\nSheets 呼叫 (方法/狀態):", file=out)
+    for r in results:
+        detail = ", ".join(f"{k}={v}" for k, v in sorted(r['sheets_calls'].items())) or "-"
+        print(f"  {r['phase']:<16}{detail}", file=out)
+    print(f"\n模擬 Sheets 拒絕: 配額 {backend.rejected['quota']}，失敗 {backend.rejected['failure']}", file=out)
+    print(f"模擬 LINE: reply {line_api.calls['reply']}，push {line_api.calls['push']}，失敗 {line_api.calls['failed']}", file=out)
+    print("（outbox 欄位後的 ! 表示時限內未送完）", file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description="離線 webhook 重播 / 壓力測試")
+    parser.add_argument('--crews', type=int, default=50, help="模擬的工班數")
+    parser.add_argument('--replay', help="重播檔案: 每行一個 webhook body JSON")
+    parser.add_argument('--keep-timestamps', action='store_true', help="重播時保留原本的事件時間")
+    parser.add_argument('--keep-roles', action='store_true', help="重播時不自動給予用戶 MANAGER 權限")
+    parser.add_argument('--record', help="把產生的 webhook body 存成可重播的檔案")
+    parser.add_argument('--concurrency', type=int, default=16, help="同時送出的 POST 數")
+    parser.add_argument('--dispatch', choices=['queue', 'partitioned'], default=app.WEBHOOK_DISPATCH_MODE,
+                        help="webhook 分派模式")
+    parser.add_argument('--events-per-body', type=int, default=1, help="產生情境時每個 webhook 帶幾個事件")
+    parser.add_argument('--seed', type=int, default=730)
+    parser.add_argument('--sheets-latency', type=float, default=0.15, help="每次 Sheets 呼叫的延遲（秒）")
+    parser.add_argument('--sheets-failure-rate', type=float, default=0.0)
+    parser.add_argument('--sheets-quota', type=int, default=60, help="每分鐘 Sheets 呼叫上限，0 為不限")
+    parser.add_argument('--line-latency', type=float, default=0.05, help="每次 LINE API 呼叫的延遲（秒）")
+    parser.add_argument('--line-failure-rate', type=float, default=0.0)
+    parser.add_argument('--drain-timeout', type=float, default=60, help="每階段等待 outbox 送完的上限（秒）")
+    parser.add_argument('--json', help="另存結果 JSON")
+    parser.add_argument('--verbose', action='store_true', help="顯示 app 的輸出")
+    args = parser.parse_args()
+
+    backend = FakeSheetsBackend(args.sheets_latency, args.sheets_failure_rate, args.sheets_quota, args.seed)
+    app.attendance_sheet = FakeWorksheet(backend, app.ATTENDANCE_SHEET_NAME,
+                                         ["日期", "姓名", "簽到時間", "離場時間", "出勤時數", "備註", "更新時間"])
+    app.summary_sheet = FakeWorksheet(backend, app.DAILY_SUMMARY_SHEET, ["統計日期", "姓名", "總出勤天數", "統計時間"])
+    app.spreadsheet = FakeSpreadsheet(backend, app.attendance_sheet, app.summary_sheet)
+    line_api = app.line_bot_api = FakeLineBotApi(args.line_latency, args.line_failure_rate, args.seed)
+    app.start_scheduler = lambda: None  # 每日統整排程不列入量測
+    app.WEBHOOK_DISPATCH_MODE = args.dispatch
+    tracker = CompletionTracker()
+
+    if args.replay:
+        phases = load_replay(args.replay, not args.keep_timestamps, not args.keep_roles)
+    else:
+        phases = [(name, merge_bodies(bodies, args.events_per_body))
+                  for name, bodies in generate_scenario(args.crews, args.seed)]
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            for _, bodies in phases:
+                for body in bodies:
+                    f.write(json.dumps(body, ensure_ascii=False) + "\n")
+
+    real_stdout = sys.stdout
+    results = []
+    for name, bodies in phases:
+        print(f"▶ {name}: {len(bodies)} 個 webhook", file=real_stdout)
+        sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with sink:
+            results.append(run_phase(name, bodies, tracker, args.concurrency, args.drain_timeout))
+
+    print_report(results, backend, line_api, real_stdout)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
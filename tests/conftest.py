@@ -0,0 +1,103 @@
+# 測試共用設定: 匯入 replay_harness 時會先給假的 LINE / Google 設定，本機狀態寫到暫存目錄
+import os
+import sys
+import time
+import types
+import itertools
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replay_harness import FakeSheetsBackend, FakeSpreadsheet, FakeWorksheet, app  # noqa: E402
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: 指令路由與解析的效能測試，可用 -m 'not benchmark' 略過")
+
+# 本機 SQLite 在整個測試期間共用，每個測試用不同的姓名與專案避免互相影響
+_name_counter = itertools.count()
+_event_counter = itertools.count()
+
+def unique_names(count, surname="測"):
+    """產生 count 個不重複的姓名"""
+    return [f"{surname}{chr(0x4E00 + next(_name_counter) % 0x5000)}{chr(0x4E00 + next(_name_counter) % 0x5000)}"
+            for _ in range(count)]
+
+class AttendanceBot:
+    """直接呼叫 handle_message，收集回覆"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.replies = []
+        self.user_id = app.ADMIN_USER_IDS[0]
+
+    def say(self, text):
+        event = types.SimpleNamespace(
+            source=types.SimpleNamespace(user_id=self.user_id),
+            message=types.SimpleNamespace(text=text),
+            timestamp=time.time() * 1000,
+            reply_token='test',
+            webhook_event_id=f"test-{next(_event_counter)}",
+            delivery_context=None,
+        )
+        app.handle_message(event)
+        return self.replies[-1]
+
+    def report(self, project_name, names):
+        """今天的日報"""
+        lines = [app.to_minguo_str(app.date.today()), project_name, "出工人員:"]
+        lines.extend(f"{i}.{name}" for i, name in enumerate(names, 1))
+        return self.say("\n".join(lines))
+
+    def flush(self):
+        """試算表後端: 把 outbox 送到模擬工作表，並讓出勤封存讀到最新內容"""
+        if self.backend in ('sheets', 'mirror'):
+            app.flush_outbox()
+        app.attendance_repo.refresh()
+
+@pytest.fixture
+def fake_sheets(monkeypatch, tmp_path):
+    """模擬的出勤表與每日統整表，測試結束時清掉留在 outbox 的寫入"""
+    sheets_backend = FakeSheetsBackend()
+    sheets = types.SimpleNamespace(
+        backend=sheets_backend,
+        attendance=FakeWorksheet(sheets_backend, app.ATTENDANCE_SHEET_NAME, app.ATTENDANCE_HEADERS),
+        summary=FakeWorksheet(sheets_backend, app.DAILY_SUMMARY_SHEET, ["統計日期", "姓名", "總出勤天數", "統計時間"]),
+    )
+    sheets.spreadsheet = FakeSpreadsheet(sheets_backend, sheets.attendance, sheets.summary)
+    monkeypatch.setattr(app, 'spreadsheet', sheets.spreadsheet)
+    monkeypatch.setattr(app, 'attendance_sheet', sheets.attendance)
+    monkeypatch.setattr(app, 'summary_sheet', sheets.summary)
+    monkeypatch.setattr(app, 'attendance_partitions', {})
+    monkeypatch.setattr(app, 'sheets_connect_attempted', True)
+    monkeypatch.setattr(app, 'sheets_breaker', app.CircuitBreaker(app.SHEETS_BREAKER_THRESHOLD, app.SHEETS_BREAKER_COOLDOWN))
+    monkeypatch.setattr(app, 'attendance_archive', app.AttendanceArchive(str(tmp_path / 'archive')))
+    monkeypatch.setattr(app, 'attendance_row_index', {})
+    monkeypatch.setattr(app, 'ATTENDANCE_BACKEND', 'sheets')
+    monkeypatch.setattr(app, 'attendance_repo', app.SheetsAttendanceRepository())
+    yield sheets
+    # 留在 outbox 的寫入要在換回真正的工作表之前處理掉，不然會影響之後的測試
+    app.flush_outbox()
+    conn = app.get_local_db()
+    conn.execute("DELETE FROM sheet_outbox")
+    conn.execute("DELETE FROM sheet_row_map")
+    conn.execute("DELETE FROM sheet_layout")
+
+@pytest.fixture(params=['memory', 'sqlite', 'sheets'])
+def bot(request, monkeypatch, tmp_path):
+    """每個測試各自的出勤後端、Session 與出勤封存"""
+    backend = request.param
+    monkeypatch.setattr(app, 'session_store', app.InMemorySessionStore())
+    monkeypatch.setattr(app, 'attendance_archive', app.AttendanceArchive(str(tmp_path / 'archive')))
+    monkeypatch.setattr(app, 'attendance_row_index', {})
+    monkeypatch.setattr(app, 'ATTENDANCE_BACKEND', backend)
+    if backend == 'sheets':
+        request.getfixturevalue('fake_sheets')
+    elif backend == 'sqlite':
+        monkeypatch.setattr(app, 'attendance_repo', app.SQLiteAttendanceRepository())
+    else:
+        monkeypatch.setattr(app, 'attendance_repo', app.InMemoryAttendanceRepository())
+
+    bot = AttendanceBot(backend)
+    monkeypatch.setattr(app, 'send_reply', lambda event, text: bot.replies.append(text) or True)
+    return bot
@@ -0,0 +1,75 @@
+from datetime import date, timedelta
+
+from conftest import app
+
+def roc(days_ago):
+    return app.to_minguo_str(date.today() - timedelta(days=days_ago))
+
+def row(days_ago, name, checkout='17:00', days=1.0):
+    return [roc(days_ago), name, '07:30', checkout, days if checkout else '', '項目: A', '']
+
+def spy_ranges(sheet, monkeypatch):
+    """記錄 get_values 讀取的範圍"""
+    ranges = []
+    get_values = sheet.get_values
+
+    def recording(range_name=None, **kwargs):
+        ranges.append(range_name)
+        return get_values(range_name, **kwargs)
+    monkeypatch.setattr(sheet, 'get_values', recording)
+    return ranges
+
+def test_incremental_sync_rereads_only_recent_rows(fake_sheets, monkeypatch):
+    """超過 ARCHIVE_RESYNC_DAYS 的列不再讀取；近期的列重新讀取，補上的離場會更新"""
+    archive = app.attendance_archive
+    fake_sheets.attendance.rows.extend([row(30, '王'), row(20, '李'), row(2, '林', checkout='')])
+    archive.sync()
+    ranges = spy_ranges(fake_sheets.attendance, monkeypatch)
+
+    fake_sheets.attendance.rows[3] = row(2, '林')
+    fake_sheets.attendance.rows.append(row(1, '陳'))
+    assert archive.sync() == 2
+
+    assert ranges == ['A4:F']
+    assert [(r[1], r[4]) for r in archive.rows_between()] == [('王', 1.0), ('李', 1.0), ('林', 1.0), ('陳', 1.0)]
+
+def test_deleted_rows_trigger_full_sync(fake_sheets):
+    """主表被手動刪列時增量範圍對不上，改為完整同步，不留下已刪除的列"""
+    archive = app.attendance_archive
+    fake_sheets.attendance.rows.extend([row(30, '王'), row(3, '李'), row(2, '林'), row(1, '陳')])
+    archive.sync()
+
+    del fake_sheets.attendance.rows[2:]
+    archive.sync()
+    assert [r[1] for r in archive.rows_between()] == ['王']
+    assert archive.live_rows == 1
+
+def test_other_process_sees_synced_archive(fake_sheets):
+    """同一目錄的另一個封存物件（另一個程序）讀到同步後的內容"""
+    fake_sheets.attendance.rows.extend([row(3, '王'), row(2, '李')])
+    app.attendance_archive.sync()
+
+    other = app.AttendanceArchive(app.attendance_archive.directory)
+    assert [r[1] for r in other.rows_between()] == ['王', '李']
+
+    fake_sheets.attendance.rows.append(row(1, '林'))
+    app.attendance_archive.sync()
+    assert [r[1] for r in other.rows_between()] == ['王', '李', '林']
+
+def test_roll_over_moves_rows_into_history(fake_sheets, monkeypatch):
+    """移出後歷史部分不再讀取，主表部分對應移出後的主表列號"""
+    archive = app.attendance_archive
+    moved = [row(60, '王'), row(59, '李')]
+    live = [row(2, '林', checkout='')]
+    fake_sheets.attendance.rows.extend(moved + live)
+    archive.sync()
+
+    del fake_sheets.attendance.rows[1:3]
+    archive.roll_over([[str(v) for v in r] for r in moved], [[str(v) for v in r] for r in live])
+    assert (archive.live_base, archive.live_rows) == (2, 1)
+    assert archive.open_rows() == [(roc(2), '林', 2)]
+
+    ranges = spy_ranges(fake_sheets.attendance, monkeypatch)
+    archive.sync(full=True)
+    assert ranges == ['A2:F']
+    assert [r[1] for r in archive.rows_between()] == ['王', '李', '林']
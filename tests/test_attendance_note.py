@@ -0,0 +1,35 @@
+from datetime import date
+
+import pytest
+
+from conftest import app, unique_names
+
+@pytest.mark.parametrize("project_name, remarks, note", [
+    ("工地A", (), "項目: 工地A"),
+    ("工地A", ("半天", None, "加班"), "項目: 工地A｜半天｜加班"),
+    (None, ("下午簽到",), "下午簽到"),
+    (None, (), ""),
+])
+def test_build_attendance_note(project_name, remarks, note):
+    assert app.build_attendance_note(project_name, *remarks) == note
+    assert app.note_project(note) == project_name
+
+def test_note_project_ignores_plain_remarks():
+    assert app.note_project("加班") is None
+    assert app.note_project("") is None
+
+def test_checkout_keeps_project_attribution(bot):
+    names = unique_names(2)
+    project_name = f"工地{names[0]}"
+    bot.report(project_name, names)
+    bot.say(f"離場：{names[0]}")
+    bot.say("人員離場")
+    bot.flush()
+
+    today = date.today()
+    rows = [row for row in app.attendance_repo.query_range(today, today) if row[1] in names]
+    assert len(rows) == 2
+    assert all(row[4] is not None for row in rows)
+    assert {row[5] for row in rows} == {project_name}
+    project_rows = [row for row in app.iter_payroll_rows(today, today, 'project') if project_name in row]
+    assert project_rows
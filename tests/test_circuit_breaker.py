@@ -0,0 +1,60 @@
+import pytest
+
+from conftest import app
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(app.time, 'monotonic', clock)
+    return clock
+
+def trip(breaker):
+    for _ in range(breaker.threshold):
+        breaker.record_failure()
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = app.CircuitBreaker(3, 10)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.is_open()
+    with pytest.raises(app.SheetsUnavailableError):
+        breaker.before_call()
+
+def test_failed_trials_do_not_restart_open_time(clock):
+    """半開試探失敗只重設冷卻，斷路時間從第一次斷路起算，背景線程才會重新連線"""
+    breaker = app.CircuitBreaker(3, 10)
+    trip(breaker)
+    for _ in range(3):
+        clock.now += 10
+        breaker.before_call()  # 冷卻結束，放行一次試探
+        breaker.record_failure()
+        assert breaker.is_open()
+    assert breaker.open_seconds() == 30
+    assert breaker.open_seconds() >= breaker.cooldown * 3
+
+def test_success_closes_breaker(clock):
+    breaker = app.CircuitBreaker(3, 10)
+    trip(breaker)
+    clock.now += 10
+    breaker.before_call()
+    breaker.record_success()
+    assert not breaker.is_open()
+    assert breaker.open_seconds() == 0
+    breaker.before_call()
+
+def test_only_one_trial_in_flight(clock):
+    breaker = app.CircuitBreaker(3, 10)
+    trip(breaker)
+    clock.now += 10
+    breaker.before_call()
+    with pytest.raises(app.SheetsUnavailableError):
+        breaker.before_call()
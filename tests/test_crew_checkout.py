@@ -0,0 +1,46 @@
+from datetime import date
+
+from conftest import app, unique_names
+
+def test_crew_checkout_after_individual_checkouts(bot, monkeypatch):
+    names = unique_names(4)
+    project_name = f"工地{names[0]}"
+    bot.report(project_name, names)
+    bot.flush()
+    for name in names[:3]:
+        bot.say(f"離場：{name}")
+
+    rebuilds = []
+    original = app.rebuild_attendance_index
+    monkeypatch.setattr(app, 'rebuild_attendance_index',
+                        lambda *args, **kwargs: rebuilds.append(args) or original(*args, **kwargs))
+    reply = bot.say("人員離場")
+
+    assert "已記錄 1 人離場" in reply
+    assert "已離場 3 人" in reply
+    assert "未完成" not in reply
+    assert rebuilds == []
+
+def test_crew_checkout_twice_reports_everyone_closed(bot):
+    names = unique_names(2)
+    bot.report(f"工地{names[0]}", names)
+    bot.say("人員離場")
+    reply = bot.say("人員離場")
+
+    assert "已記錄 0 人離場" in reply
+    assert "已離場 2 人" in reply
+    assert "未完成" not in reply
+
+def test_record_checkouts_separates_closed_from_missing(bot):
+    names = unique_names(2)
+    bot.report(f"工地{names[0]}", names[:1])
+    bot.say(f"離場：{names[0]}")
+    bot.flush()
+    app.attendance_row_index.clear()
+
+    work_date = app.to_minguo_str(date.today())
+    checkout_time = app.datetime.datetime.now()
+    updated, closed, failed = app.attendance_repo.record_checkouts(
+        work_date, [(names[0], checkout_time, 1.0, ''), (names[1], checkout_time, 1.0, '')]
+    )
+    assert (updated, closed, failed) == ([], [names[0]], [names[1]])
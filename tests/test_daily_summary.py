@@ -0,0 +1,65 @@
+from datetime import date, timedelta
+
+import gspread
+
+from conftest import app, unique_names
+from replay_harness import FakeResponse
+
+def summary_ops():
+    return app.get_local_db().execute(
+        "SELECT payload FROM sheet_outbox WHERE sheet = ?", (app.DAILY_SUMMARY_SHEET,)
+    ).fetchall()
+
+def test_pending_summary_rows_are_not_written_twice(fake_sheets, monkeypatch):
+    """統整列還在 outbox 時再次統整（例如排程重試），不能再排入同一組 (日期, 姓名)"""
+    work_date = app.to_minguo_str(date.today() - timedelta(days=1))
+    name = unique_names(1)[0]
+    fake_sheets.attendance.rows.append([work_date, name, '07:30', '17:00', 1.0, '項目: A', ''])
+
+    def rejected(values, **kwargs):
+        raise gspread.exceptions.APIError(FakeResponse(429, 'Quota exceeded', 'RESOURCE_EXHAUSTED'))
+    with monkeypatch.context() as patch:
+        patch.setattr(fake_sheets.summary, 'append_rows', rejected)
+        assert app.daily_summary() == 1
+        assert len(summary_ops()) == 1
+        assert app.daily_summary() == 0
+        assert len(summary_ops()) == 1
+
+    app.get_local_db().execute("UPDATE sheet_outbox SET next_attempt = 0")
+    app.flush_outbox()
+    assert [row[:3] for row in fake_sheets.summary.rows[1:]] == [[work_date, name, 1.0]]
+
+def test_backfill_is_idempotent(fake_sheets):
+    """漏掉的日期一次補齊，同一天同一人只取最高天數；再執行不會重複寫"""
+    today = date.today()
+    name, other = unique_names(2)
+    days = [app.to_minguo_str(today - timedelta(days=n)) for n in (3, 2, 1)]
+    fake_sheets.attendance.rows.extend([
+        [days[0], name, '07:30', '12:00', 0.5, '項目: A', ''],
+        [days[0], name, '13:00', '17:00', 1.0, '項目: B', ''],
+        [days[1], other, '07:30', '17:00', 1.0, '項目: A', ''],
+        [days[2], name, '07:30', '', '', '項目: A', ''],
+    ])
+
+    assert app.daily_summary(include_today=False) == 2
+    assert app.daily_summary(include_today=False) == 0
+    assert sorted(row[:3] for row in fake_sheets.summary.rows[1:]) == sorted([
+        [days[0], name, 1.0],
+        [days[1], other, 1.0],
+    ])
+
+def test_backfill_starts_after_last_summarized_day(fake_sheets, monkeypatch):
+    """已統整到的最後一天之前的日期不再補，補的天數也有上限"""
+    monkeypatch.setattr(app, 'SUMMARY_BACKFILL_MAX_DAYS', 3)
+    today = date.today()
+    name = unique_names(1)[0]
+    fake_sheets.attendance.rows.extend(
+        [app.to_minguo_str(today - timedelta(days=n)), name, '07:30', '17:00', 1.0, '項目: A', '']
+        for n in range(6, 0, -1)
+    )
+    fake_sheets.summary.rows.append([app.to_minguo_str(today - timedelta(days=5)), name, 1.0, ''])
+
+    assert app.daily_summary(include_today=False) == 3
+    assert [row[0] for row in fake_sheets.summary.rows[2:]] == [
+        app.to_minguo_str(today - timedelta(days=n)) for n in (3, 2, 1)
+    ]
@@ -0,0 +1,26 @@
+from conftest import app
+
+def test_duplicate_within_window():
+    dedup = app.TimeBucketedDedup(10)
+    assert not dedup.check_and_add('a', now=100)
+    assert dedup.check_and_add('a', now=105)
+    assert not dedup.check_and_add('a', now=111)
+
+def test_entries_expire_after_window():
+    dedup = app.TimeBucketedDedup(10)
+    dedup.add('a', now=100)
+    dedup.add('b', now=103)
+    dedup.check_and_add('c', now=112)
+    assert dedup.size() == 2
+    dedup.check_and_add('d', now=200)
+    assert dedup.size() == 1
+
+def test_clock_going_backwards_still_expires():
+    """時間倒退時記到最新的一格，不會清掉同一格裡較新的 id，過了時間窗全部都會被刪除"""
+    dedup = app.TimeBucketedDedup(10)
+    dedup.add('a', now=105)
+    dedup.add('b', now=95)
+    assert dedup.check_and_add('a', now=106)
+    assert dedup.check_and_add('b', now=106)
+    dedup.check_and_add('c', now=200)
+    assert dedup.seen == {'c': 200}
@@ -0,0 +1,109 @@
+import time
+import uuid
+
+from conftest import app
+
+def test_write_quota_is_shared_between_processes():
+    """每個 worker 程序各有自己的 TokenBucket 物件，token 數存在同一個 SQLite"""
+    name = f"test-{uuid.uuid4().hex}"
+    workers = [app.TokenBucket(name, 600, capacity=2), app.TokenBucket(name, 600, capacity=2)]
+    started = time.monotonic()
+    for bucket in workers * 2:
+        bucket.acquire()
+    # 容量 2、每秒補 10 個: 第 3、4 個 token 要等約 0.2 秒；各自計算的話不必等待
+    assert time.monotonic() - started >= 0.15
+
+def outbox_rows(row_key):
+    return app.get_local_db().execute(
+        "SELECT kind FROM sheet_outbox WHERE row_key = ? ORDER BY id", (row_key,)
+    ).fetchall()
+
+def dead_rows(row_key):
+    return app.get_local_db().execute(
+        "SELECT kind, reason FROM sheet_outbox_dead WHERE row_key = ?", (row_key,)
+    ).fetchall()
+
+def test_update_without_row_goes_to_dead_letter(fake_sheets, monkeypatch):
+    monkeypatch.setattr(app, 'OUTBOX_UNRESOLVED_MAX_ATTEMPTS', 1)
+    row_key = app.make_row_key("115/01/02", f"無列{uuid.uuid4().hex[:6]}")
+    app.enqueue_sheet_ops([(app.ATTENDANCE_SHEET_NAME, 'update', row_key, None, 'D:F', ['17:00', 1.0, ''])])
+
+    app.flush_outbox()
+    assert outbox_rows(row_key) == []
+    assert dead_rows(row_key) == [('update', "找不到對應的列")]
+
+def test_update_waits_while_its_append_is_pending(fake_sheets, monkeypatch):
+    monkeypatch.setattr(app, 'OUTBOX_UNRESOLVED_MAX_ATTEMPTS', 1)
+
+    def failing_append(*args, **kwargs):
+        raise RuntimeError("append failed")
+    monkeypatch.setattr(fake_sheets.attendance, 'append_rows', failing_append)
+    row_key = app.make_row_key("115/01/02", f"待送{uuid.uuid4().hex[:6]}")
+    app.enqueue_sheet_ops([
+        (app.ATTENDANCE_SHEET_NAME, 'append', row_key, None, None, ["115/01/02", "x", "07:30", "", "", "", ""]),
+        (app.ATTENDANCE_SHEET_NAME, 'update', row_key, None, 'D:F', ['17:00', 1.0, '']),
+    ])
+
+    app.flush_outbox()
+    assert outbox_rows(row_key) == [('append',), ('update',)]
+    assert dead_rows(row_key) == []
+
+def test_append_and_update_resolve_row_in_one_flush(fake_sheets):
+    """同一批的新增列先送出並記下列號，之後的更新依 row_key 寫到那一列"""
+    names = [f"列{uuid.uuid4().hex[:6]}" for _ in range(3)]
+    app.enqueue_sheet_ops([
+        (app.ATTENDANCE_SHEET_NAME, 'append', app.make_row_key("115/01/02", name), None, None,
+         ["115/01/02", name, "07:30", "", "", "", ""])
+        for name in names
+    ] + [(app.ATTENDANCE_SHEET_NAME, 'update', app.make_row_key("115/01/02", names[1]), None, 'D:F',
+          ['17:00', 1.0, '加班'])])
+
+    assert app.flush_outbox() == 4
+    assert [row[1] for row in fake_sheets.attendance.rows[1:]] == names
+    assert fake_sheets.attendance.rows[2][3:6] == ['17:00', 1.0, '加班']
+    assert app.get_local_db().execute(
+        "SELECT row FROM sheet_row_map WHERE sheet = ? AND row_key = ?",
+        (app.ATTENDANCE_SHEET_NAME, app.make_row_key("115/01/02", names[2]))
+    ).fetchone() == (4,)
+
+def test_appends_are_batched_into_one_call(fake_sheets, monkeypatch):
+    calls = []
+    append_rows = fake_sheets.attendance.append_rows
+
+    def counting_append(values, **kwargs):
+        calls.append(len(values))
+        return append_rows(values, **kwargs)
+    monkeypatch.setattr(fake_sheets.attendance, 'append_rows', counting_append)
+    app.enqueue_sheet_ops([
+        (app.ATTENDANCE_SHEET_NAME, 'append', None, None, None, ["115/01/02", f"批{i}", "07:30", "", "", "", ""])
+        for i in range(5)
+    ])
+
+    app.flush_outbox()
+    assert calls == [5]
+
+def test_failed_send_is_retried_after_backoff(fake_sheets, monkeypatch):
+    """送出失敗留在 outbox 並延後重試，時間未到不會再送"""
+    failures = [RuntimeError("暫時失敗")]
+    append_rows = fake_sheets.attendance.append_rows
+
+    def flaky_append(values, **kwargs):
+        if failures:
+            raise failures.pop()
+        return append_rows(values, **kwargs)
+    monkeypatch.setattr(fake_sheets.attendance, 'append_rows', flaky_append)
+    row_key = app.make_row_key("115/01/02", f"重試{uuid.uuid4().hex[:6]}")
+    app.enqueue_sheet_ops([(app.ATTENDANCE_SHEET_NAME, 'append', row_key, None, None,
+                            ["115/01/02", "重試", "07:30", "", "", "", ""])])
+
+    assert app.flush_outbox() == 0
+    attempts, next_attempt = app.get_local_db().execute(
+        "SELECT attempts, next_attempt FROM sheet_outbox WHERE row_key = ?", (row_key,)
+    ).fetchone()
+    assert attempts == 1 and next_attempt > time.time()
+    assert app.flush_outbox() == 0
+
+    app.get_local_db().execute("UPDATE sheet_outbox SET next_attempt = 0 WHERE row_key = ?", (row_key,))
+    assert app.flush_outbox() == 1
+    assert outbox_rows(row_key) == []
+    assert fake_sheets.attendance.rows[-1][1] == "重試"
@@ -0,0 +1,141 @@
+# 指令路由與解析的效能測試
+# 語料以固定種子產生，每筆都帶著預期的路由結果，先確認解析正確再計時
+#   python -m pytest -q -m benchmark -s                              # 顯示每種解析的吞吐量
+#   BENCH_PARSERS_SAVE=bench.json python -m pytest -q -m benchmark       # 存成基準
+#   BENCH_PARSERS_BASELINE=bench.json python -m pytest -q -m benchmark   # 變慢超過門檻即失敗
+import os
+import json
+import time
+import random
+
+import pytest
+
+from conftest import app
+
+pytestmark = pytest.mark.benchmark
+
+CORPUS_SIZE = int(os.environ.get('BENCH_PARSERS_SIZE', 5000))
+REPEAT = 5  # 重複次數，取最快一輪
+SEED = 115
+MAX_REGRESSION = float(os.environ.get('BENCH_PARSERS_MAX_REGRESSION', 0.25))  # 容許變慢的比例
+
+SURNAMES = "王李張劉陳楊黃趙吳周徐孫馬朱胡郭何林高羅"
+GIVEN = "小明志豪家豪建宏俊傑淑芬美玲雅婷怡君宗翰冠宇"
+PROJECTS = ["台北101工地", "新竹科學園區A棟", "桃園機場第三航廈", "台中港倉儲", "高雄捷運延伸段"]
+NOTES = ["半天", "早退", "借調", "加班", "14:00到", "外包"]
+CHAT = ["收到", "明天幾點集合？", "好的 謝謝", "今天下雨暫停施工", "@王小明 材料到了嗎", "👍"]
+
+def random_name(rng):
+    return rng.choice(SURNAMES) + "".join(rng.sample(GIVEN, 2))
+
+def random_project(rng):
+    return rng.choice(PROJECTS) if rng.random() < 0.5 else None
+
+def at_project(project):
+    return f"@{project}" if project else ""
+
+def date_str(rng):
+    return f"{rng.randint(113, 115):03d}/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}"
+
+def make_report(rng):
+    """實際格式的日報: 民國日期、專案名稱、編號人員、括號備註、共計與便當行"""
+    work_date, project = date_str(rng), rng.choice(PROJECTS)
+    lines = [f"{work_date}（{rng.choice('一二三四五六')}）", project, rng.choice(["出工人員：", "人員:", "今日出工"])]
+    staff = []
+    count = rng.randint(3, 25)
+    for i in range(1, count + 1):
+        name = random_name(rng)
+        note = rng.choice(NOTES) if rng.random() < 0.2 else None
+        staff.append({"name": name, "note": note})
+        lines.append(f"{i}{rng.choice(['.', '、', '. '])}{name}{f'({note})' if note else ''}")
+    lines.append(f"共計：{count}人")
+    lines.append(f"便當：{count}個")
+    return "\n".join(lines), ("report", {"date": work_date, "project_name": project, "staff": staff})
+
+def make_add(rng):
+    name, project = random_name(rng), random_project(rng)
+    note = rng.choice(NOTES) if rng.random() < 0.3 else None
+    text = f"新增{rng.choice([':', '：'])}{name}{at_project(project)}{f' ({note})' if note else ''}"
+    return text, ("add_staff", {"name": name, "project": project, "note": note})
+
+def make_checkout(rng):
+    name, project = random_name(rng), random_project(rng)
+    text = f"{rng.choice(['離場', '下班'])}{rng.choice([':', '：'])}{name}{at_project(project)}"
+    return text, ("checkout", {"name": name, "project": project})
+
+def make_crew(rng):
+    project = random_project(rng)
+    return rng.choice(["人員離場", "人員下班"]) + at_project(project), ("crew_checkout", {"project": project})
+
+def make_exact(rng):
+    text = rng.choice(sorted(app.EXACT_COMMANDS))
+    command, required_role = app.EXACT_COMMANDS[text]
+    return text, (command if required_role in (None, "MANAGER") else "unknown", None)
+
+def make_chat(rng):
+    return rng.choice(CHAT), ("unknown", None)
+
+def build_corpus(size, seed):
+    """依實際比例混合各種訊息，回傳 [(文字, 預期的 route_command 結果)]"""
+    rng = random.Random(seed)
+    makers = [(make_report, 2), (make_add, 3), (make_checkout, 3), (make_crew, 1), (make_exact, 1), (make_chat, 4)]
+    pool = [maker for maker, weight in makers for _ in range(weight)]
+    return [rng.choice(pool)(rng) for _ in range(size)]
+
+@pytest.fixture(scope='module')
+def corpus():
+    return build_corpus(CORPUS_SIZE, SEED)
+
+@pytest.fixture(scope='module')
+def results():
+    """各項吞吐量，全部量完後存成基準或與基準比較"""
+    results = {}
+    yield results
+    if os.environ.get('BENCH_PARSERS_SAVE'):
+        with open(os.environ['BENCH_PARSERS_SAVE'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+def bench(func, inputs):
+    """回傳最佳一輪的每秒處理筆數"""
+    best = None
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        for text in inputs:
+            func(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(inputs) / best
+
+def test_corpus_routes_as_generated(corpus):
+    mismatches = [(text, expected, app.route_command(text, "MANAGER")) for text, expected in corpus
+                  if app.route_command(text, "MANAGER") != expected]
+    assert mismatches == []
+
+def test_corpus_mix_is_stable(corpus):
+    """固定種子產生的語料不變，吞吐量才能和基準比較"""
+    counts = {}
+    for _, (command, _) in corpus:
+        counts[command] = counts.get(command, 0) + 1
+    assert sum(counts.values()) == CORPUS_SIZE
+    assert set(counts) == {"report", "add_staff", "checkout", "crew_checkout", "period_query", "unknown"}
+
+@pytest.mark.parametrize("name", [
+    "route_command", "parse_full_attendance_report", "parse_add_staff", "parse_checkout_staff",
+])
+def test_throughput(name, corpus, results):
+    if name == "route_command":
+        func, inputs = (lambda text: app.route_command(text, "MANAGER")), [text for text, _ in corpus]
+    else:
+        command = {"parse_full_attendance_report": "report", "parse_add_staff": "add_staff",
+                   "parse_checkout_staff": "checkout"}[name]
+        func, inputs = getattr(app, name), [text for text, (routed, _) in corpus if routed == command]
+    results[name] = ops = bench(func, inputs)
+    print(f"\n{name:<32} {len(inputs):>6} 筆  {ops:>12,.0f} 筆/秒  {1e6 / ops:>8.2f} µs/筆")
+
+    baseline_path = os.environ.get('BENCH_PARSERS_BASELINE')
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if name in baseline:
+            change = ops / baseline[name] - 1
+            assert change >= -MAX_REGRESSION, f"{name} 變慢 {change:+.1%}（門檻 {MAX_REGRESSION:.0%}）"
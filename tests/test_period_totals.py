@@ -0,0 +1,61 @@
+import threading
+from datetime import date, datetime
+
+from conftest import app, unique_names
+
+def test_rebuild_waits_for_checkout_in_progress(monkeypatch):
+    """離場記錄已寫入、總計還沒累加時重建，重建要等累加完成，天數不能重複計算"""
+    repo = app.InMemoryAttendanceRepository()
+    monkeypatch.setattr(app, 'attendance_repo', repo)
+    name = unique_names(1)[0]
+    work_date = app.to_minguo_str(date(2026, 10, 16))
+    sign_in = datetime(2026, 10, 16, 7, 30)
+    assert app.write_person_to_sheet(work_date, "專案", name, sign_in)
+
+    rebuild = threading.Thread(target=app.rebuild_period_totals)
+    record_checkouts = repo.record_checkouts
+
+    def record_then_rebuild(*args):
+        result = record_checkouts(*args)
+        rebuild.start()
+        rebuild.join(0.2)
+        return result
+    monkeypatch.setattr(repo, 'record_checkouts', record_then_rebuild)
+
+    assert app.update_person_checkout(work_date, name, datetime(2026, 10, 16, 17, 0), sign_in)
+    rebuild.join()
+    assert dict(app.get_period_totals(date(2026, 10, 16)))[name] == 1.0
+
+def test_pay_period_boundaries():
+    assert app.get_pay_period(date(2026, 1, 5)) == (date(2025, 12, 21), date(2026, 1, 5))
+    assert app.get_pay_period(date(2026, 1, 6)) == (date(2026, 1, 6), date(2026, 1, 20))
+    assert app.get_pay_period(date(2026, 1, 20)) == (date(2026, 1, 6), date(2026, 1, 20))
+    assert app.get_pay_period(date(2026, 12, 21)) == (date(2026, 12, 21), date(2027, 1, 5))
+
+def test_deltas_accumulate_per_pay_period():
+    name = unique_names(1)[0]
+    app.add_period_deltas([
+        (app.to_minguo_str(date(2026, 3, 6)), name, 1.0),
+        (app.to_minguo_str(date(2026, 3, 20)), name, 0.5),
+        (app.to_minguo_str(date(2026, 3, 21)), name, 1.0),
+        ("不是日期", name, 1.0),
+    ])
+
+    assert dict(app.get_period_totals(date(2026, 3, 10)))[name] == 1.5
+    assert dict(app.get_period_totals(date(2026, 4, 5)))[name] == 1.0
+
+def test_rebuild_replaces_drifted_totals(monkeypatch):
+    """重建以出勤資料為準: 增量累加的誤差與已刪除的人都會修正"""
+    repo = app.InMemoryAttendanceRepository()
+    monkeypatch.setattr(app, 'attendance_repo', repo)
+    name, gone = unique_names(2)
+    work_date = app.to_minguo_str(date(2026, 5, 7))
+    sign_in = datetime(2026, 5, 7, 7, 30)
+    app.write_person_to_sheet(work_date, "專案", name, sign_in)
+    app.update_person_checkout(work_date, name, datetime(2026, 5, 7, 12, 0), sign_in)
+    app.add_period_deltas([(work_date, name, 3.0), (work_date, gone, 1.0)])
+
+    assert app.rebuild_period_totals() >= 1
+    totals = dict(app.get_period_totals(date(2026, 5, 7)))
+    assert totals[name] == 0.5
+    assert gone not in totals
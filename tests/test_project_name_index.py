@@ -0,0 +1,48 @@
+import random
+
+from conftest import app
+
+DAY = "115/10/17"
+
+def build(names, work_date=DAY):
+    index = app.ProjectNameIndex()
+    for name in names:
+        index.add(name, work_date, name)
+    return index
+
+def brute_force(names, query):
+    """逐一比對所有名稱的參考結果"""
+    q = app.normalize_project_name(query)
+    normalized = {name: app.normalize_project_name(name) for name in names}
+    exact = {k for k, n in normalized.items() if n == q}
+    prefix = {k for k, n in normalized.items() if n != q and n.startswith(q)}
+    contains = {k for k, n in normalized.items() if q in n} - exact - prefix
+    contained = {k for k, n in normalized.items() if n and n in q} - exact - prefix - contains
+    return [exact, prefix, contains, contained]
+
+def test_match_tiers():
+    index = build(["信義A棟", "信義", "大安信義", "A", "松山"])
+    assert index.match(DAY, "信義") == [{"信義"}, {"信義A棟"}, {"大安信義"}, set()]
+    assert index.match(DAY, "信義a棟三樓") == [set(), set(), set(), {"信義A棟", "信義", "A"}]
+
+def test_match_ignores_width_case_and_spaces():
+    index = build(["ＡＢＣ 工地"])
+    assert index.match(DAY, "abc工地")[0] == {"ＡＢＣ 工地"}
+
+def test_dates_are_separate_and_remove_clears_all_tiers():
+    index = build(["信義"])
+    index.add("other-day", "115/10/18", "信義")
+    assert index.match("115/10/18", "信義")[0] == {"other-day"}
+
+    index.remove("信義")
+    assert index.match(DAY, "信義") == [set(), set(), set(), set()]
+    assert index.match(DAY, "信") == [set(), set(), set(), set()]
+
+def test_match_agrees_with_brute_force():
+    rng = random.Random(7)
+    alphabet = "信義大安松山AB一二"
+    names = list({"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(60)})
+    index = build(names)
+    for _ in range(300):
+        query = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 5)))
+        assert index.match(DAY, query) == brute_force(names, query), query
@@ -0,0 +1,114 @@
+from datetime import date
+
+import pytest
+
+from conftest import app
+
+def roc(day):
+    return app.to_minguo_str(day)
+
+def add_rows(sheet, *rows):
+    sheet.rows.extend(list(row) for row in rows)
+
+def test_rollover_keeps_numbers_numeric(fake_sheets):
+    """移到分區的天數要是數字，分區中的 SUM 與樞紐分析才算得到"""
+    add_rows(fake_sheets.attendance,
+             [roc(date(2026, 8, 3)), '王', '07:30', '17:00', 1.0, '項目: A', ''],
+             [roc(date(2026, 8, 4)), '王', '07:30', '12:00', 0.5, '項目: A', ''],
+             [roc(date(2026, 10, 16)), '林', '07:30', '', '', '項目: B', ''])
+
+    assert app.rollover_attendance(date(2026, 10, 17)) == 2
+
+    partition = fake_sheets.spreadsheet.sheets[app.attendance_partition_title(date(2026, 8, 1))]
+    assert [row[4] for row in partition.rows[1:]] == [1.0, 0.5]
+    assert [row[1] for row in fake_sheets.attendance.rows[1:]] == ['林']
+    # 出勤封存仍以文字列解析
+    assert app.attendance_repo.query_range(date(2026, 8, 1), date(2026, 8, 31)) == [
+        (roc(date(2026, 8, 3)), '王', '07:30', '17:00', 1.0, 'A'),
+        (roc(date(2026, 8, 4)), '王', '07:30', '12:00', 0.5, 'A'),
+    ]
+
+def test_rerun_does_not_duplicate_partition_rows(fake_sheets):
+    """上次寫入分區後、刪除主表前中斷，重跑時已在分區的列不重複寫"""
+    row = [roc(date(2026, 8, 3)), '王', '07:30', '17:00', 1.0, '項目: A', '']
+    add_rows(fake_sheets.attendance, row)
+    partition = fake_sheets.spreadsheet.add_worksheet(app.attendance_partition_title(date(2026, 8, 1)))
+    add_rows(partition, app.ATTENDANCE_HEADERS, row)
+    app.attendance_partitions[partition.title] = partition
+
+    assert app.rollover_attendance(date(2026, 10, 17)) == 1
+    assert partition.rows[1:] == [row]
+    assert fake_sheets.attendance.rows[1:] == []
+
+def test_interrupted_delete_rebuilds_row_map(fake_sheets, monkeypatch):
+    """刪列後、修正列號前中斷，下次送出 outbox 前依試算表現況修正，不會寫到別人的列"""
+    add_rows(fake_sheets.attendance,
+             [roc(date(2026, 8, 3)), '王', '07:30', '17:00', 1.0, '項目: A', ''],
+             [roc(date(2026, 10, 16)), '林', '07:30', '', '', '項目: B', ''],
+             [roc(date(2026, 10, 16)), '陳', '07:30', '', '', '項目: B', ''])
+    conn = app.get_local_db()
+    for row_key, row in [(app.make_row_key(roc(date(2026, 8, 3)), '王'), 2),
+                         (app.make_row_key(roc(date(2026, 10, 16)), '林'), 3),
+                         (app.make_row_key(roc(date(2026, 10, 16)), '陳'), 4)]:
+        conn.execute("INSERT INTO sheet_row_map (sheet, row_key, row, created) VALUES (?, ?, ?, 0)",
+                     (app.ATTENDANCE_SHEET_NAME, row_key, row))
+
+    def crash(sheet, deleted_rows):
+        raise RuntimeError("中斷")
+    with monkeypatch.context() as patch:
+        patch.setattr(app, 'remap_sheet_rows', crash)
+        with pytest.raises(RuntimeError):
+            app.rollover_attendance(date(2026, 10, 17))
+    assert [row[1] for row in fake_sheets.attendance.rows[1:]] == ['林', '陳']
+
+    app.enqueue_sheet_ops([(app.ATTENDANCE_SHEET_NAME, 'update', app.make_row_key(roc(date(2026, 10, 16)), '陳'),
+                            4, 'D:F', ['17:00', 1.0, '項目: B'])])
+    app.flush_outbox()
+
+    assert fake_sheets.attendance.rows[1][1:5] == ['林', '07:30', '', '']
+    assert fake_sheets.attendance.rows[2][1:5] == ['陳', '07:30', '17:00', 1.0]
+    assert dict(conn.execute("SELECT row_key, row FROM sheet_row_map WHERE sheet = ?",
+                             (app.ATTENDANCE_SHEET_NAME,)).fetchall()) == {
+        app.make_row_key(roc(date(2026, 10, 16)), '林'): 2,
+        app.make_row_key(roc(date(2026, 10, 16)), '陳'): 3,
+    }
+    assert app.get_layout_value('rollover_deleting') == 0
+    assert len(app.attendance_repo.query_range(date(2026, 8, 1), date(2026, 8, 31))) == 1
+
+def test_remap_shifts_rows_after_deleted_ones(fake_sheets):
+    conn = app.get_local_db()
+    sheet = app.ATTENDANCE_SHEET_NAME
+    for row_key, row in [('a', 2), ('b', 3), ('c', 5), ('d', 8)]:
+        conn.execute("INSERT INTO sheet_row_map (sheet, row_key, row, created) VALUES (?, ?, ?, 0)",
+                     (sheet, row_key, row))
+    app.enqueue_sheet_ops([(sheet, 'update', 'd', 8, 'D:F', ['17:00', 1.0, '']),
+                           (sheet, 'update', 'b', 3, 'D:F', ['17:00', 1.0, ''])])
+    generation = app.get_layout_value('generation')
+
+    app.remap_sheet_rows(sheet, [6, 3, 4])
+
+    assert dict(conn.execute("SELECT row_key, row FROM sheet_row_map WHERE sheet = ?", (sheet,)).fetchall()) == {
+        'a': 2, 'c': 3, 'd': 5,
+    }
+    assert conn.execute("SELECT row_key, target_row FROM sheet_outbox WHERE sheet = ? ORDER BY id",
+                        (sheet,)).fetchall() == [('d', 5), ('b', None)]
+    assert app.get_layout_value('generation') == generation + 1
+
+def test_checkout_after_rollover_updates_shifted_row(fake_sheets):
+    """移出上方的舊列後，尚未離場的人離場時寫到他移動後的列"""
+    today = date(2026, 10, 16)
+    add_rows(fake_sheets.attendance,
+             [roc(date(2026, 8, 3)), '王', '07:30', '17:00', 1.0, '項目: A', ''],
+             [roc(today), '林', '07:30', '', '', '項目: B', ''],
+             [roc(date(2026, 8, 4)), '李', '07:30', '17:00', 1.0, '項目: A', ''],
+             [roc(today), '陳', '07:30', '', '', '項目: B', ''])
+    app.rebuild_attendance_index()
+
+    assert app.rollover_attendance(date(2026, 10, 17)) == 2
+    app.attendance_repo.record_checkouts(roc(today), [('陳', app.datetime.datetime(2026, 10, 16, 17, 0), 1.0, '項目: B')])
+    app.flush_outbox()
+
+    assert [row[1:5] for row in fake_sheets.attendance.rows[1:]] == [
+        ['林', '07:30', '', ''],
+        ['陳', '07:30', '17:00', 1.0],
+    ]
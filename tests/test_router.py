@@ -0,0 +1,61 @@
+import pytest
+
+from conftest import app
+
+REPORT = "115/10/16（五）\n台北101工地\n出工人員：\n1.王小明\n2、李志豪(半天)\n3. 陳建宏 (14:00到)\n共計：3人\n便當：3個"
+
+@pytest.mark.parametrize("text, role, expected", [
+    ("查詢本期出勤", None, ("period_query", None)),
+    ("重新整理出勤", "ADMIN", ("period_refresh", None)),
+    ("重新整理出勤", "MANAGER", ("unknown", None)),
+    ("系統狀態", None, ("unknown", None)),
+    ("新增：王小明", "MANAGER", ("add_staff", {"name": "王小明", "project": None, "note": None})),
+    ("新增:王小明@台北101工地 (借調)", "MANAGER",
+     ("add_staff", {"name": "王小明", "project": "台北101工地", "note": "借調"})),
+    ("新增：李志豪 (半天)", "MANAGER", ("add_staff", {"name": "李志豪", "project": None, "note": "半天"})),
+    ("離場：王小明", "MANAGER", ("checkout", {"name": "王小明", "project": None})),
+    ("下班:王小明@台中港倉儲", "MANAGER", ("checkout", {"name": "王小明", "project": "台中港倉儲"})),
+    ("人員離場", "MANAGER", ("crew_checkout", {"project": None})),
+    ("人員下班@台中港倉儲", "MANAGER", ("crew_checkout", {"project": "台中港倉儲"})),
+    # 「人員離場：」同時含有「離場：」，個別離場優先
+    ("人員離場：王小明", "MANAGER", ("checkout", {"name": "王小明", "project": None})),
+    ("收到", "MANAGER", ("unknown", None)),
+    ("明天幾點集合？", None, ("unknown", None)),
+])
+def test_route_command(text, role, expected):
+    assert app.route_command(text, role) == expected
+
+def test_route_report():
+    command, parsed = app.route_command(REPORT, "MANAGER")
+    assert command == "report"
+    assert parsed == {
+        "date": "115/10/16",
+        "project_name": "台北101工地",
+        "staff": [
+            {"name": "王小明", "note": None},
+            {"name": "李志豪", "note": "半天"},
+            {"name": "陳建宏", "note": "14:00到"},
+        ],
+    }
+
+def test_report_needs_date_and_staff_header():
+    # 只有日期沒有人員/出工，不是日報
+    assert app.route_command("115/10/16 收工了", "MANAGER") == ("unknown", None)
+
+@pytest.mark.parametrize("text", [
+    "115/10/16",
+    "115/10/16\n\n出工人員：\n1.王小明",
+    "115/10/16\n台北101工地\n出工人員：\n共計：0人",
+    "10/16\n台北101工地\n出工人員：\n1.王小明",
+])
+def test_parse_report_rejects_incomplete(text):
+    assert app.parse_full_attendance_report(text) is None
+
+def test_parse_report_without_staff_header_starts_at_third_line():
+    parsed = app.parse_full_attendance_report("115/10/16\n新竹科學園區A棟\n1.王小明\n2.李志豪")
+    assert [person["name"] for person in parsed["staff"]] == ["王小明", "李志豪"]
+
+@pytest.mark.parametrize("text", ["新增：", "新增", "離場：", "下班"])
+def test_parsers_reject_missing_name(text):
+    assert app.parse_add_staff(text) is None
+    assert app.parse_checkout_staff(text) is None
@@ -0,0 +1,53 @@
+import uuid
+
+from conftest import app
+
+def test_only_one_leader_until_it_releases(tmp_path):
+    """同一個鎖檔只有一個 leader；leader 的檔案關閉（程序結束）後由其他程序接手"""
+    path = str(tmp_path / "scheduler.lock")
+    first, second = app.LeaderLock(path), app.LeaderLock(path)
+    assert first.try_acquire()
+    assert first.try_acquire()
+    assert not second.try_acquire()
+
+    first.lock_file.close()
+    assert second.try_acquire()
+    assert second.is_leader()
+
+def test_forked_child_is_not_leader(tmp_path, monkeypatch):
+    lock = app.LeaderLock(str(tmp_path / "scheduler.lock"))
+    assert lock.try_acquire()
+    monkeypatch.setattr(app.os, 'getpid', lambda: lock.owner_pid + 1)
+    assert not lock.is_leader()
+
+def test_run_id_succeeds_only_once():
+    job = f"job-{uuid.uuid4().hex[:6]}"
+    calls = []
+    assert app.run_job(job, f"{job}:1", lambda: calls.append(1) or 3) == 3
+    assert app.run_job(job, f"{job}:1", lambda: calls.append(1) or 3) is None
+    assert app.run_job(job, f"{job}:2", lambda: calls.append(1) or 4) == 4
+    assert len(calls) == 2
+    assert app.get_job_status()[job]['run_id'] == f"{job}:2"
+
+def test_failed_run_is_retried_with_same_run_id():
+    job = f"job-{uuid.uuid4().hex[:6]}"
+
+    def fail():
+        raise RuntimeError("試算表無法使用")
+    assert app.run_job(job, f"{job}:1", fail) is None
+    status = app.get_job_status()[job]
+    assert (status['status'], status['error']) == ('failed', "試算表無法使用")
+
+    assert app.run_job(job, f"{job}:1", lambda: 1) == 1
+    assert app.get_job_status()[job]['status'] == 'ok'
+
+def test_running_run_id_is_skipped_until_timeout(monkeypatch):
+    """另一個程序執行中的 run id 略過；超過 JOB_RUNNING_TIMEOUT 視為中斷，可重新執行"""
+    job = f"job-{uuid.uuid4().hex[:6]}"
+    conn = app.get_local_db()
+    conn.execute("INSERT INTO job_runs (run_id, job, status, started, pid) VALUES (?, ?, 'running', ?, 1)",
+                 (f"{job}:1", job, app.time.time()))
+
+    assert app.run_job(job, f"{job}:1", lambda: 1) is None
+    monkeypatch.setattr(app, 'JOB_RUNNING_TIMEOUT', 0)
+    assert app.run_job(job, f"{job}:1", lambda: 1) == 1
@@ -0,0 +1,73 @@
+import datetime
+import threading
+import uuid
+
+from conftest import app, unique_names
+
+WORK_DATE = "115/10/17"
+
+def workers(count=2):
+    """每個 SQLiteSessionStore 物件代表一個 worker 程序，共用同一個 SQLite"""
+    return [app.SQLiteSessionStore() for _ in range(count)]
+
+def project():
+    return f"工地{uuid.uuid4().hex[:6]}"
+
+def now():
+    return datetime.datetime.now()
+
+def test_concurrent_claims_register_once():
+    """多個 worker 同時登記同一批人，每人只有一個 worker 登記成功"""
+    stores = workers(4)
+    name = project()
+    sessions = [store.get_or_create(WORK_DATE, name, "U1") for store in stores]
+    people = [{"name": person, "note": ""} for person in unique_names(5)]
+    claimed = []
+    barrier = threading.Barrier(len(stores))
+
+    def claim(store, session):
+        barrier.wait()
+        claimed.extend(p['name'] for p in store.claim_staff(session, people, now()))
+    threads = [threading.Thread(target=claim, args=pair) for pair in zip(stores, sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(p['name'] for p in people)
+    assert [r.name for r in stores[0].get(WORK_DATE, name).staff] == [p['name'] for p in people]
+
+def test_stale_session_save_merges_instead_of_overwriting():
+    """worker 手上的 Session 是舊的，寫回時要併入其他 worker 已登記的人"""
+    first, second = workers()
+    name = project()
+    stale = second.get_or_create(WORK_DATE, name, "U1")
+    a, b = unique_names(2)
+    first.claim_staff(first.get(WORK_DATE, name), [{"name": a, "note": ""}], now())
+
+    stale.staff.add(b, now())
+    second.save(stale)
+
+    assert [r.name for r in first.get(WORK_DATE, name).staff] == [a, b]
+    assert [r.name for r in stale.staff] == [a, b]
+
+def test_release_only_removes_given_names():
+    store, = workers(1)
+    name = project()
+    session = store.get_or_create(WORK_DATE, name, "U1")
+    a, b = unique_names(2)
+    store.claim_staff(session, [{"name": a, "note": ""}, {"name": b, "note": ""}], now())
+
+    store.release_staff(session, [a])
+    assert [r.name for r in store.get(WORK_DATE, name).staff] == [b]
+
+def test_session_created_by_another_worker_is_matched():
+    """其他 worker 新建的 Session 也能以部分專案名稱找到，且只限被授權的用戶"""
+    first, second = workers()
+    second.match_project(WORK_DATE, "暖身")  # 先載入名稱索引，之後只能靠增量載入看到新 Session
+    name = project()
+    first.get_or_create(WORK_DATE, name, "U1")
+
+    assert second.match_project(WORK_DATE, name[:5]).project_name == name
+    assert second.match_project(WORK_DATE, name, user_id="U1").project_name == name
+    assert second.match_project(WORK_DATE, name, user_id="U2") is None
@@ -0,0 +1,89 @@
+import datetime
+
+import pytest
+from requests.exceptions import ConnectionError
+
+from conftest import FakeSheetsBackend, FakeSpreadsheet, FakeWorksheet, app
+
+class FakeCredentials:
+    def __init__(self, remaining):
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=remaining)
+        self.requests = []
+
+    def refresh(self, request):
+        self.requests.append(request)
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+def test_token_refresh_uses_plain_request(monkeypatch):
+    """換發 token 不能經過 AuthorizedSession，否則換發時又要再授權一次"""
+    creds = FakeCredentials(remaining=10)
+    monkeypatch.setattr(app, 'sheets_credentials', creds)
+    monkeypatch.setattr(app, 'sheets_session', app.AuthorizedSession(creds))
+
+    app.refresh_sheets_token_if_due()
+
+    assert len(creds.requests) == 1
+    assert not isinstance(creds.requests[0].session, app.AuthorizedSession)
+
+def test_token_not_refreshed_before_margin(monkeypatch):
+    creds = FakeCredentials(remaining=app.SHEETS_TOKEN_REFRESH_MARGIN + 600)
+    monkeypatch.setattr(app, 'sheets_credentials', creds)
+
+    app.refresh_sheets_token_if_due()
+
+    assert creds.requests == []
+
+class FakeClient:
+    def __init__(self, workbook):
+        self.workbook = workbook
+
+    def set_timeout(self, timeout):
+        pass
+
+    def open(self, title):
+        if isinstance(self.workbook, Exception):
+            raise self.workbook
+        return self.workbook
+
+class FakeSession:
+    def close(self):
+        pass
+
+@pytest.fixture
+def connect(monkeypatch):
+    """以模擬的 gspread Client 執行 connect_sheets，結束後還原連線相關的全域變數"""
+    for name in ('gsheet_client', 'spreadsheet', 'worksheet', 'attendance_sheet', 'summary_sheet',
+                 'sheets_credentials', 'sheets_session', 'attendance_partitions'):
+        monkeypatch.setattr(app, name, getattr(app, name))
+    monkeypatch.setattr(app, 'sheets_breaker', app.CircuitBreaker(3, 60))
+    monkeypatch.setattr(app, 'GOOGLE_SHEETS_CREDENTIALS_JSON', '{}')
+    monkeypatch.setattr(app.Credentials, 'from_service_account_info',
+                        lambda info, scopes: FakeCredentials(remaining=3600))
+    monkeypatch.setattr(app, 'build_sheets_session', lambda creds: FakeSession())
+
+    def run(workbook):
+        monkeypatch.setattr(app.gspread, 'Client', lambda auth, session: FakeClient(workbook))
+        app.connect_sheets()
+    return run
+
+def calls(method, status):
+    return app.sheets_calls_total.values.get((method, status), 0)
+
+def test_connect_counts_calls_and_creates_missing_sheets(connect):
+    backend = FakeSheetsBackend()
+    workbook = FakeSpreadsheet(backend, FakeWorksheet(backend, app.WORKSHEET_NAME, ["項目"]))
+    before = {method: calls(method, 'ok') for method in ('open', 'worksheets', 'add_worksheet', 'append_row')}
+
+    connect(workbook)
+
+    assert calls('open', 'ok') == before['open'] + 1
+    assert calls('worksheets', 'ok') == before['worksheets'] + 1
+    assert calls('add_worksheet', 'ok') == before['add_worksheet'] + 2
+    assert calls('append_row', 'ok') == before['append_row'] + 2
+    assert app.attendance_sheet.rows == [app.ATTENDANCE_HEADERS]
+
+def test_connect_failure_trips_breaker(connect):
+    """開啟試算表時連線失敗也要計入斷路器"""
+    with pytest.raises(ConnectionError):
+        connect(ConnectionError("連線逾時"))
+    assert app.sheets_breaker.failures == 1
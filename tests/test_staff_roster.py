@@ -0,0 +1,49 @@
+import datetime
+import random
+
+from conftest import app
+
+NOW = datetime.datetime(2026, 10, 17, 7, 30)
+
+def roster(*names):
+    """以建構子載入，與從資料庫讀回的舊名單相同，可能有正規化後相同的姓名"""
+    return app.StaffRoster(app.StaffRecord(name, NOW, "") for name in names)
+
+def test_suggests_names_one_edit_away():
+    staff = roster("王小明", "李大華", "陳美玲")
+    assert staff.suggest("王小民") == ["王小明"]
+    assert staff.suggest("王明") == ["王小明"]
+    assert staff.suggest("王小明明") == ["王小明"]
+    assert staff.suggest("李華大") == ["李大華"]
+    assert staff.suggest("張三") == []
+
+def test_normalized_duplicates_are_all_suggested():
+    """舊名單中正規化後相同的多人都列出來，讓使用者選"""
+    staff = roster("王小明", "王 小明（新）")
+    assert staff.get("王小明（新）") is None
+    assert sorted(staff.suggest("王小明（新）")) == ["王 小明（新）", "王小明"]
+
+def test_removed_names_are_not_suggested():
+    staff = roster("王小明", "王小民")
+    staff.remove(["王小明"])
+    assert staff.suggest("王小名") == ["王小民"]
+    staff.remove(["王小民"])
+    assert staff.suggest("王小名") == []
+    assert staff.near == {}
+
+def test_suggest_agrees_with_brute_force():
+    """與逐一比對所有姓名的刪字變化結果相同，並依 limit 截斷"""
+    rng = random.Random(11)
+    alphabet = "王李陳小明華美玲"
+    names = sorted({"".join(rng.choice(alphabet) for _ in range(rng.randint(2, 4))) for _ in range(80)})
+    staff = roster(*names)
+
+    def near(a, b):
+        return a == b or a in app.staff_name_deletions(b) or b in app.staff_name_deletions(a) or bool(
+            app.staff_name_deletions(a) & app.staff_name_deletions(b))
+    for _ in range(300):
+        query = "".join(rng.choice(alphabet) for _ in range(rng.randint(2, 4)))
+        if query in names:
+            continue
+        expected = sorted(name for name in names if near(name, query))[:5]
+        assert staff.suggest(query, limit=5) == expected, query
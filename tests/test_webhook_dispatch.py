@@ -0,0 +1,50 @@
+import json
+import queue
+import types
+
+import pytest
+
+from conftest import app
+from replay_harness import make_event, sign
+
+@pytest.fixture
+def client(monkeypatch):
+    """不啟動背景線程，佇列只放得下一個事件"""
+    monkeypatch.setattr(app, 'background_started', True)
+    monkeypatch.setattr(app, 'WEBHOOK_DISPATCH_MODE', 'queue')
+    monkeypatch.setattr(app, 'EVENT_WORKER_COUNT', 1)
+    monkeypatch.setattr(app, 'event_queues', [queue.Queue(maxsize=1)])
+    monkeypatch.setattr(app, 'pending_report_keys', {})
+    processed = []
+    monkeypatch.setattr(app, 'process_event', processed.append)
+    test_client = app.app.test_client()
+    test_client.processed = processed
+    return test_client
+
+def post(client, *texts, prefix):
+    user_id = app.ADMIN_USER_IDS[0]
+    body = json.dumps({"destination": "test", "events": [
+        make_event(user_id, "Ctest", text, f"{prefix}-{i}") for i, text in enumerate(texts)
+    ]}, ensure_ascii=False)
+    return client.post('/callback', data=body.encode('utf-8'),
+                       headers={'X-Line-Signature': sign(body), 'Content-Type': 'application/json'})
+
+def test_full_queue_returns_503_without_processing_inline(client):
+    assert post(client, "查詢本期出勤", prefix="a").status_code == 200
+    report = f"{app.to_minguo_str(app.date.today())}\n工地Q\n出工人員:\n1.王一"
+    response = post(client, report, "人員離場", prefix="b")
+
+    assert response.status_code == 503
+    assert client.processed == []
+    assert app.event_queues[0].qsize() == 1
+    # 被拒絕的日報不能留下 pending key，否則之後的指令會跟著一個不存在的日報走
+    assert app.pending_report_keys == {}
+
+def test_redelivered_copy_processed_first_skips_original():
+    event_id = "redelivery-order"
+    redelivered = types.SimpleNamespace(webhook_event_id=event_id,
+                                        delivery_context=types.SimpleNamespace(is_redelivery=True))
+    original = types.SimpleNamespace(webhook_event_id=event_id,
+                                     delivery_context=types.SimpleNamespace(is_redelivery=False))
+    assert not app.is_duplicate_message(redelivered)
+    assert app.is_duplicate_message(original)